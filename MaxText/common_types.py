@@ -46,6 +46,7 @@ CACHE_BATCH = "cache_batch"
 CACHE_SEQUENCE = "cache_sequence"
 CACHE_HEADS = "cache_heads"
 CACHE_KV = "cache_kv"
+CACHE_PAGES = "cache_pages"
 CACHE_SCALE_BATCH = "cache_scale_batch"
 CACHE_SCALE_SEQUENCE = "cache_scale_sequence"
 CACHE_SCALE_HEADS = "cache_scale_heads"
@@ -53,6 +54,11 @@ CACHE_SCALE_KV = "cache_scale_kv"
 
 MODEL_MODE_AUTOREGRESSIVE = "autoregressive"
 MODEL_MODE_PREFILL = "prefill"
+# Prefill of tokens which follow a prompt prefix that is already held in the prefill cache.
+MODEL_MODE_PREFILL_CONTINUATION = "prefill_continuation"
+# Decoding of several tokens per sequence in one step, e.g. to verify speculated tokens. The tokens are
+# appended at every sequence's own position in the autoregressive cache.
+MODEL_MODE_AUTOREGRESSIVE_CHUNK = "autoregressive_chunk"
 MODEL_MODE_TRAIN = "train"
 
 DECODING_ACTIVE_SEQUENCE_INDICATOR = 1
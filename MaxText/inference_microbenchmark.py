@@ -229,17 +229,22 @@ def summarize_prefill_result(engine, params, tokens, true_length):
   rng = jax.random.PRNGKey(1234)
   prefill_result, _ = engine.prefill(params=params, padded_tokens=tokens, true_length=true_length, rng=rng)
   jax.block_until_ready(prefill_result)
-  num_prefill_logits_params, total_prefill_logits_size, avg_prefill_logits_param_size = max_utils.summarize_pytree_data(
-      prefill_result["logits"], name="Prefill Logits", raw=True
-  )
+  summary = {}
+  # With decode_sharded_sampling the prefix keeps no logits, only the sampled tokens.
+  if "logits" in prefill_result:
+    num_prefill_logits_params, total_prefill_logits_size, avg_prefill_logits_param_size = max_utils.summarize_pytree_data(
+        prefill_result["logits"], name="Prefill Logits", raw=True
+    )
+    summary |= {
+        "num_logits_params": num_prefill_logits_params,
+        "total_logits_size": total_prefill_logits_size,
+        "avg_logits_param_size": avg_prefill_logits_param_size,
+    }
   num_prefill_cache_params, total_prefill_cache_size, avg_prefill_cache_param_size = max_utils.summarize_pytree_data(
       prefill_result["cache"], name="Prefill Cache"
   )
   del prefill_result
-  return {
-      "num_logits_params": num_prefill_logits_params,
-      "total_logits_size": total_prefill_logits_size,
-      "avg_logits_param_size": avg_prefill_logits_param_size,
+  return summary | {
       "num_cache_params": num_prefill_cache_params,
       "total_cache_size": total_prefill_cache_size,
       "avg_cache_param_size": avg_prefill_cache_param_size,
@@ -0,0 +1,128 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Plans the prefill length buckets of the MLPerf SUT from the prompt length histogram of the dataset.
+
+Every prompt is padded to the smallest bucket length that fits it. The bucket lengths are the multiples of a
+granularity that minimize the padded tokens over the histogram, found exactly by dynamic programming over the
+candidate lengths. Each bucket's batch size is the number of slots of max_target_length = 2 * length that fit
+in the KV cache budget.
+"""
+
+import bisect
+import dataclasses
+from typing import Dict, List
+
+
+@dataclasses.dataclass
+class Bucket:
+  """A prefill length bucket and the prompts padded to it."""
+
+  length: int
+  batch_size: int
+  num_prompts: int = 0
+  prompt_tokens: int = 0
+
+  @property
+  def padded_tokens(self) -> int:
+    return self.num_prompts * self.length
+
+  @property
+  def padding_ratio(self) -> float:
+    """Fraction of the padded prompt tokens which are padding."""
+    if not self.num_prompts:
+      return 0.0
+    return 1.0 - self.prompt_tokens / self.padded_tokens
+
+
+def _round_up(length: int, granularity: int) -> int:
+  return -(-length // granularity) * granularity
+
+
+def padded_length(bucket_lengths: List[int], length: int, granularity: int = 32) -> int:
+  """The smallest of the sorted bucket_lengths that fits length, or length rounded up if none does."""
+  i = bisect.bisect_left(bucket_lengths, length)
+  if i == len(bucket_lengths):
+    return _round_up(length, granularity)
+  return bucket_lengths[i]
+
+
+def plan_bucket_lengths(length_counts: Dict[int, int], num_buckets: int, granularity: int = 32) -> List[int]:
+  """Returns at most num_buckets multiples of granularity minimizing the padded tokens of length_counts.
+
+  Args:
+    length_counts: the number of prompts of every prompt length.
+    num_buckets: the largest number of buckets to use.
+    granularity: every bucket length is a multiple of it.
+  """
+  if num_buckets < 1:
+    raise ValueError(f"num_buckets must be positive, got {num_buckets}")
+  if not length_counts:
+    return []
+  # Candidate lengths, with the number of prompts and their tokens whose smallest candidate is each of them.
+  candidates = sorted({_round_up(length, granularity) for length in length_counts})
+  counts = [0] * len(candidates)
+  tokens = [0] * len(candidates)
+  for length, count in length_counts.items():
+    i = bisect.bisect_left(candidates, length)
+    counts[i] += count
+    tokens[i] += count * length
+  prefix_counts, prefix_tokens = [0], [0]
+  for count, token in zip(counts, tokens):
+    prefix_counts.append(prefix_counts[-1] + count)
+    prefix_tokens.append(prefix_tokens[-1] + token)
+
+  def padding(i, j):
+    """Padding of the prompts of candidates i..j-1 padded to candidates[j - 1]."""
+    return candidates[j - 1] * (prefix_counts[j] - prefix_counts[i]) - (prefix_tokens[j] - prefix_tokens[i])
+
+  # best[k][j]: least padding of the prompts of the first j candidates with k buckets, the last at candidates[j - 1].
+  n = len(candidates)
+  num_buckets = min(num_buckets, n)
+  inf = float("inf")
+  best = [[inf] * (n + 1) for _ in range(num_buckets + 1)]
+  split = [[0] * (n + 1) for _ in range(num_buckets + 1)]
+  best[0][0] = 0
+  for k in range(1, num_buckets + 1):
+    for j in range(k, n + 1):
+      for i in range(k - 1, j):
+        cost = best[k - 1][i] + padding(i, j)
+        if cost < best[k][j]:
+          best[k][j], split[k][j] = cost, i
+  k = min(range(1, num_buckets + 1), key=lambda k: best[k][n])
+  lengths, j = [], n
+  while k > 0:
+    lengths.append(candidates[j - 1])
+    j, k = split[k][j], k - 1
+  return sorted(lengths)
+
+
+def plan_buckets(
+    length_counts: Dict[int, int], num_buckets: int, kv_budget_tokens: int, granularity: int = 32
+) -> List[Bucket]:
+  """Returns the buckets minimizing the padded prompt tokens, with their batch sizes and padding ratios.
+
+  Args:
+    length_counts: the number of prompts of every prompt length.
+    num_buckets: the largest number of buckets to use.
+    kv_budget_tokens: KV cache tokens, batch size * max_target_length, every bucket's engine may use.
+    granularity: every bucket length is a multiple of it.
+  """
+  lengths = plan_bucket_lengths(length_counts, num_buckets, granularity)
+  buckets = [Bucket(length=length, batch_size=max(1, kv_budget_tokens // (2 * length))) for length in lengths]
+  for length, count in length_counts.items():
+    bucket = buckets[bisect.bisect_left(lengths, length)]
+    bucket.num_prompts += count
+    bucket.prompt_tokens += count * length
+  return buckets
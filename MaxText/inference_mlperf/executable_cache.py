@@ -0,0 +1,107 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local cache of serialized compiled executables, so repeated runs load them instead of recompiling."""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+from typing import Any, Dict
+
+import jax
+import jaxlib
+from jax.experimental.serialize_executable import deserialize_and_load, serialize
+
+log = logging.getLogger(__name__)
+
+_METADATA_FILE = "metadata.json"
+
+
+def digest(value: Any) -> str:
+  return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def tree_digest(tree: Any) -> str:
+  """Hash of the paths, shapes, dtypes and shardings of the leaves of tree."""
+  leaves, _ = jax.tree_util.tree_flatten_with_path(tree)
+  return digest(
+      [f"{jax.tree_util.keystr(path)}:{leaf.shape}:{leaf.dtype}:{getattr(leaf, 'sharding', None)}" for path, leaf in leaves]
+  )
+
+
+def _runtime() -> Dict[str, Any]:
+  """What an executable was compiled for besides the program itself."""
+  device = jax.devices()[0]
+  return {
+      "jax": jax.__version__,
+      "jaxlib": jaxlib.__version__,
+      "platform_version": device.client.platform_version,
+      "device_kind": device.device_kind,
+      "device_count": jax.device_count(),
+      "process_count": jax.process_count(),
+  }
+
+
+class ExecutableCache:
+  """Compiled executables serialized under directory/<hash of key>/, one pickle per executable.
+
+  key must identify everything the executables depend on, the config and the shapes of their inputs. The
+  jax version and the hardware are checked on open: executables compiled for another runtime are deleted
+  and compiled again. An executable that fails to load is recompiled and overwritten as well.
+  """
+
+  def __init__(self, directory: str, key: Dict[str, Any]):
+    self.path = os.path.join(directory, digest(key))
+    os.makedirs(self.path, exist_ok=True)
+    metadata = {"key": json.loads(json.dumps(key, default=str)), "runtime": _runtime()}
+    metadata_path = os.path.join(self.path, _METADATA_FILE)
+    if os.path.exists(metadata_path):
+      with open(metadata_path, "r", encoding="utf-8") as f:
+        if json.load(f) == metadata:
+          return
+      log.info(f"Invalidating the executables in {self.path}, they were compiled for another config or runtime")
+      for name in os.listdir(self.path):
+        os.remove(os.path.join(self.path, name))
+    self._write(_METADATA_FILE, json.dumps(metadata, indent=2, sort_keys=True).encode("utf-8"))
+
+  def _write(self, name: str, data: bytes):
+    tmp_path = os.path.join(self.path, f"{name}.tmp")
+    with open(tmp_path, "wb") as f:
+      f.write(data)
+    os.replace(tmp_path, os.path.join(self.path, name))
+
+  def compile(self, name: str, fn, *args, donate_argnums=(), **kwargs):
+    """Returns fn jitted and compiled for args and kwargs, loaded from the cache when an earlier run compiled it."""
+    file_path = os.path.join(self.path, f"{name}.pickle")
+    if os.path.exists(file_path):
+      try:
+        with open(file_path, "rb") as f:
+          serialized = pickle.load(f)
+        _, in_tree = jax.tree_util.tree_flatten((args, kwargs))
+        _, out_tree = jax.tree_util.tree_flatten(jax.eval_shape(fn, *args, **kwargs))
+        compiled = deserialize_and_load(serialized, in_tree, out_tree)
+        log.info(f"Loaded compiled {name} from {file_path}")
+        return compiled
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        log.warning(f"Failed to load compiled {name} from {file_path}, compiling it again: {e}")
+
+    compiled = jax.jit(fn, donate_argnums=donate_argnums).lower(*args, **kwargs).compile()
+    try:
+      serialized, _, _ = serialize(compiled)
+      self._write(f"{name}.pickle", pickle.dumps(serialized))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      log.warning(f"Failed to save compiled {name} to {file_path}: {e}")
+    return compiled
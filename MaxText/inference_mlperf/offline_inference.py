@@ -12,9 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Callable, List
+from typing import Callable, List, Optional
 import dataclasses
-from collections import defaultdict
 import jax
 from jax import numpy as jnp
 import numpy as np
@@ -22,6 +21,7 @@ import queue
 import os
 import functools
 import threading
+import time
 import traceback
 import signal
 
@@ -30,6 +30,8 @@ from jetstream.engine import engine_api
 import logging
 # pylint: disable=no-name-in-module
 from maxengine import set_engine_vars_from_base_engine
+import executable_cache
+import offline_scheduler
 
 log = logging.getLogger(__name__)
 
@@ -39,6 +41,8 @@ class InputData:
   id: str
   tokens: jax.Array
   true_length: int
+  # Most tokens to generate after the first one, None for the max_decode_length of the engine.
+  max_decode_length: Optional[int] = None
 
 
 class JetThread(threading.Thread):
@@ -54,7 +58,15 @@ class JetThread(threading.Thread):
 
 class OfflineInference:
 
-  def __init__(self, engine: engine_api.Engine, params, base_engine: engine_api.Engine):
+  def __init__(
+      self,
+      engine: engine_api.Engine,
+      params,
+      base_engine: engine_api.Engine,
+      prefill_batch_size: int = 1,
+      scheduler: Optional[offline_scheduler.Scheduler] = None,
+      compiled_cache_dir: str = "",
+  ):
     self.live = False
     self.engine = engine
     self.decode_state = None
@@ -70,8 +82,20 @@ class OfflineInference:
     metadata = engine.get_tokenizer()
     self.tokenizer = engine.build_tokenizer(metadata)
     self.dummy = False
+    # Prompts of the same padded length are prefilled and inserted this many at a time when enough slots are free.
+    self.prefill_batch_size = prefill_batch_size
+    # Generate steps run on device per decode call.
+    self.decode_steps = 5
+    # Decides how many prompts to prefill and decode calls to run every iteration of batch_inference.
+    self.scheduler = scheduler or offline_scheduler.FixedScheduler()
+    # Prefill and decode duty cycle and slot utilization of the last batch_inference run.
+    self.scheduler_stats = None
+
+    # warmup loads the compiled prefill and generate executables from here when an earlier run saved them.
+    self.compiled_cache_dir = compiled_cache_dir
 
     self._cached_pref = {}
+    self._cached_pref_batch = {}
     self._cached_generate = None
     self.detokenize_backlog = queue.Queue(10)
 
@@ -79,8 +103,33 @@ class OfflineInference:
     if self.decode_state is None:
       self.decode_state = self.engine.init_decode_state()
 
-  def warmup(self, max_length, warmup_samples):
+  def _executable_cache_key(self):
+    """What the compiled prefill and generate executables depend on, without the run specific paths."""
+    config = {
+        k: str(v)
+        for k, v in self.engine.config.get_keys().items()
+        if k != "run_name" and not k.endswith(("_path", "_dir", "_directory", "_file"))
+    }
+    return {
+        "config": config,
+        "params": executable_cache.tree_digest(self.params),
+        "decode_state": executable_cache.tree_digest(self.decode_state),
+        "prefill_batch_size": self.prefill_batch_size,
+        "decode_steps": self.decode_steps,
+        "eos_id": self.tokenizer.eos_id,
+    }
+
+  def _compile(self, cache, name, fn, *args, donate_argnums=(), **kwargs):
+    if cache is not None:
+      return cache.compile(name, fn, *args, donate_argnums=donate_argnums, **kwargs)
+    return jax.jit(fn, donate_argnums=donate_argnums).lower(*args, **kwargs).compile()
+
+  def warmup(self, max_length, warmup_samples, prefill_lengths=None):
+    """Compiles prefill for the padded prompt lengths up to max_length, powers of two unless prefill_lengths is given."""
     self.init_decode_state()
+    cache = None
+    if self.compiled_cache_dir:
+      cache = executable_cache.ExecutableCache(self.compiled_cache_dir, self._executable_cache_key())
     interesting_buckets = [
         32,
         64,
@@ -91,20 +140,47 @@ class OfflineInference:
         2048,
         4096,
     ]
+    if prefill_lengths is not None:
+      interesting_buckets = sorted(prefill_lengths)
     for length in interesting_buckets:
       if length > max_length:
         break
       log.info(f"Compiling prefill: {length}")
       input_data = jax.ShapeDtypeStruct((length,), jnp.dtype("int32"))
-      self._cached_pref[length] = (
-          jax.jit(self._prefill_insert, donate_argnums=(4,))
-          .lower(self.params, tokens=input_data, slot=0, true_length=length - 1, decode_state=self.decode_state)
-          .compile()
+      self._cached_pref[length] = self._compile(
+          cache,
+          f"prefill_insert_{length}",
+          self._prefill_insert,
+          self.params,
+          donate_argnums=(4,),
+          tokens=input_data,
+          slot=0,
+          true_length=length - 1,
+          decode_state=self.decode_state,
       )
-    self.batch_inference(warmup_samples, desc="warmup")
-    self._cached_generate = (
-        jax.jit(self.engine.generate, donate_argnums=(1,)).lower(self.params, self.decode_state).compile()
+      if self.prefill_batch_size > 1:
+        log.info(f"Compiling batched prefill: {length} x {self.prefill_batch_size}")
+        batch_input_data = jax.ShapeDtypeStruct((self.prefill_batch_size, length), jnp.dtype("int32"))
+        batch_indices = jax.ShapeDtypeStruct((self.prefill_batch_size,), jnp.dtype("int32"))
+        self._cached_pref_batch[length] = self._compile(
+            cache,
+            f"prefill_insert_batch_{length}x{self.prefill_batch_size}",
+            self._prefill_insert_batch,
+            self.params,
+            donate_argnums=(4,),
+            tokens=batch_input_data,
+            slots=batch_indices,
+            true_lengths=batch_indices,
+            decode_state=self.decode_state,
+        )
+    log.info(f"Compiling generate: {self.decode_steps} steps")
+    self._cached_generate = self._compile(
+        cache, f"generate_{self.decode_steps}", self._generate_n(), self.params, self.decode_state, donate_argnums=(1,)
     )
+    self.batch_inference(warmup_samples, desc="warmup")
+
+  def _generate_n(self):
+    return functools.partial(self.engine.generate_n, n=self.decode_steps, eos_id=self.tokenizer.eos_id)
 
   def _prefill_insert(self, params, tokens, slot, true_length, decode_state):
     """return decodestate."""
@@ -112,17 +188,30 @@ class OfflineInference:
     decode_state = self.engine.insert(prefill_result, decode_state, slot=slot)
     return first_token, decode_state
 
+  def _prefill_insert_batch(self, params, tokens, slots, true_lengths, decode_state):
+    """return decodestate."""
+    prefill_result, first_tokens = self.engine.prefill_batch(params=params, padded_tokens=tokens, true_lengths=true_lengths)
+    decode_state = self.engine.insert_batch(prefill_result, decode_state, slots=slots)
+    return first_tokens, decode_state
+
   def batch_inference_with_callback(
       self,
       data: List[InputData],
       emit_first_token: Callable[[str, int], bool],
-      emit_token: Callable[[str, int], bool],
+      emit_token: Optional[Callable[[str, int], bool]],
       desc: str,
+      emit_tokens: Optional[Callable[[List[str], np.ndarray, np.ndarray], Optional[np.ndarray]]] = None,
   ):
     """callback is a function that takes id and token. It will be called once per output
 
     token.
+
+    emit_tokens replaces emit_token with one call per decode call: it takes the ids of the active slots, their
+    tokens [steps, len(ids)] and how many of those are output tokens, counting up to and including the step
+    at which a slot is done. It may return a bool array marking the ids to finish early.
     """
+    if emit_tokens is None:
+      emit_tokens = _emit_tokens_one_by_one(emit_token)
 
     def prefill(slot, tokens, true_length):
       nonlocal self
@@ -134,15 +223,46 @@ class OfflineInference:
       if (cached := self._cached_pref.get(len(tokens))) is not None:
         prefill_fn = cached
 
+      start = time.perf_counter()
       first_token, self.decode_state = prefill_fn(
           self.params, tokens=tokens, slot=slot, true_length=true_length, decode_state=self.decode_state
       )
+      # Wait for the prefill so that its device time is not counted in the next decode call.
+      jax.block_until_ready(first_token)
+      stats.record_prefill(1, time.perf_counter() - start)
       return first_token
 
+    def prefill_batch(slots, rows):
+      nonlocal self
+      if self.dummy:
+        log.info("dummy prefill")
+        return 123
+
+      prefill_fn = self._prefill_insert_batch
+      if (cached := self._cached_pref_batch.get(len(rows[0].tokens))) is not None:
+        prefill_fn = cached
+
+      start = time.perf_counter()
+      first_tokens, self.decode_state = prefill_fn(
+          self.params,
+          tokens=jnp.stack([row.tokens for row in rows]),
+          slots=jnp.array(slots, dtype=jnp.int32),
+          true_lengths=jnp.array([row.true_length for row in rows], dtype=jnp.int32),
+          decode_state=self.decode_state,
+      )
+      jax.block_until_ready(first_tokens)
+      stats.record_prefill(len(rows), time.perf_counter() - start)
+      return first_tokens
+
     empty_slots = list(range(self.batch_size))
     slot_to_id = {}
+    # Tokens every slot may still output before it reaches the max_decode_length of its row.
+    row_max_decode_lengths = {row.id: row.max_decode_length for row in data if row.max_decode_length is not None}
+    slot_remaining = np.zeros(self.batch_size, dtype=np.int64)
     num_prefills = {}
     num_decodes = 0
+    stats = offline_scheduler.SchedulerStats(self.batch_size)
+    self.scheduler_stats = stats
 
     dummy_length = 1
 
@@ -151,27 +271,21 @@ class OfflineInference:
       nonlocal dummy_length
       if self.dummy:
         log.info("Dummy generate")
-        res = engine_api.ResultTokens(
-            data=np.array([[123, 1, dummy_length]] * self.batch_size),
-            tokens_idx=(0, 0),
-            valid_idx=(0, 0),
-            length_idx=(0, 0),
-            samples_per_slot=(0, 0),
-        )
-        dummy_length += 1
-        self.decode_state, result_tokens = self.decode_state, res
+        tokens = np.full((self.decode_steps, self.batch_size), 123)
+        lengths = dummy_length + np.arange(self.decode_steps)
+        done = np.broadcast_to((lengths >= self.max_decode_length)[:, None], tokens.shape)
+        dummy_length += self.decode_steps
       else:
-        gen_fn = self.engine.generate
+        gen_fn = self._generate_n()
         if self._cached_generate is not None:
           gen_fn = self._cached_generate
-        result_tokens_l = []
-        for i in range(5):
-          self.decode_state, result_tokens = gen_fn(self.params, self.decode_state)
-          result_tokens_l.append(result_tokens)
-      for i in range(5):
-        result_tokens = result_tokens_l[i].convert_to_numpy()
-        self.detokenize_backlog.put((result_tokens, False, 0, 0), block=True)
-        # log.info(f"Decode put result {i} to queue")
+        num_active_slots = self.batch_size - len(empty_slots)
+        start = time.perf_counter()
+        self.decode_state, tokens, done = gen_fn(self.params, self.decode_state)
+        # one transfer for all the steps
+        tokens, done = jax.device_get((tokens, done))
+        stats.record_decode(num_active_slots, time.perf_counter() - start)
+      self.detokenize_backlog.put(((tokens, done), False, 0, 0), block=True)
 
     def detokenize():
       nonlocal self
@@ -180,29 +294,43 @@ class OfflineInference:
       while self.live:
         # log.info("Detokenize start")
         newly_empty = []
-        result_tokens, is_first_token, row_id, _slot = self.detokenize_backlog.get(block=True)
+        result_tokens, is_first_token, row_ids, _slots = self.detokenize_backlog.get(block=True)
         # log.info("Detokenize get from queue")
         if is_first_token:
-          first_token = result_tokens.data[0][0].item()
-          should_terminate = emit_first_token(row_id, first_token)
-          if not should_terminate:
-            slot_to_id[_slot] = row_id
-          else:
-            empty_slots.append(_slot)
+          # one transfer for all the rows
+          first_tokens = np.asarray(result_tokens.data)[:, 0].tolist()
+          for row_id, _slot, first_token in zip(row_ids, _slots, first_tokens):
+            should_terminate = emit_first_token(row_id, first_token)
+            if not should_terminate:
+              slot_to_id[_slot] = row_id
+              slot_remaining[_slot] = min(row_max_decode_lengths.get(row_id, self.max_decode_length), self.max_decode_length)
+            else:
+              empty_slots.append(_slot)
+          self.detokenize_backlog.task_done()
           continue
-        for slot, id_ in slot_to_id.items():
-          token, is_valid, length = result_tokens.data[slot]
-          log.debug(f"slot is {slot}, length is {length}")
-          should_finish = False
-          if is_valid:
-            should_finish = emit_token(id_, token.item())
-          if should_finish or length >= self.max_decode_length:
-            newly_empty.append(slot)
-            log.info(f"Detokenize free up {slot}, length {length}")
+        tokens, done = result_tokens
+        if slot_to_id:
+          active_slots = np.fromiter(slot_to_id.keys(), dtype=np.int32, count=len(slot_to_id))
+          active_done = done[:, active_slots]
+          finished = active_done.any(axis=0)
+          # A slot's tokens are output up to and including the first step at which it is done.
+          num_tokens = np.where(finished, active_done.argmax(axis=0) + 1, tokens.shape[0])
+          remaining = slot_remaining[active_slots]
+          finished |= num_tokens >= remaining
+          num_tokens = np.minimum(num_tokens, remaining)
+          slot_remaining[active_slots] -= num_tokens
+          ids = [slot_to_id[slot] for slot in active_slots.tolist()]
+          should_finish = emit_tokens(ids, tokens[:, active_slots], num_tokens)
+          if should_finish is not None:
+            finished |= should_finish
+          newly_empty = active_slots[finished].tolist()
+          if newly_empty:
+            log.info(f"Detokenize free up {newly_empty}")
         # Add slots of those that are empty to empty
         for slot in newly_empty:
           del slot_to_id[slot]
           empty_slots.append(slot)
+        self.detokenize_backlog.task_done()
         if newly_empty and self.detokenize_backlog.qsize() == 0 and len(slot_to_id.items()) == 0:
           break
 
@@ -214,23 +342,63 @@ class OfflineInference:
     )
     self.live = True
     detokenize_thread.start()
-    for row in data:
-      while not empty_slots:
-        # If slots are all full, decode until there are free slots
-        # to insert
+    row_idx = 0
+    while row_idx < len(data):
+      decision = self.scheduler.decide(
+          offline_scheduler.SchedulerState(
+              num_pending=len(data) - row_idx,
+              next_length=len(data[row_idx].tokens),
+              num_empty_slots=len(empty_slots),
+              batch_size=self.batch_size,
+              prefill_batch_size=self.prefill_batch_size,
+              decode_steps=self.decode_steps,
+          )
+      )
+      num_decodes_to_run = decision.num_decodes
+      num_to_prefill = min(decision.num_prefills, len(data) - row_idx)
+      if num_decodes_to_run == 0 and (num_to_prefill == 0 or not empty_slots):
+        # Nothing to prefill into, decode to free up slots
+        num_decodes_to_run = 1
+      for _ in range(num_decodes_to_run):
         num_decodes += 1
         log.info(f"decode-{desc}-{num_decodes}")
         decode()
-      # do one insert
-      num_tokens = len(row.tokens)
-      num_prefills[num_tokens] = 0 if num_tokens not in num_prefills else num_prefills[num_tokens] + 1
-      log.info(
-          f"prefill-{desc}-{num_prefills} num_prefills {sum(num_prefills.values())} num_tokens {num_tokens} true_length {row.true_length} num_empty_slots {len(empty_slots)} num_decodes {num_decodes}"
-      )
-      slot = empty_slots.pop()
-      first_token = prefill(slot, row.tokens, row.true_length)
-      self.detokenize_backlog.put((first_token, True, row.id, slot), block=True)
 
+      while num_to_prefill > 0 and empty_slots:
+        row = data[row_idx]
+        num_tokens = len(row.tokens)
+        batch_rows = data[row_idx : row_idx + self.prefill_batch_size]
+        if (
+            self.prefill_batch_size > 1
+            and num_to_prefill >= self.prefill_batch_size
+            and len(empty_slots) >= self.prefill_batch_size
+            and len(batch_rows) == self.prefill_batch_size
+            and all(len(r.tokens) == num_tokens for r in batch_rows)
+        ):
+          # do a batch of inserts
+          num_prefills[num_tokens] = num_prefills.get(num_tokens, -1) + len(batch_rows)
+          log.info(
+              f"prefill-{desc}-{num_prefills} num_prefills {sum(num_prefills.values())} num_tokens {num_tokens} batch {len(batch_rows)} num_empty_slots {len(empty_slots)} num_decodes {num_decodes}"
+          )
+          slots = [empty_slots.pop() for _ in batch_rows]
+          first_tokens = prefill_batch(slots, batch_rows)
+          self.detokenize_backlog.put((first_tokens, True, [r.id for r in batch_rows], slots), block=True)
+          row_idx += len(batch_rows)
+          num_to_prefill -= len(batch_rows)
+          continue
+        # do one insert
+        num_prefills[num_tokens] = 0 if num_tokens not in num_prefills else num_prefills[num_tokens] + 1
+        log.info(
+            f"prefill-{desc}-{num_prefills} num_prefills {sum(num_prefills.values())} num_tokens {num_tokens} true_length {row.true_length} num_empty_slots {len(empty_slots)} num_decodes {num_decodes}"
+        )
+        slot = empty_slots.pop()
+        first_token = prefill(slot, row.tokens, row.true_length)
+        self.detokenize_backlog.put((first_token, True, [row.id], [slot]), block=True)
+        row_idx += 1
+        num_to_prefill -= 1
+
+    # Wait for the slots of the last prefills to be filled, or the drain below may stop before decoding them.
+    self.detokenize_backlog.join()
     while slot_to_id:
       log.info(f"decode-{desc}-{num_decodes} num_filled_slots {len(slot_to_id)}")
       num_decodes += 1
@@ -239,18 +407,45 @@ class OfflineInference:
     self.live = False
     detokenize_thread.join()
     log.info(f"summary-{desc}-prefills-{num_prefills}-decodes-{num_decodes} completed.")
+    log.info(f"scheduler-{desc} {type(self.scheduler).__name__} {stats.summary()}")
 
   def batch_inference(self, data: List[InputData], desc=""):
-    """data is list of obj with id, tokens, and true length"""
-    res = defaultdict(list)
-
-    def callback(id_, token):
-      nonlocal res
+    """data is list of obj with id, tokens, and true length. Returns the output tokens of every id."""
+    # Output tokens of every id, preallocated for the first token and every generated token.
+    res = {}
+    res_lengths = {}
+
+    def emit_first_token(id_, token):
+      res[id_] = np.empty(self.max_decode_length + 1, dtype=np.int64)
+      res[id_][0] = token
+      res_lengths[id_] = 1
       if token == self.tokenizer.eos_id:
         log.info(f"res[{id_}] eos")
-      if not res[id_] or res[id_][-1] != self.tokenizer.eos_id:
-        res[id_].append(token)
       return token == self.tokenizer.eos_id
 
-    self.batch_inference_with_callback(data, emit_first_token=callback, emit_token=callback, desc=desc)
-    return res
+    def emit_tokens(ids, tokens, num_tokens):
+      for id_, id_tokens, n in zip(ids, tokens.T, num_tokens):
+        start = res_lengths[id_]
+        n = min(n, len(res[id_]) - start)
+        res[id_][start : start + n] = id_tokens[:n]
+        res_lengths[id_] = start + n
+
+    self.batch_inference_with_callback(
+        data, emit_first_token=emit_first_token, emit_token=None, desc=desc, emit_tokens=emit_tokens
+    )
+    return {id_: tokens[: res_lengths[id_]] for id_, tokens in res.items()}
+
+
+def _emit_tokens_one_by_one(emit_token: Callable[[str, int], bool]):
+  """Adapts a per token emit_token callback to batch_inference_with_callback's emit_tokens."""
+
+  def emit_tokens(ids, tokens, num_tokens):
+    should_finish = np.zeros(len(ids), dtype=bool)
+    for i, (id_, n) in enumerate(zip(ids, num_tokens)):
+      for token in tokens[:n, i].tolist():
+        if emit_token(id_, token):
+          should_finish[i] = True
+          break
+    return should_finish
+
+  return emit_tokens
@@ -43,7 +43,9 @@ parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
 from maxengine import create_engine_from_config_flags
+import bucket_planner
 import offline_inference
+import offline_scheduler
 
 _MLPERF_ID = "llama2-70b"
 
@@ -125,6 +127,55 @@ flags.DEFINE_string(
     required=False,
 )
 
+flags.DEFINE_integer(
+    "prefill_batch_size",
+    1,
+    "Number of same length prompts to prefill and insert in one call when enough decode slots are free.",
+    required=False,
+)
+
+flags.DEFINE_bool(
+    "shared_decode_state",
+    False,
+    "Serve every prefill length bucket from one engine and one decode state, so queries of all buckets decode "
+    "together in the same slots instead of running bucket after bucket.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "shared_decode_batch_size",
+    0,
+    "Decode slots of the shared engine with shared_decode_state, whose every slot has the cache length of the "
+    "longest bucket. 0 uses as many slots as fit in the KV cache, batch size * max target length, of the largest "
+    "bucket engine.",
+    required=False,
+)
+
+flags.DEFINE_string(
+    "compiled_cache_dir",
+    "",
+    "If set, warmup saves the compiled prefill and generate executables here, keyed by a hash of the engine config "
+    "and model, and later runs load them instead of compiling again.",
+    required=False,
+)
+
+flags.DEFINE_enum(
+    "scheduler",
+    "fixed",
+    ["fixed", "cost_model"],
+    "How to pick the number of prefills and decode calls every iteration. fixed fills every free slot right away, "
+    "cost_model waits for a full prefill batch when its timings say that is cheaper than idle slots.",
+    required=False,
+)
+
+flags.DEFINE_string(
+    "scheduler_timings",
+    "",
+    "inference_microbenchmark_log_file_path results for the cost_model scheduler, one per engine in the order of "
+    "prefill_lengths_and_batch_sizes. Format path_1|path_2|.., or a single path used for every engine.",
+    required=False,
+)
+
 flags.DEFINE_string(
     "maxengine_args",
     "",
@@ -167,15 +218,87 @@ flags.DEFINE_bool(
     required=False,
 )
 
+flags.DEFINE_integer(
+    "plan_buckets",
+    0,
+    "Number of prefill length buckets to plan from the prompt lengths of the dataset, replacing "
+    "prefill_lengths_and_batch_sizes. Prompts are padded to the smallest planned length instead of a power of two. "
+    "0 uses prefill_lengths_and_batch_sizes as given.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "bucket_kv_budget_tokens",
+    0,
+    "KV cache tokens, batch size * max target length, of the engine of every planned bucket, which sets its batch "
+    "size. 0 uses the largest of prefill_lengths_and_batch_sizes.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "bucket_length_granularity",
+    32,
+    "Planned bucket lengths are multiples of it.",
+    required=False,
+)
+
 scenario_map = {
     "offline": lg.TestScenario.Offline,
     "server": lg.TestScenario.Server,
 }
 
 
-def pad_tokens(tokens):
+def _make_schedulers():
+  """Returns the scheduler of every engine in the order of prefill_lengths_and_batch_sizes."""
+  num_engines = len(FLAGS.prefill_lengths_and_batch_sizes.split("|"))
+  if FLAGS.scheduler == "fixed":
+    return [offline_scheduler.FixedScheduler() for _ in range(num_engines)]
+  paths = FLAGS.scheduler_timings.split("|") if FLAGS.scheduler_timings else []
+  if len(paths) == 1:
+    paths = paths * num_engines
+  if len(paths) != num_engines:
+    raise ValueError(f"The cost_model scheduler needs scheduler_timings for each of the {num_engines} engines.")
+  return [
+      offline_scheduler.CostModelScheduler(offline_scheduler.CostModel.from_microbenchmark_results(path)) for path in paths
+  ]
+
+
+def _create_shared_offline_inference(query_batches, schedulers):
+  """Returns one OfflineInference serving every bucket, keyed by the (length, batch) of each bucket.
+
+  The engine's cache is sized for the longest bucket, so prompts of every length are prefilled into the same slots.
+  Unless shared_decode_batch_size is set, it has as many slots of that length as fit in the KV cache of the largest
+  bucket engine, so it takes no more memory than the bucket engines did one at a time. Every query still
+  generates at most its bucket length of tokens, see SUT.issue_queries. Decode calls are scheduled by the scheduler
+  of the longest bucket, whose timings were measured at the cache length of the shared engine.
+  """
+  longest = max(query_batches)
+  length = longest[0]
+  kv_budget_tokens = max(2 * l * b for l, b in query_batches)
+  batch = FLAGS.shared_decode_batch_size or max(1, kv_budget_tokens // (2 * length))
+  log.info(
+      f"Using one shared decode state with batch size: {batch} and length: {length}, instead of the buckets "
+      f"{list(query_batches)}, with the scheduler of bucket {longest}"
+  )
+  engine = create_engine_from_config_flags(
+      batch_size=batch,
+      max_prefill_predict_length=length,
+      max_target_length=2 * length,
+      args_str=FLAGS.maxengine_args,
+  )
+  scheduler = schedulers[list(query_batches).index(longest)]
+  offline_inf = offline_inference.OfflineInference(
+      engine, None, None, FLAGS.prefill_batch_size, scheduler, FLAGS.compiled_cache_dir
+  )
+  return {group_idx: offline_inf for group_idx in query_batches}
+
+
+def pad_tokens(tokens, bucket_lengths=None):
   true_length = len(tokens)
-  target_length = max(int(2 ** math.ceil(math.log2(true_length))), 32)
+  if bucket_lengths:
+    target_length = bucket_planner.padded_length(bucket_lengths, true_length, FLAGS.bucket_length_granularity)
+  else:
+    target_length = max(int(2 ** math.ceil(math.log2(true_length))), 32)
   padded = tokens + [0] * (target_length - true_length)
   return padded, true_length
 
@@ -190,6 +313,13 @@ def _init_query_batches():
   return query_batches
 
 
+def _bucket_lengths():
+  """The planned bucket lengths prompts are padded to, or None to pad them to powers of two."""
+  if not FLAGS.plan_buckets:
+    return None
+  return sorted(length for length, _ in _init_query_batches())
+
+
 @contextlib.contextmanager
 def timed(msg):
   log.info(msg + " start")
@@ -231,10 +361,11 @@ def _pick_batch_size(num_samples, max_batch, dataset_size, sample_size):
 def get_warmup_samples(dataset):
   query_batches = _init_query_batches()
   pandas_rows = list(dataset.iterrows())
+  bucket_lengths = _bucket_lengths()
   input_data = {}
   for sample_id in range(len(pandas_rows)):
     p = pandas_rows[sample_id][1]
-    padded, length = pad_tokens(p.tok_input)
+    padded, length = pad_tokens(p.tok_input, bucket_lengths)
     input_data[sample_id] = offline_inference.InputData("", jnp.array(padded), length)  # to be filled later
   for data in input_data.values():
     # make sure tokens are transferred to device
@@ -311,6 +442,8 @@ class SUT:
       else:
         input_data = copy.copy(self._sample_id_to_input[q.index])
         input_data.id = q.id
+        # As many tokens as the bucket's own engine generates, also when the shared engine could generate more.
+        input_data.max_decode_length = group_idx[0]
         self._query_batches[group_idx].append(input_data)
     num_grouped_queries = [len(self._query_batches[b]) for b in self._query_batches]
     log.info(f"Issue {num_queries} queries - classified queries {num_grouped_queries} num_skipped {num_skipped_queries}")
@@ -321,22 +454,32 @@ class SUT:
     # At this point _processed_data is ready
     log.info("Issue queries end")
 
+  def _process_group(self, offline_inf, group, desc):
+    log.info(f"Flush queries processing {desc} with {len(group)} samples")
+    offline_inf.init_decode_state()
+    result = offline_inf.batch_inference(group, desc=desc)
+    offline_inf.decode_state = None
+    gc.collect()
+    for key, val in result.items():
+      key = int(key)
+      lg.FirstTokenComplete([make_response(key, [val[0]])])
+      resp = make_response(key, val)
+      lg.QuerySamplesComplete([resp])
+
   @timed("flush_queries")
   def flush_queries(self):
     log.info("Flush queries start")
     start = time.perf_counter()
-    for group_idx in self._query_batches:
-      group = self._query_batches[group_idx]
-      log.info(f"Flush queries processing {group_idx} with {len(group)} samples")
-      self.offline_inf_instances[group_idx].init_decode_state()
-      result = self.offline_inf_instances[group_idx].batch_inference(group, desc=f"batch-{group_idx}")
-      self.offline_inf_instances[group_idx].decode_state = None
-      gc.collect()
-      for key, val in result.items():
-        key = int(key)
-        lg.FirstTokenComplete([make_response(key, [val[0]])])
-        resp = make_response(key, val)
-        lg.QuerySamplesComplete([resp])
+    if FLAGS.shared_decode_state:
+      # Every bucket maps to the same instance. Longest prompts go first so they don't make up the drain tail,
+      # and prompts of the same padded length stay together for batched prefill.
+      group = [row for group_idx in self._query_batches for row in self._query_batches[group_idx]]
+      group.sort(key=lambda row: len(row.tokens), reverse=True)
+      offline_inf = next(iter(self.offline_inf_instances.values()))
+      self._process_group(offline_inf, group, desc="batch-shared")
+    else:
+      for group_idx in self._query_batches:
+        self._process_group(self.offline_inf_instances[group_idx], self._query_batches[group_idx], f"batch-{group_idx}")
 
     log.info("Flush queries end")
     end = time.perf_counter()
@@ -347,10 +490,11 @@ class SUT:
     start = time.perf_counter()
     input_data = {}
     self.pandas_rows = list(self._dataset.iterrows())
+    bucket_lengths = _bucket_lengths()
 
     for sample_id in sample_list:
       p = self.pandas_rows[sample_id][1]
-      padded, length = pad_tokens(p.tok_input)
+      padded, length = pad_tokens(p.tok_input, bucket_lengths)
       input_data[sample_id] = offline_inference.InputData("", jnp.array(padded), length)  # to be filled later
 
     for data in input_data.values():
@@ -399,6 +543,26 @@ def _estimated_counts_by_bucket(dataset):
   return estimates
 
 
+def _plan_buckets(dataset):
+  """Replaces prefill_lengths_and_batch_sizes with the buckets planned from the prompt lengths of dataset."""
+  kv_budget_tokens = FLAGS.bucket_kv_budget_tokens or max(2 * l * b for l, b in _init_query_batches())
+  length_counts = collections.Counter(dataset.tok_input_length.tolist())
+  buckets = bucket_planner.plan_buckets(length_counts, FLAGS.plan_buckets, kv_budget_tokens, FLAGS.bucket_length_granularity)
+  for bucket in buckets:
+    log.info(
+        f"Planned bucket length {bucket.length} batch size {bucket.batch_size}: "
+        f"{bucket.num_prompts} prompts, padding ratio {bucket.padding_ratio:.3f}"
+    )
+  prompt_tokens = sum(l * n for l, n in length_counts.items())
+  padded_tokens = sum(bucket.padded_tokens for bucket in buckets)
+  pow2_tokens = sum(max(int(2 ** math.ceil(math.log2(l))), 32) * n for l, n in length_counts.items())
+  log.info(
+      f"Planned padding ratio {1 - prompt_tokens / padded_tokens:.3f}, "
+      f"power of two padding ratio {1 - prompt_tokens / pow2_tokens:.3f}"
+  )
+  FLAGS.prefill_lengths_and_batch_sizes = "|".join(f"{bucket.length},{bucket.batch_size}" for bucket in buckets)
+
+
 def main(argv):
   del argv
   args = FLAGS
@@ -421,6 +585,8 @@ def main(argv):
   dataset = pd.read_pickle(FLAGS.dataset_path)
   if FLAGS.total_sample_count < len(dataset):
     dataset = dataset.sample(n=FLAGS.total_sample_count)
+  if FLAGS.plan_buckets:
+    _plan_buckets(dataset)
   estimated_counts_by_bucket = _estimated_counts_by_bucket(dataset)
   log.info(f"Dataset len {len(dataset)}, estimated counts by bucket {estimated_counts_by_bucket}")
 
@@ -435,30 +601,41 @@ def main(argv):
   query_batches = _init_query_batches()
   params = None
   base_engine = None
-  # Create an engine and corresponding offline_inf_instance per batch of queries
-  for group_idx in query_batches:
-    (length, batch) = group_idx
-    target_length = 2 * length
-    log.info(f"Using batch size: {batch} and length: {length}")
-    engine = create_engine_from_config_flags(
-        batch_size=batch,
-        max_prefill_predict_length=length,
-        max_target_length=target_length,
-        args_str=FLAGS.maxengine_args,
-    )
-    offline_inf = offline_inference.OfflineInference(engine, params, base_engine)
-    if params is None and offline_inf.params is not None:
-      base_engine = engine
-    params = offline_inf.params
-    offline_inf_instances[group_idx] = offline_inf
+  schedulers = _make_schedulers()
+  if FLAGS.shared_decode_state:
+    offline_inf_instances = _create_shared_offline_inference(query_batches, schedulers)
+  else:
+    # Create an engine and corresponding offline_inf_instance per batch of queries
+    for group_idx, scheduler in zip(query_batches, schedulers):
+      (length, batch) = group_idx
+      target_length = 2 * length
+      log.info(f"Using batch size: {batch} and length: {length}")
+      engine = create_engine_from_config_flags(
+          batch_size=batch,
+          max_prefill_predict_length=length,
+          max_target_length=target_length,
+          args_str=FLAGS.maxengine_args,
+      )
+      offline_inf = offline_inference.OfflineInference(
+          engine, params, base_engine, FLAGS.prefill_batch_size, scheduler, FLAGS.compiled_cache_dir
+      )
+      if params is None and offline_inf.params is not None:
+        base_engine = engine
+      params = offline_inf.params
+      offline_inf_instances[group_idx] = offline_inf
 
   if not FLAGS.skip_warmup:
     with timed("warmup"):
-      for group_idx in offline_inf_instances:
+      if FLAGS.shared_decode_state:
+        # The shared instance compiles every bucket up to the longest one, with the warmup samples of all buckets.
+        warmup_groups = {max(query_batches): [row for rows in warmup_samples.values() for row in rows]}
+      else:
+        warmup_groups = warmup_samples
+      for group_idx, samples in warmup_groups.items():
         (length, batch) = group_idx
         log.info(f"warm up for {length}")
         offline_inf_instances[group_idx].init_decode_state()
-        offline_inf_instances[group_idx].warmup(length, warmup_samples[group_idx])
+        offline_inf_instances[group_idx].warmup(length, samples, _bucket_lengths())
         offline_inf_instances[group_idx].decode_state = None  # drop state
         gc.collect()
 
@@ -0,0 +1,178 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Schedulers deciding how many prompts to prefill and how many decode calls to run in OfflineInference."""
+
+import bisect
+import dataclasses
+import json
+from typing import Dict
+
+
+@dataclasses.dataclass
+class SchedulerState:
+  """What the continuous batching loop knows before every scheduling decision."""
+
+  num_pending: int  # prompts not prefilled yet
+  next_length: int  # padded length of the next prompt
+  num_empty_slots: int
+  batch_size: int  # decode slots
+  prefill_batch_size: int  # prompts of the same length prefilled in one call
+  decode_steps: int  # generate steps per decode call
+
+  @property
+  def num_active_slots(self):
+    return self.batch_size - self.num_empty_slots
+
+
+@dataclasses.dataclass
+class ScheduleDecision:
+  """Decode calls to run first, then prompts to prefill into free slots."""
+
+  num_prefills: int
+  num_decodes: int
+
+
+class CostModel:
+  """Prefill and generate timings of one engine, as measured by inference_microbenchmark.
+
+  A batch of prompts costs about as much as one prompt of their total length, so batched prefills are
+  estimated from the single prompt timings of every measured length, interpolated linearly in between and
+  extrapolated linearly in tokens past the longest one.
+  """
+
+  def __init__(self, prefill_ms: Dict[int, float], generate_step_ms: float):
+    if not prefill_ms:
+      raise ValueError("CostModel needs the prefill time of at least one length.")
+    self.lengths = sorted(prefill_ms)
+    self.times = [prefill_ms[length] for length in self.lengths]
+    self.generate_step_ms = generate_step_ms
+
+  @classmethod
+  def from_microbenchmark_results(cls, path: str):
+    """Reads the inference_microbenchmark_log_file_path written with the prefill and generate stages."""
+    with open(path, "r", encoding="utf-8") as f:
+      results = json.load(f)
+    prefill_ms = {
+        int(length): result["time_in_ms"] + results["insert"][length]["time_in_ms"]
+        for length, result in results["prefill"].items()
+    }
+    return cls(prefill_ms, results["autoregressive"]["step_in_ms"])
+
+  def prefill_ms(self, length: int, num_prompts: int = 1) -> float:
+    """Estimated time to prefill and insert num_prompts prompts of the padded length in one call."""
+    tokens = length * num_prompts
+    i = bisect.bisect_left(self.lengths, tokens)
+    if i == 0:
+      return self.times[0]
+    if i == len(self.lengths):
+      return self.times[-1] * tokens / self.lengths[-1]
+    lo, hi = self.lengths[i - 1], self.lengths[i]
+    return self.times[i - 1] + (self.times[i] - self.times[i - 1]) * (tokens - lo) / (hi - lo)
+
+  def generate_ms(self, steps: int) -> float:
+    return self.generate_step_ms * steps
+
+
+class Scheduler:
+  """Decides every iteration of the continuous batching loop how many prompts to prefill and decode calls to run."""
+
+  def decide(self, state: SchedulerState) -> ScheduleDecision:
+    raise NotImplementedError
+
+
+class FixedScheduler(Scheduler):
+  """Fills every free slot as soon as it is free and decodes only when all slots are busy."""
+
+  def decide(self, state: SchedulerState) -> ScheduleDecision:
+    if state.num_empty_slots == 0:
+      return ScheduleDecision(num_prefills=0, num_decodes=1)
+    return ScheduleDecision(num_prefills=min(state.num_empty_slots, state.num_pending), num_decodes=0)
+
+
+class CostModelScheduler(Scheduler):
+  """Waits for enough free slots to prefill a full batch when that is cheaper than leaving them idle.
+
+  Prefilling the free slots one by one now costs them the single prompt prefill time each. Running one more
+  decode call first leaves them idle for that call, which costs their share of its time, but lets them be
+  prefilled later at the cheaper batched time per prompt. The cheaper of the two is picked.
+  """
+
+  def __init__(self, cost_model: CostModel):
+    self.cost_model = cost_model
+
+  def decide(self, state: SchedulerState) -> ScheduleDecision:
+    if state.num_empty_slots == 0:
+      return ScheduleDecision(num_prefills=0, num_decodes=1)
+    num_prefills = min(state.num_empty_slots, state.num_pending)
+    batch = state.prefill_batch_size
+    if state.num_active_slots == 0 or batch <= 1 or num_prefills >= batch or state.num_pending < batch:
+      return ScheduleDecision(num_prefills=num_prefills, num_decodes=0)
+
+    single_ms = self.cost_model.prefill_ms(state.next_length)
+    batched_ms = self.cost_model.prefill_ms(state.next_length, batch) / batch
+    idle_ms = self.cost_model.generate_ms(state.decode_steps) / state.batch_size
+    if single_ms - batched_ms > idle_ms:
+      return ScheduleDecision(num_prefills=0, num_decodes=1)
+    return ScheduleDecision(num_prefills=num_prefills, num_decodes=0)
+
+
+@dataclasses.dataclass
+class SchedulerStats:
+  """Prefill and decode time and slot occupancy of one batch_inference run."""
+
+  batch_size: int
+  num_prefill_calls: int = 0
+  num_prefilled: int = 0
+  num_decode_calls: int = 0
+  prefill_seconds: float = 0.0
+  decode_seconds: float = 0.0
+  active_slot_decodes: int = 0  # sum of the active slots over the decode calls
+
+  def record_prefill(self, num_prompts: int, seconds: float):
+    self.num_prefill_calls += 1
+    self.num_prefilled += num_prompts
+    self.prefill_seconds += seconds
+
+  def record_decode(self, num_active_slots: int, seconds: float):
+    self.num_decode_calls += 1
+    self.active_slot_decodes += num_active_slots
+    self.decode_seconds += seconds
+
+  @property
+  def prefill_duty_cycle(self) -> float:
+    total = self.prefill_seconds + self.decode_seconds
+    return self.prefill_seconds / total if total else 0.0
+
+  @property
+  def decode_duty_cycle(self) -> float:
+    total = self.prefill_seconds + self.decode_seconds
+    return self.decode_seconds / total if total else 0.0
+
+  @property
+  def slot_utilization(self) -> float:
+    """Average fraction of the decode slots holding a prompt over the decode calls."""
+    if not self.num_decode_calls:
+      return 0.0
+    return self.active_slot_decodes / (self.num_decode_calls * self.batch_size)
+
+  def summary(self) -> Dict[str, float]:
+    return {
+        "num_prefill_calls": self.num_prefill_calls,
+        "num_prefilled": self.num_prefilled,
+        "num_decode_calls": self.num_decode_calls,
+        "prefill_duty_cycle": self.prefill_duty_cycle,
+        "decode_duty_cycle": self.decode_duty_cycle,
+        "slot_utilization": self.slot_utilization,
+    }
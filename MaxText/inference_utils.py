@@ -14,10 +14,15 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import functools
+
 import jax
 import jax.numpy as jnp
+from jax.experimental import shard_map
 
 NEG_INF = -1.0e7  # Masking purpose
+# Nucleus sampling searches its cutoff among this many of the largest logits before sorting the whole vocab.
+NUCLEUS_CANDIDATES = 256
 
 
 # pylint: disable=bare-except, consider-using-generator, too-many-positional-arguments
@@ -48,21 +53,60 @@ def sampling(logits, rng, algorithm, topk=0, nucleus_topp=0, temperature=1.0):
     raise ValueError(f"Sampling {algorithm=} not supported!")
 
 
-def sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng):
+def sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng, num_candidates=NUCLEUS_CANDIDATES, approx=False):
   """Restrict sampling to the top logits with cumulative probability >= nucleus_topp.
 
   The nucleus sampling method is proposed in the paper `The Curious Case of
   Neural Text Degeneration (https://arxiv.org/pdf/1904.09751.pdf)`
 
+  Rather than sorting the whole vocab, the cutoff is searched among the num_candidates largest logits of
+  every row, found with lax.top_k or, if approx is set, the faster but inexact lax.approx_max_k. Only when
+  the candidates of some row hold less than nucleus_topp of its probability mass do we fall back to a full
+  sort.
   """
   if nucleus_topp < 0:
     raise ValueError("Can't apply nucleus with parameter {nucleus_topp=} less zero")
+  if num_candidates >= logits.shape[-1]:
+    cutoff_logit = nucleus_cutoff_logit_sorted(logits, nucleus_topp)
+  else:
+    if approx:
+      candidate_logits, _ = jax.lax.approx_max_k(logits, num_candidates)
+    else:
+      candidate_logits, _ = jax.lax.top_k(logits, num_candidates)
+    log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+    candidate_cutoff_logit, candidates_cover_topp = nucleus_cutoff_logit_candidates(
+        candidate_logits, log_normalizer, nucleus_topp
+    )
+    cutoff_logit = jax.lax.cond(
+        candidates_cover_topp,
+        lambda: candidate_cutoff_logit,
+        lambda: nucleus_cutoff_logit_sorted(logits, nucleus_topp),
+    )
+  logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, NEG_INF), logits)
+  return jax.random.categorical(rng, logits / temperature)
+
+
+def nucleus_cutoff_logit_candidates(candidate_logits, log_normalizer, nucleus_topp):
+  """The smallest logit kept by nucleus sampling, searched among descending candidate_logits.
+
+  Returns the cutoff and whether the candidates of every row hold nucleus_topp of its probability mass,
+  without which the cutoff is not exact.
+  """
+  # The candidates' probabilities are normalized over the whole vocab.
+  candidate_cum_probs = jnp.cumsum(jnp.exp(candidate_logits - log_normalizer), axis=-1)
+  cutoff_index = jnp.minimum(
+      jnp.sum(candidate_cum_probs < nucleus_topp, axis=-1, keepdims=True), candidate_logits.shape[-1] - 1
+  )  # find cutoff index
+  candidates_cover_topp = jnp.all(candidate_cum_probs[..., -1] >= nucleus_topp)
+  return jnp.take_along_axis(candidate_logits, cutoff_index, axis=-1), candidates_cover_topp
+
+
+def nucleus_cutoff_logit_sorted(logits, nucleus_topp):
+  """The smallest logit kept by nucleus sampling, found by sorting the whole vocab."""
   logits_sorted = jnp.sort(logits, axis=-1)[..., ::-1]  # sort descending
   sorted_cum_probs = jnp.cumsum(jax.nn.softmax(logits_sorted, axis=-1), axis=-1)  # get cumsum probs
   cutoff_index = jnp.sum(sorted_cum_probs < nucleus_topp, axis=-1, keepdims=True)  # find cutoff index
-  cutoff_logit = jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
-  logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, NEG_INF), logits)
-  return jax.random.categorical(rng, logits / temperature)
+  return jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
 
 
 def sample_topk_logits(logits, topk, temperature, rng):
@@ -73,3 +117,262 @@ def sample_topk_logits(logits, topk, temperature, rng):
   topk_token = jnp.expand_dims(jax.random.categorical(rng, topk_logits / temperature).astype(jnp.int32), axis=-1)
   sampled_tokens = jnp.squeeze(jnp.take_along_axis(topk_idxs, topk_token, axis=-1), axis=-1).astype(jnp.int32)
   return sampled_tokens
+
+
+def sample_per_slot(logits, rng, temperature, top_k, top_p, greedy, num_candidates=NUCLEUS_CANDIDATES):
+  """Samples every row of logits with its own sampling parameters.
+
+  logits: unnormalized logits shaped [batch, YOUR_LEADING_DIMS, Vocab]
+  rng: rng key to use
+  temperature: [batch] temperature for scaling probability
+  top_k: [batch] restricting to top_k logits before sampling, 0 disables it
+  top_p: [batch] restricting to top_p probability mass before sampling, 1.0 disables it
+  greedy: [batch] bool, take the argmax instead of sampling
+
+  As in sample_nucleus_topp_logits, the cutoffs are taken on the raw logits and the temperature only scales
+  the kept ones. They are searched among the num_candidates largest logits, the whole vocab is sorted only
+  when some row's cutoff falls beyond them, and nothing is when every row is greedy.
+  """
+
+  def per_row(x):
+    return jnp.reshape(x, x.shape + (1,) * (logits.ndim - 1))
+
+  greedy_tokens = jnp.argmax(logits, axis=-1)
+
+  def sample():
+    candidate_logits, _ = jax.lax.top_k(logits, min(num_candidates, logits.shape[-1]))
+    log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+    cutoff_logit, within_candidates = per_slot_cutoff_logit_candidates(
+        candidate_logits, log_normalizer, top_k, top_p, greedy
+    )
+    keeps_vocab = per_row((top_k <= 0) & (top_p >= 1.0))
+    cutoff_logit = jax.lax.cond(
+        jnp.all(within_candidates | keeps_vocab),
+        lambda: cutoff_logit,
+        lambda: per_slot_cutoff_logit_sorted(logits, top_k, top_p),
+    )
+    masked_logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, NEG_INF), logits)
+    # greedy rows may leave temperature at 0
+    sampled_tokens = jax.random.categorical(rng, masked_logits / per_row(jnp.where(greedy, 1.0, temperature)))
+    return jnp.where(jnp.reshape(greedy, greedy.shape + (1,) * (logits.ndim - 2)), greedy_tokens, sampled_tokens)
+
+  return jax.lax.cond(jnp.all(greedy), lambda: greedy_tokens, sample)
+
+
+def per_slot_cutoff_logit_candidates(candidate_logits, log_normalizer, top_k, top_p, greedy):
+  """The smallest logit every row keeps under its own top_k [batch] and top_p [batch], searched among
+  descending candidate_logits [batch, ..., num_candidates].
+
+  Returns the cutoff, -inf for rows which keep every logit, and whether every logit a row keeps is among
+  its candidates: true for greedy rows and for rows whose top_k or top_p cutoff falls among them.
+  """
+
+  def per_row(x):
+    return jnp.reshape(x, x.shape + (1,) * (candidate_logits.ndim - 1))
+
+  num_candidates = candidate_logits.shape[-1]
+  topk_within = per_row((top_k > 0) & (top_k <= num_candidates))
+  topk_cutoff_index = per_row(jnp.clip(top_k, 1, num_candidates) - 1)
+  topk_cutoff_logit = jnp.where(topk_within, jnp.take_along_axis(candidate_logits, topk_cutoff_index, axis=-1), -jnp.inf)
+
+  # The candidates' probabilities are normalized over the whole vocab.
+  candidate_cum_probs = jnp.cumsum(jnp.exp(candidate_logits - log_normalizer), axis=-1)
+  topp_cutoff_index = jnp.minimum(jnp.sum(candidate_cum_probs < per_row(top_p), axis=-1, keepdims=True), num_candidates - 1)
+  topp_within = (candidate_cum_probs[..., -1:] >= per_row(top_p)) & per_row(top_p < 1.0)
+  topp_cutoff_logit = jnp.where(topp_within, jnp.take_along_axis(candidate_logits, topp_cutoff_index, axis=-1), -jnp.inf)
+
+  within_candidates = per_row(greedy) | topk_within | topp_within
+  return jnp.maximum(topk_cutoff_logit, topp_cutoff_logit), within_candidates
+
+
+def per_slot_cutoff_logit_sorted(logits, top_k, top_p):
+  """The smallest logit every row keeps under its own top_k [batch] and top_p [batch], found by sorting the
+  whole vocab."""
+
+  def per_row(x):
+    return jnp.reshape(x, x.shape + (1,) * (logits.ndim - 1))
+
+  vocab_size = logits.shape[-1]
+  logits_sorted = jnp.sort(logits, axis=-1)[..., ::-1]  # sort descending
+  topk_cutoff_index = per_row(jnp.clip(top_k, 1, vocab_size) - 1)
+  topk_cutoff_logit = jnp.where(per_row(top_k > 0), jnp.take_along_axis(logits_sorted, topk_cutoff_index, axis=-1), -jnp.inf)
+
+  sorted_cum_probs = jnp.cumsum(jax.nn.softmax(logits_sorted, axis=-1), axis=-1)
+  topp_cutoff_index = jnp.minimum(jnp.sum(sorted_cum_probs < per_row(top_p), axis=-1, keepdims=True), vocab_size - 1)
+  topp_cutoff_logit = jnp.where(
+      per_row(top_p < 1.0), jnp.take_along_axis(logits_sorted, topp_cutoff_index, axis=-1), -jnp.inf
+  )
+  return jnp.maximum(topk_cutoff_logit, topp_cutoff_logit)
+
+
+def sharded_top_k(logits, k, mesh, logits_spec):
+  """Top k of logits [..., Vocab] which stay sharded over the vocab as laid out by logits_spec.
+
+  Every shard takes the top k of its slice of the vocab and only those k candidates per shard are gathered
+  for the final top k, instead of the whole vocab.
+
+  Returns:
+    values and vocab indices of the top k logits, shaped [..., k] and sharded like logits_spec without its
+    vocab axis.
+  """
+  vocab_axes = tuple(logits_spec[-1]) if isinstance(logits_spec[-1], (list, tuple)) else logits_spec[-1]
+  if vocab_axes is None:
+    return jax.lax.top_k(logits, k)
+  row_spec = jax.sharding.PartitionSpec(*logits_spec[:-1], None)
+
+  @functools.partial(
+      shard_map.shard_map,
+      mesh=mesh,
+      in_specs=(logits_spec,),
+      out_specs=(row_spec, row_spec),
+      check_rep=False,
+  )
+  def merge_top_k(shard_logits):
+    shard_values, shard_indices = jax.lax.top_k(shard_logits, min(k, shard_logits.shape[-1]))
+    shard_indices = shard_indices + jax.lax.axis_index(vocab_axes) * shard_logits.shape[-1]
+    values = jax.lax.all_gather(shard_values, vocab_axes, axis=shard_values.ndim - 1, tiled=True)
+    indices = jax.lax.all_gather(shard_indices, vocab_axes, axis=shard_indices.ndim - 1, tiled=True)
+    values, merged = jax.lax.top_k(values, k)
+    return values, jnp.take_along_axis(indices, merged, axis=-1)
+
+  return merge_top_k(logits)
+
+
+def sampling_sharded(logits, rng, algorithm, mesh, logits_spec, topk=0, nucleus_topp=0, temperature=1.0):
+  """Same as sampling, for logits which stay sharded over the vocab as laid out by logits_spec.
+
+  Every algorithm reduces the vocab with sharded_top_k, so the logits are never gathered to one device.
+  Weighted sampling, and nucleus sampling whose candidates miss nucleus_topp of the mass, use the Gumbel-max
+  trick: the argmax of logits / temperature plus Gumbel noise is a sample of their softmax.
+  """
+  top_k = functools.partial(sharded_top_k, mesh=mesh, logits_spec=logits_spec)
+
+  def sample_candidates(candidate_logits, candidate_indices, sample_rng):
+    choice = jax.random.categorical(sample_rng, candidate_logits / temperature)
+    return jnp.take_along_axis(candidate_indices, choice[..., None], axis=-1)[..., 0]
+
+  def sample_vocab(vocab_logits, sample_rng):
+    gumbel = jax.random.gumbel(sample_rng, vocab_logits.shape, jnp.float32)
+    return top_k(vocab_logits / temperature + gumbel, 1)[1][..., 0]
+
+  if algorithm == "greedy":
+    return top_k(logits, 1)[1][..., 0]
+  elif algorithm == "weighted":
+    return sample_vocab(logits, rng)
+  elif algorithm == "topk":
+    if topk <= 0:
+      raise ValueError("Can't apply algorithm topk with parameter {topk=} less than or equal to zero")
+    return sample_candidates(*top_k(logits, topk), rng).astype(jnp.int32)
+  elif algorithm == "nucleus":
+    if nucleus_topp < 0:
+      raise ValueError("Can't apply nucleus with parameter {nucleus_topp=} less zero")
+    candidate_logits, candidate_indices = top_k(logits, min(NUCLEUS_CANDIDATES, logits.shape[-1]))
+    log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+    cutoff_logit, candidates_cover_topp = nucleus_cutoff_logit_candidates(candidate_logits, log_normalizer, nucleus_topp)
+
+    def from_candidates():
+      masked = jnp.where(candidate_logits < cutoff_logit, jnp.full_like(candidate_logits, NEG_INF), candidate_logits)
+      return sample_candidates(masked, candidate_indices, rng)
+
+    def from_vocab():
+      vocab_cutoff_logit = nucleus_cutoff_logit_sorted(logits, nucleus_topp)
+      return sample_vocab(jnp.where(logits < vocab_cutoff_logit, jnp.full_like(logits, NEG_INF), logits), rng)
+
+    return jax.lax.cond(candidates_cover_topp, from_candidates, from_vocab)
+  else:
+    raise ValueError(f"Sampling {algorithm=} not supported!")
+
+
+def sample_per_slot_sharded(logits, rng, mesh, logits_spec, temperature, top_k, top_p, greedy):
+  """Same as sample_per_slot, for logits which stay sharded over the vocab as laid out by logits_spec.
+
+  The cutoffs are searched among the NUCLEUS_CANDIDATES largest logits gathered by sharded_top_k. Only
+  when some sampled row needs a cutoff beyond them do we fall back to sample_per_slot over the whole vocab.
+  """
+
+  def per_row(x):
+    return jnp.reshape(x, x.shape + (1,) * (logits.ndim - 1))
+
+  num_candidates = min(NUCLEUS_CANDIDATES, logits.shape[-1])
+  temperature = jnp.where(greedy, 1.0, temperature)
+  candidate_logits, candidate_indices = sharded_top_k(logits, num_candidates, mesh, logits_spec)
+  log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+  cutoff_logit, within_candidates = per_slot_cutoff_logit_candidates(candidate_logits, log_normalizer, top_k, top_p, greedy)
+
+  def from_candidates():
+    masked = jnp.where(candidate_logits < cutoff_logit, jnp.full_like(candidate_logits, NEG_INF), candidate_logits)
+    choice = jax.random.categorical(rng, masked / per_row(temperature))
+    sampled_tokens = jnp.take_along_axis(candidate_indices, choice[..., None], axis=-1)[..., 0]
+    greedy_tokens = candidate_indices[..., 0]
+    return jnp.where(jnp.reshape(greedy, greedy.shape + (1,) * (logits.ndim - 2)), greedy_tokens, sampled_tokens)
+
+  def from_vocab():
+    return sample_per_slot(logits, rng, temperature, top_k, top_p, greedy)
+
+  return jax.lax.cond(jnp.all(within_candidates), from_candidates, from_vocab)
+
+
+def top_logprobs(logits, k, top_k_fn=jax.lax.top_k):
+  """Log probabilities of the k most likely tokens of every row of logits [..., Vocab].
+
+  Returns:
+    logprobs [..., k] in descending order and their vocab indices [..., k].
+  """
+  values, indices = top_k_fn(logits, k)
+  return values - jax.nn.logsumexp(logits, axis=-1, keepdims=True), indices
+
+
+def speculative_accept(draft_tokens, draft_logits, target_logits, rng, greedy, temperature, remaining):
+  """Accepts the draft model's proposals against the target model's logits.
+
+  Proposals are accepted while they match the target argmax (greedy) or pass the speculative sampling
+  test, so the output follows the target distribution. The token after the accepted proposals comes from
+  the target, resampled from the residual max(0, p - q) after a rejection. A slot emits at most remaining
+  tokens: past that its accepted proposals are cut, and with none remaining it emits nothing.
+
+  Args:
+    draft_tokens: [batch, k] proposals.
+    draft_logits: [batch, k, vocab] draft logits the proposals were sampled from.
+    target_logits: [batch, k + 1, vocab] target logits after the last token and after every proposal.
+    rng: rng key to use
+    greedy: accept the proposals matching the target argmax rather than sampling
+    temperature: temperature of the draft and target sampling
+    remaining: [batch] number of tokens every slot may still emit before its ar cache is full.
+
+  Returns:
+    new_tokens [batch, k + 1], valid [batch, k + 1] marking the emitted ones, num_new_tokens [batch] and
+    num_kept [batch], the number of emitted proposals, which indexes the target logits of the last emitted token.
+  """
+  num_draft_tokens = draft_tokens.shape[1]
+  accept_rng, sample_rng = jax.random.split(rng)
+  if greedy:
+    target_tokens = jnp.argmax(target_logits, axis=-1).astype(jnp.int32)
+    accepted = draft_tokens == target_tokens[:, :num_draft_tokens]
+    num_accepted = jnp.sum(jnp.cumprod(accepted, axis=1), axis=1)
+    next_token = jnp.take_along_axis(target_tokens, num_accepted[:, None], axis=1)
+  else:
+    target_probs = jax.nn.softmax(target_logits / temperature, axis=-1)
+    draft_probs = jax.nn.softmax(draft_logits / temperature, axis=-1)
+    target_draft_probs = jnp.take_along_axis(target_probs[:, :num_draft_tokens], draft_tokens[..., None], axis=-1)
+    draft_draft_probs = jnp.take_along_axis(draft_probs, draft_tokens[..., None], axis=-1)
+    uniform = jax.random.uniform(accept_rng, draft_tokens.shape)
+    accepted = uniform * draft_draft_probs[..., 0] < target_draft_probs[..., 0]
+    num_accepted = jnp.sum(jnp.cumprod(accepted, axis=1), axis=1)
+    # On rejection resample from the residual max(0, p - q); after accepting every proposal sample from p.
+    draft_probs = jnp.pad(draft_probs, ((0, 0), (0, 1), (0, 0)))
+    target_probs_n = jnp.take_along_axis(target_probs, num_accepted[:, None, None], axis=1)[:, 0]
+    draft_probs_n = jnp.take_along_axis(draft_probs, num_accepted[:, None, None], axis=1)[:, 0]
+    residual = jnp.maximum(target_probs_n - draft_probs_n, 0)
+    residual = jnp.where(jnp.sum(residual, axis=-1, keepdims=True) > 0, residual, target_probs_n)
+    next_token = jax.random.categorical(sample_rng, jnp.log(residual))[:, None].astype(jnp.int32)
+
+  speculation_idx = jnp.arange(num_draft_tokens + 1)[None, :]
+  new_tokens = jnp.where(
+      speculation_idx == num_accepted[:, None],
+      next_token,
+      jnp.pad(draft_tokens, ((0, 0), (0, 1))),
+  )
+  num_kept = jnp.minimum(num_accepted, jnp.maximum(remaining - 1, 0))
+  valid = (speculation_idx <= num_kept[:, None]) & (remaining[:, None] > 0)
+  num_new_tokens = jnp.where(remaining > 0, num_kept + 1, 0)
+  return new_tokens, valid.astype(jnp.int8), num_new_tokens, num_kept
@@ -33,6 +33,14 @@ DEFAULT_MASK_VALUE = common_types.DEFAULT_MASK_VALUE
 shard_map = shard_map.shard_map
 
 
+def dequantize(x: jax.Array, scale: jax.Array | None) -> jax.Array:
+  """Returns x in float32, multiplied by its scale if x is a quantized int8/int4 kv block."""
+  x = x.astype(jnp.float32)
+  if scale is not None:
+    x = x * scale.astype(jnp.float32)
+  return x
+
+
 @functools.partial(jax.jit, static_argnames=["mask_value"])
 def reference_mqa(
     q: jax.Array,
@@ -40,6 +48,8 @@ def reference_mqa(
     v: jax.Array,
     lengths: jax.Array,
     *,
+    k_scale: jax.Array | None = None,
+    v_scale: jax.Array | None = None,
     mask_value: float = DEFAULT_MASK_VALUE,
 ) -> tuple[jax.Array, jax.Array, jax.Array]:
   """Multi query attention reference.
@@ -49,6 +59,8 @@ def reference_mqa(
     k: A [batch_size, seq_len, head_dim] jax.Array.
     v: A [batch_size, seq_len, head_dim] jax.Array.
     lengths: A i32[batch_size] jax.Array.
+    k_scale: An optional [batch_size, seq_len, 1] jax.Array of scales of a quantized k.
+    v_scale: An optional [batch_size, seq_len, 1] jax.Array of scales of a quantized v.
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
 
@@ -57,7 +69,9 @@ def reference_mqa(
     max logit ([batch_size, num_heads]) and softmax denominator ([batch_size,
     num_heads]).
   """
-  logits = jnp.einsum("bhd,btd->bht", q.astype(jnp.float32), k.astype(jnp.float32))
+  k = dequantize(k, k_scale)
+  v = v if v_scale is None else dequantize(v, v_scale)
+  logits = jnp.einsum("bhd,btd->bht", q.astype(jnp.float32), k)
   mask = jnp.arange(k.shape[1])[None] < lengths[:, None]
 
   logits = logits + jnp.where(mask, 0.0, mask_value)[:, None]
@@ -69,13 +83,15 @@ def reference_mqa(
   return o, logits_max[..., None], denominator[..., None]
 
 
-@jax.jit
+@functools.partial(jax.jit, static_argnames=["mask_value"])
 def reference_mha(
     q: jax.Array,
     k: jax.Array,
     v: jax.Array,
     lengths: jax.Array,
     *,
+    k_scale: jax.Array | None = None,
+    v_scale: jax.Array | None = None,
     mask_value: float = DEFAULT_MASK_VALUE,
 ) -> tuple[jax.Array, jax.Array, jax.Array]:
   """Multi head attention reference.
@@ -85,6 +101,8 @@ def reference_mha(
     k: A [batch_size, seq_len, num_heads, head_dim] jax.Array.
     v: A [batch_size, seq_len, num_heads, head_dim] jax.Array.
     lengths: A i32[batch_size] jax.Array.
+    k_scale: An optional [batch_size, seq_len, num_heads or 1, 1] jax.Array of scales of a quantized k.
+    v_scale: An optional [batch_size, seq_len, num_heads or 1, 1] jax.Array of scales of a quantized v.
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
 
@@ -93,6 +111,8 @@ def reference_mha(
     max logit ([batch_size, num_heads]) and softmax denominator ([batch_size,
     num_heads]).
   """
+  k = dequantize(k, k_scale)
+  v = v if v_scale is None else dequantize(v, v_scale)
   q = jnp.swapaxes(q, 1, 2)
   k = jnp.swapaxes(k, 1, 2)
   v = jnp.swapaxes(v, 1, 2)
@@ -108,6 +128,8 @@ def reference_gqa(
     v: jax.Array,
     lengths: jax.Array,
     mask_value: float = DEFAULT_MASK_VALUE,
+    k_scale: jax.Array | None = None,
+    v_scale: jax.Array | None = None,
 ) -> tuple[jax.Array, jax.Array, jax.Array]:
   """Vanilla attention GQA implementation for reference.
 
@@ -116,6 +138,8 @@ def reference_gqa(
     k: A [batch_size, num_kv_heads, max_seq_len, head_dim] jax.Array.
     v: A [batch_size, num_kv_heads, max_seq_len, head_dim] jax.Array.
     lengths: A i32[batch_size] jax.Array.
+    k_scale: An optional [batch_size, num_kv_heads or 1, max_seq_len, 1] jax.Array of scales of a quantized k.
+    v_scale: An optional [batch_size, num_kv_heads or 1, max_seq_len, 1] jax.Array of scales of a quantized v.
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
 
@@ -130,8 +154,10 @@ def reference_gqa(
   assert num_heads_q % num_heads_kv == 0
 
   q = q.reshape(batch_size, num_heads_kv, num_heads_q // num_heads_kv, head_dim)
+  k = dequantize(k, k_scale)
+  v = v if v_scale is None else dequantize(v, v_scale)
 
-  logits = jnp.einsum("bhgd,bhtd->bhgt", q.astype(jnp.float32), k.astype(jnp.float32))
+  logits = jnp.einsum("bhgd,bhtd->bhgt", q.astype(jnp.float32), k)
   mask = jnp.arange(seq_len)[None] < lengths[:, None]
   logits = logits + jnp.where(mask, 0.0, mask_value)[:, None, None, :]
   logits_max = logits.max(axis=-1)
@@ -149,14 +175,21 @@ def ragged_flash_attention_kernel(
     q_ref,
     k_ref,
     v_ref,
-    o_ref,
-    m_ref,
-    l_ref,
-    *,
+    *refs,
     block_size: int,
     mask_value: float,
+    quantized: bool = False,
 ):
-  """Pallas kernel for flash attention."""
+  """Pallas kernel for flash attention.
+
+  With quantized kv, refs starts with the k and v scale blocks, which the int8/int4
+  k and v blocks are dequantized with once they are loaded.
+  """
+  if quantized:
+    k_scale_ref, v_scale_ref, o_ref, m_ref, l_ref = refs
+  else:
+    k_scale_ref = v_scale_ref = None
+    o_ref, m_ref, l_ref = refs
   b, i = pl.program_id(0), pl.program_id(1)
 
   @pl.when(i == 0)
@@ -170,8 +203,8 @@ def ragged_flash_attention_kernel(
   @pl.when(i * block_size < length)
   def run():
     q = q_ref[...].astype(jnp.float32)
-    k = k_ref[...].astype(jnp.float32)
-    v = v_ref[...].astype(jnp.float32)
+    k = dequantize(k_ref[...], None if k_scale_ref is None else k_scale_ref[...])
+    v = dequantize(v_ref[...], None if v_scale_ref is None else v_scale_ref[...])
     m_prev, l_prev = m_ref[...], l_ref[...]
 
     qk = lax.dot_general(q, k, (((1,), (1,)), ((), ())), preferred_element_type=jnp.float32)
@@ -201,9 +234,12 @@ def ragged_mqa(
     v: jax.Array,
     lengths: jax.Array,
     *,
+    k_scale: jax.Array | None = None,
+    v_scale: jax.Array | None = None,
     block_size: int = 256,
     mask_value: float = DEFAULT_MASK_VALUE,
     cost_estimate: pl.CostEstimate | None = None,
+    interpret: bool = False,
 ) -> tuple[jax.Array, jax.Array, jax.Array]:
   """Ragged multi query attention.
 
@@ -212,9 +248,12 @@ def ragged_mqa(
     k: A [batch_size, seq_len, head_dim] jax.Array.
     v: A [batch_size, seq_len, head_dim] jax.Array.
     lengths: A i32[batch_size] jax.Array.
+    k_scale: An optional [batch_size, seq_len, 1] jax.Array of scales of an int8/int4 k.
+    v_scale: An optional [batch_size, seq_len, 1] jax.Array of scales of an int8/int4 v.
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
     cost_estimate: A Pallas TPU cost estimate based on a reference implementation
+    interpret: Runs the kernel in the Pallas interpreter, e.g. to test it on CPU.
 
   Returns:
     The output of attention([batch_size, num_heads, head_dim]), along with the
@@ -224,7 +263,9 @@ def ragged_mqa(
   batch_size, num_heads, head_dim = q.shape
   assert lengths.shape == (batch_size,)
   assert lengths.dtype == jnp.int32
+  assert (k_scale is None) == (v_scale is None), "k and v are quantized together."
   seq_len = k.shape[1]
+  quantized = k_scale is not None
 
   def compute_ragged_block_indices(b, i, lengths_ref):
     length = lengths_ref[b]
@@ -235,19 +276,26 @@ def ragged_mqa(
     i_next = jnp.where(not_done, i, jnp.where(am_last_batch, last_good_block, 0))
     return b_next, i_next, 0
 
+  in_specs = [
+      pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
+      pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
+      pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
+  ]
+  inputs = [q, k, v]
+  if quantized:
+    in_specs += [pl.BlockSpec((None, block_size, 1), compute_ragged_block_indices)] * 2
+    inputs += [k_scale, v_scale]
+
   out, m, l = pl.pallas_call(
       functools.partial(
           ragged_flash_attention_kernel,
           block_size=block_size,
           mask_value=mask_value,
+          quantized=quantized,
       ),
       grid_spec=pltpu.PrefetchScalarGridSpec(
           num_scalar_prefetch=1,
-          in_specs=[
-              pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
-              pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
-              pl.BlockSpec((None, block_size, head_dim), compute_ragged_block_indices),
-          ],
+          in_specs=in_specs,
           out_specs=[
               pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
               pl.BlockSpec((None, num_heads, head_dim), lambda b, i, _: (b, 0, 0)),
@@ -266,15 +314,33 @@ def ragged_mqa(
           jax.ShapeDtypeStruct((batch_size, num_heads, head_dim), jnp.float32),
       ],
       cost_estimate=cost_estimate,
-  )(lengths, q, k, v)
+      interpret=interpret,
+  )(lengths, *inputs)
   return out, m[..., 0], l[..., 0]
 
 
+def _reference_cost_estimate(reference_fn, *args, **kwargs) -> pl.CostEstimate:
+  """Returns a Pallas TPU cost estimate from the compiled cost analysis of a reference implementation."""
+  cost_analysis = reference_fn.lower(*args, **kwargs).compile().cost_analysis()[0]
+  return pl.CostEstimate(
+      flops=int(cost_analysis["flops"]),
+      transcendentals=int(cost_analysis["transcendentals"]),
+      bytes_accessed=int(cost_analysis["bytes accessed"]),
+  )
+
+
+def _per_kv_head_scale(scale: jax.Array | None, kv: jax.Array) -> jax.Array | None:
+  """Broadcasts a [b, s, n_kv or 1, 1] scale, which is shared across heads for heads_and_dkv kv quantization,
+  to [b, s, n_kv, 1] so it can be mapped over the kv heads with its kv."""
+  return None if scale is None else jnp.broadcast_to(scale, kv.shape[:-1] + (1,))
+
+
 @functools.partial(
     jax.jit,
     static_argnames=[
         "block_size",
         "mask_value",
+        "interpret",
     ],
 )
 def ragged_mha(
@@ -283,55 +349,54 @@ def ragged_mha(
     value: jax.Array,
     lengths: jax.Array,
     *,
+    key_scale: jax.Array | None = None,
+    value_scale: jax.Array | None = None,
     block_size: int = 256,
     mask_value: float = DEFAULT_MASK_VALUE,
+    interpret: bool = False,
 ) -> tuple[jax.Array, jax.Array, jax.Array]:
   """Ragged multi head attention.
 
   Args:
     q: A [batch_size, 1, num_heads, head_dim] jax.Array.
-    k: A [batch_size, seq_len, num_heads, head_dim] jax.Array.
-    v: A [batch_size, seq_len, num_heads, head_dim] jax.Array.
+    k: A [batch_size, seq_len, num_heads, head_dim] jax.Array, int8/int4 when key_scale is given.
+    v: A [batch_size, seq_len, num_heads, head_dim] jax.Array, int8/int4 when value_scale is given.
     lengths: A i32[batch_size] jax.Array.
+    key_scale: An optional [batch_size, seq_len, num_heads or 1, 1] jax.Array of scales of a quantized k.
+    value_scale: An optional [batch_size, seq_len, num_heads or 1, 1] jax.Array of scales of a quantized v.
     block_size: Value defining the Pallas block length in the seq_len dimension
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
+    interpret: Runs the kernel in the Pallas interpreter, e.g. to test it on CPU.
 
   Returns:
     The output of attention([batch_size, num_heads, head_dim]), along with the
     max logit ([batch_size, num_heads, 1]) and softmax denominator ([batch_size,
     num_heads, 1]).
   """
-  cost_analysis = (
-      reference_mha.lower(
-          query,
-          key,
-          value,
-          lengths,
-          mask_value=mask_value,
-      )
-      .compile()
-      .cost_analysis()[0]
+  cost_estimate = None
+  if not interpret:
+    cost_estimate = _reference_cost_estimate(
+        reference_mha, query, key, value, lengths, k_scale=key_scale, v_scale=value_scale, mask_value=mask_value
+    )
+
+  key_scale = _per_kv_head_scale(key_scale, key)
+  value_scale = _per_kv_head_scale(value_scale, value)
+  query, key, value, key_scale, value_scale = jax.tree.map(
+      lambda x: jnp.swapaxes(x, 1, 2), (query, key, value, key_scale, value_scale)
   )
-  cost_estimate = pl.CostEstimate(
-      flops=int(cost_analysis["flops"]),
-      transcendentals=int(cost_analysis["transcendentals"]),
-      bytes_accessed=int(cost_analysis["bytes accessed"]),
+  mqa = functools.partial(
+      ragged_mqa,
+      block_size=block_size,
+      mask_value=mask_value,
+      cost_estimate=cost_estimate,
+      interpret=interpret,
   )
-
-  query = jnp.swapaxes(query, 1, 2)
-  key = jnp.swapaxes(key, 1, 2)
-  value = jnp.swapaxes(value, 1, 2)
   o, m, l = jax.vmap(
-      functools.partial(
-          ragged_mqa,
-          block_size=block_size,
-          mask_value=mask_value,
-          cost_estimate=cost_estimate,
-      ),
-      in_axes=(1, 1, 1, None),
+      lambda q, k, v, lengths, k_scale, v_scale: mqa(q, k, v, lengths, k_scale=k_scale, v_scale=v_scale),
+      in_axes=(1, 1, 1, None, 1, 1),
       out_axes=2,
-  )(query, key, value, lengths)
+  )(query, key, value, lengths, key_scale, value_scale)
   m = jnp.expand_dims(m, axis=-1)
   l = jnp.expand_dims(l, axis=-1)
   o = o * l
@@ -343,6 +408,7 @@ def ragged_mha(
     static_argnames=[
         "block_size",
         "mask_value",
+        "interpret",
     ],
 )
 def ragged_gqa(
@@ -351,57 +417,64 @@ def ragged_gqa(
     value: jax.Array,
     lengths: jax.Array,
     *,
+    key_scale: jax.Array | None = None,
+    value_scale: jax.Array | None = None,
     block_size: int = 256,
     mask_value: float = DEFAULT_MASK_VALUE,
+    interpret: bool = False,
 ) -> tuple[jax.Array, jax.Array, jax.Array]:
   """Ragged group query attention.
 
   Args:
     q: A [batch_size, num_heads_q, head_dim] jax.Array.
-    k: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array.
-    v: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array.
+    k: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array, int8/int4 when key_scale is given.
+    v: A [batch_size, seq_len, num_heads_kv, head_dim] jax.Array, int8/int4 when value_scale is given.
     lengths: A i32[batch_size] jax.Array.
+    key_scale: An optional [batch_size, seq_len, num_heads_kv or 1, 1] jax.Array of scales of a quantized k.
+    value_scale: An optional [batch_size, seq_len, num_heads_kv or 1, 1] jax.Array of scales of a quantized v.
     block_size: Value defining the Pallas block length in the seq_len dimension
     mask_value: The value used for padding in attention. By default it is a very
       negative floating point number.
+    interpret: Runs the kernel in the Pallas interpreter, e.g. to test it on CPU.
 
   Returns:
     The output of attention([batch_size, num_heads, head_dim]), along with the
     max logit ([batch_size, num_heads, 1]) and softmax denominator ([batch_size,
     num_heads, 1]).
   """
-  cost_analysis = (
-      reference_gqa.lower(
-          jnp.squeeze(query),
-          jnp.swapaxes(key, 1, 2),
-          jnp.swapaxes(value, 1, 2),
-          lengths,
-          mask_value=mask_value,
-      )
-      .compile()
-      .cost_analysis()[0]
-  )
-  cost_estimate = pl.CostEstimate(
-      flops=int(cost_analysis["flops"]),
-      transcendentals=int(cost_analysis["transcendentals"]),
-      bytes_accessed=int(cost_analysis["bytes accessed"]),
-  )
+  key_scale = _per_kv_head_scale(key_scale, key)
+  value_scale = _per_kv_head_scale(value_scale, value)
+  cost_estimate = None
+  if not interpret:
+    cost_estimate = _reference_cost_estimate(
+        reference_gqa,
+        jnp.squeeze(query),
+        jnp.swapaxes(key, 1, 2),
+        jnp.swapaxes(value, 1, 2),
+        lengths,
+        mask_value=mask_value,
+        k_scale=None if key_scale is None else jnp.swapaxes(key_scale, 1, 2),
+        v_scale=None if value_scale is None else jnp.swapaxes(value_scale, 1, 2),
+    )
   batch_size, _, num_heads_q, head_dim = query.shape
   _, _, num_heads_kv, _ = key.shape
 
   query = query.reshape(batch_size, num_heads_kv, num_heads_q // num_heads_kv, head_dim)  # (b, n_kv, n_q // n_kv, d)
-  key = jnp.swapaxes(key, 1, 2)  # (b, n_kv, s, d)
-  value = jnp.swapaxes(value, 1, 2)  # (b, n_kv, s, d)
+  key, value, key_scale, value_scale = jax.tree.map(
+      lambda x: jnp.swapaxes(x, 1, 2), (key, value, key_scale, value_scale)
+  )  # (b, n_kv, s, d) and (b, n_kv, s, 1)
+  mqa = functools.partial(
+      ragged_mqa,
+      block_size=block_size,
+      mask_value=mask_value,
+      cost_estimate=cost_estimate,
+      interpret=interpret,
+  )
   o, m, l = jax.vmap(
-      functools.partial(
-          ragged_mqa,
-          block_size=block_size,
-          mask_value=mask_value,
-          cost_estimate=cost_estimate,
-      ),
-      in_axes=(1, 1, 1, None),
+      lambda q, k, v, lengths, k_scale, v_scale: mqa(q, k, v, lengths, k_scale=k_scale, v_scale=v_scale),
+      in_axes=(1, 1, 1, None, 1, 1),
       out_axes=1,
-  )(query, key, value, lengths)
+  )(query, key, value, lengths, key_scale, value_scale)
 
   m = jnp.reshape(m, (batch_size, 1, num_heads_q, 1))
   l = jnp.reshape(l, (batch_size, 1, num_heads_q, 1))
@@ -0,0 +1,152 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Microbenchmark of writing one decode token per slot into the ar KV cache.
+
+Compares the per slot fori_loop which the ragged attention path used, a vmapped dynamic_update_slice and
+the single scatter of attentions.scatter_token_into_cache.
+
+Example:
+  python3 MaxText/kv_cache_update_microbenchmark.py --batch_sizes=64,256,512 --ar_cache_axis_order=1,2,0,3
+"""
+import argparse
+import datetime
+import json
+
+import jax
+import jax.numpy as jnp
+
+from layers import attentions
+
+_WARMUP_ITERS = 2
+CACHE_AXIS_NAMES = (attentions.CACHE_BATCH, attentions.CACHE_SEQUENCE, attentions.CACHE_HEADS, attentions.CACHE_KV)
+CACHE_SCALE_AXIS_NAMES = (
+    attentions.CACHE_SCALE_BATCH,
+    attentions.CACHE_SCALE_SEQUENCE,
+    attentions.CACHE_SCALE_HEADS,
+    attentions.CACHE_SCALE_KV,
+)
+
+
+def _batch_and_sequence_axes(axis_names):
+  batch_axis = [i for i, name in enumerate(axis_names) if name in (attentions.CACHE_BATCH, attentions.CACHE_SCALE_BATCH)][0]
+  sequence_axis = [
+      i for i, name in enumerate(axis_names) if name in (attentions.CACHE_SEQUENCE, attentions.CACHE_SCALE_SEQUENCE)
+  ][0]
+  return batch_axis, sequence_axis
+
+
+def fori_loop_update(cache, token, write_positions, axis_names):
+  """One dynamic update per slot in a fori_loop, the way the ragged attention path wrote the cache."""
+  batch_axis, sequence_axis = _batch_and_sequence_axes(axis_names)
+  cache_locations = [slice(None)] * cache.ndim
+  token_locations = [slice(None)] * cache.ndim
+  token_locations[sequence_axis] = 0
+
+  def body(i, val):
+    cache_locations[batch_axis] = i
+    cache_locations[sequence_axis] = write_positions[i]
+    token_locations[batch_axis] = i
+    return val.at[tuple(cache_locations)].set(token[tuple(token_locations)])
+
+  return jax.lax.fori_loop(0, cache.shape[batch_axis], body, cache, unroll=8)
+
+
+def dynamic_update_slice_update(cache, token, write_positions, axis_names):
+  """A dynamic_update_slice per slot, vmapped over the batch."""
+  batch_axis, sequence_axis = _batch_and_sequence_axes(axis_names)
+  row_sequence_axis = sequence_axis - 1 if batch_axis < sequence_axis else sequence_axis
+  return jax.vmap(
+      lambda c, x, i: jax.lax.dynamic_update_slice_in_dim(c, x, i, row_sequence_axis),
+      in_axes=(batch_axis, batch_axis, 0),
+      out_axes=batch_axis,
+  )(cache, token, write_positions)
+
+
+def benchmark_loop(update_fn, caches, tokens, write_positions, iters):
+  """Returns the average time in ms of writing tokens into caches with update_fn."""
+  for _ in range(_WARMUP_ITERS):
+    caches = update_fn(caches, tokens, write_positions)
+  jax.block_until_ready(caches)
+  start = datetime.datetime.now()
+  for _ in range(iters):
+    caches = update_fn(caches, tokens, write_positions)
+  jax.block_until_ready(caches)
+  end = datetime.datetime.now()
+  return 1000 * (end - start).total_seconds() / iters
+
+
+def main(args):
+  axis_order = tuple(int(i) for i in args.ar_cache_axis_order.split(","))
+  axis_names = tuple(CACHE_AXIS_NAMES[i] for i in axis_order)
+  scale_axis_names = tuple(CACHE_SCALE_AXIS_NAMES[i] for i in axis_order)
+  methods = {
+      "fori_loop": fori_loop_update,
+      "dynamic_update_slice": dynamic_update_slice_update,
+      "scatter": attentions.scatter_token_into_cache,
+  }
+
+  results = {}
+  for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+    logical_shape = (batch_size, args.cache_length, args.num_kv_heads, args.head_dim)
+    cache_shape = tuple(logical_shape[i] for i in axis_order)
+    token_shape = tuple((batch_size, 1, args.num_kv_heads, args.head_dim)[i] for i in axis_order)
+    scale_logical_shape = (batch_size, args.cache_length, args.num_kv_heads, 1)
+    scale_shape = tuple(scale_logical_shape[i] for i in axis_order)
+    scale_token_shape = tuple((batch_size, 1, args.num_kv_heads, 1)[i] for i in axis_order)
+
+    dtype = jnp.int8 if args.quantized else jnp.bfloat16
+    cache_shapes = {"key": (cache_shape, dtype), "value": (cache_shape, dtype)}
+    tokens = {"key": jnp.ones(token_shape, dtype), "value": jnp.ones(token_shape, dtype)}
+    names = {"key": axis_names, "value": axis_names}
+    if args.quantized:
+      for name in ("key_scale", "value_scale"):
+        cache_shapes[name] = (scale_shape, jnp.bfloat16)
+        tokens[name] = jnp.ones(scale_token_shape, jnp.bfloat16)
+        names[name] = scale_axis_names
+    write_positions = jax.random.randint(jax.random.PRNGKey(0), (batch_size,), 0, args.cache_length)
+
+    results[batch_size] = {}
+    print(f"KV cache update benchmark results for batch size {batch_size}:\n")
+    for method_name, method in methods.items():
+
+      def update(caches, tokens, write_positions, method=method):
+        return {name: method(caches[name], tokens[name], write_positions, names[name]) for name in caches}
+
+      # The caches are donated so every method gets its own.
+      caches = {name: jnp.zeros(shape, dtype) for name, (shape, dtype) in cache_shapes.items()}
+      update_fn = jax.jit(update, donate_argnums=(0,))
+      results[batch_size][method_name] = benchmark_loop(update_fn, caches, tokens, write_positions, args.iters)
+      print(f"\t{method_name} average time: {results[batch_size][method_name]:.3f} ms")
+    print("\n\n")
+
+  if args.log_file_path:
+    with open(args.log_file_path, "w", encoding="utf-8") as f:
+      json.dump(results, f, indent=2)
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--batch_sizes", type=str, default="32,64,128,256,512")
+  parser.add_argument("--cache_length", type=int, default=1024)
+  parser.add_argument("--num_kv_heads", type=int, default=8)
+  parser.add_argument("--head_dim", type=int, default=128)
+  parser.add_argument("--ar_cache_axis_order", type=str, default="1,2,0,3")
+  parser.add_argument("--quantized", action="store_true", help="Benchmark int8 caches with their bfloat16 scales.")
+  parser.add_argument("--iters", type=int, default=100)
+  parser.add_argument("--log_file_path", type=str, default="")
+  main(parser.parse_args())
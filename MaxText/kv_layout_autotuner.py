@@ -0,0 +1,164 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Autotunes the KV cache layout with the inference microbenchmarks and stores the winner in kv_layout_cache_path.
+
+The layouts of the two caches are tuned in two stages: first the ar cache axis order, compute axis order and reshape_q
+on the generate step, then the prefill cache axis order on prefill + insert with the winning ar layout. Every stage runs
+successive halving: all candidates are benchmarked with a few iterations, the slower half and anything slower than
+kv_layout_autotune_prune_ratio times the best are dropped, and the survivors are rerun with twice the iterations, up to
+inference_microbenchmark_loop_iters. MaxEngine picks the stored layout up at startup with use_kv_layout_cache=True.
+
+Example:
+  python3 MaxText/kv_layout_autotuner.py MaxText/configs/base.yml model_name=llama2-7b per_device_batch_size=24 \
+    kv_layout_cache_path=/tmp/kv_layouts.json
+"""
+
+import itertools
+import json
+import math
+import sys
+
+import jax
+
+import inference_microbenchmark
+import kv_layout_cache
+import pyconfig
+
+try:
+  JaxRuntimeError = jax.errors.JaxRuntimeError  # added in JAX 0.4.34
+except AttributeError:
+  from jax._src.lib import xla_extension
+
+  JaxRuntimeError = xla_extension.XlaRuntimeError
+
+_FIRST_ROUND_ITERS = 2
+_HALVING_RATE = 2
+COMPUTE_AXIS_ORDERS = ("0,1,2,3", "0,2,1,3")
+
+
+def axis_order_str(axis_order):
+  return ",".join(str(i) for i in axis_order)
+
+
+def enumerate_ar_layouts(config):
+  """Every ar cache axis order with every compute axis order, and reshape_q where there are query groups."""
+  reshape_q_options = (False, True) if config.num_query_heads > config.num_kv_heads else (False,)
+  return [
+      {"ar_cache_axis_order": axis_order_str(axis_order), "compute_axis_order": compute_axis_order, "reshape_q": reshape_q}
+      for axis_order, compute_axis_order, reshape_q in itertools.product(
+          itertools.permutations(range(4)), COMPUTE_AXIS_ORDERS, reshape_q_options
+      )
+  ]
+
+
+def enumerate_prefill_layouts():
+  return [{"prefill_cache_axis_order": axis_order_str(axis_order)} for axis_order in itertools.permutations(range(4))]
+
+
+def successive_halving(candidates, measure, first_iters, max_iters, prune_ratio):
+  """Returns the fastest candidate, its time and the time of every candidate in every round.
+
+  measure(candidate, iters) returns the time of a candidate, or inf if it failed to run.
+  """
+  iters = min(first_iters, max_iters)
+  history = []
+  while True:
+    times = [measure(candidate, iters) for candidate in candidates]
+    history.append({"iters": iters, "times": [{"layout": c, "time_in_ms": t} for c, t in zip(candidates, times)]})
+    ranked = sorted(zip(times, range(len(candidates))))
+    best_time = ranked[0][0]
+    if math.isinf(best_time):
+      raise ValueError(f"Every candidate layout failed to run with {iters} iterations.")
+    keep = max(1, len(candidates) // _HALVING_RATE)
+    candidates = [candidates[i] for t, i in ranked[:keep] if t <= prune_ratio * best_time]
+    if len(candidates) == 1 or iters >= max_iters:
+      return candidates[0], best_time, history
+    iters = min(max_iters, iters * _HALVING_RATE)
+    print(f"Kept {len(candidates)} layouts, rerunning them with {iters} iterations.")
+
+
+def ar_step_ms(results):
+  return results["autoregressive"]["step_in_ms"]
+
+
+def prefill_insert_ms(results):
+  return sum(results["prefill"][l]["time_in_ms"] + results["insert"][l]["time_in_ms"] for l in results["prefill"])
+
+
+def make_measure(config, fixed_layout, stages, metric):
+  """Returns a measure function which runs the microbenchmark stages with a candidate layout on top of fixed_layout."""
+
+  def measure(candidate, iters):
+    keys = pyconfig._config.keys  # pylint: disable=protected-access
+    keys.update(fixed_layout)
+    keys.update(candidate)
+    keys["inference_microbenchmark_stages"] = stages
+    keys["inference_microbenchmark_loop_iters"] = iters
+    keys["inference_microbenchmark_log_file_path"] = ""
+    keys["use_kv_layout_cache"] = False
+    try:
+      time_in_ms = metric(inference_microbenchmark.main(config))
+    except JaxRuntimeError:
+      # OOM
+      time_in_ms = math.inf
+    print(f"Layout {candidate} with {iters} iterations: {time_in_ms:.3f} ms")
+    return time_in_ms
+
+  return measure
+
+
+def main():
+  pyconfig.initialize(sys.argv)
+  config = pyconfig.config
+  if not config.kv_layout_cache_path:
+    raise ValueError("kv_layout_autotuner.py needs kv_layout_cache_path to store the tuned layout.")
+  max_iters = config.inference_microbenchmark_loop_iters
+  prune_ratio = config.kv_layout_autotune_prune_ratio
+  log_file_path = config.inference_microbenchmark_log_file_path
+  layout = {name: config.get_keys()[name] for name in kv_layout_cache.LAYOUT_KEYS}
+
+  ar_layout, ar_time, ar_history = successive_halving(
+      enumerate_ar_layouts(config),
+      make_measure(config, layout, "generate", ar_step_ms),
+      _FIRST_ROUND_ITERS,
+      max_iters,
+      prune_ratio,
+  )
+  layout.update(ar_layout)
+  print(f"Best ar layout {ar_layout}: {ar_time:.3f} ms per step")
+
+  prefill_layout, prefill_time, prefill_history = successive_halving(
+      enumerate_prefill_layouts(),
+      make_measure(config, layout, "prefill", prefill_insert_ms),
+      _FIRST_ROUND_ITERS,
+      max_iters,
+      prune_ratio,
+  )
+  layout.update(prefill_layout)
+  print(f"Best prefill layout {prefill_layout}: {prefill_time:.3f} ms for prefill and insert of every prefill length")
+
+  metrics = {"ar_step_in_ms": ar_time, "prefill_insert_in_ms": prefill_time}
+  kv_layout_cache.store_layout(config.kv_layout_cache_path, config, layout, metrics)
+  print(f"Stored layout {layout} in {config.kv_layout_cache_path}")
+  if log_file_path:
+    with open(log_file_path, "w", encoding="utf-8") as f:
+      json.dump({"layout": layout, "metrics": metrics, "ar": ar_history, "prefill": prefill_history}, f, indent=2)
+
+
+if __name__ == "__main__":
+  jax.config.update("jax_default_prng_impl", "unsafe_rbg")
+  main()
@@ -0,0 +1,93 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Local database of the fastest KV cache layouts found by kv_layout_autotuner.py.
+
+Entries are keyed by the model shape, the batch and the hardware, so a layout tuned for one deployment is never
+applied to another. The database is a single json file which is rewritten atomically on every store.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+import jax
+
+LAYOUT_KEYS = ("prefill_cache_axis_order", "ar_cache_axis_order", "compute_axis_order", "reshape_q")
+_SHAPE_KEYS = (
+    "model_name",
+    "emb_dim",
+    "num_query_heads",
+    "num_kv_heads",
+    "head_dim",
+    "num_decoder_layers",
+    "dtype",
+    "weight_dtype",
+    "quantization",
+    "quantize_kvcache",
+    "kv_quant_axis",
+    "kv_quant_dtype",
+    "attention",
+    "max_prefill_predict_length",
+    "max_target_length",
+    "per_device_batch_size",
+)
+
+
+def layout_cache_entry_key(config) -> Dict[str, Any]:
+  """Returns what a tuned layout depends on: the model shape, the batch, the mesh and the hardware."""
+  key = {name: str(getattr(config, name)) for name in _SHAPE_KEYS}
+  key["mesh"] = {name: value for name, value in sorted(config.get_keys().items()) if name.startswith(("ici_", "dcn_"))}
+  key["device_kind"] = jax.devices()[0].device_kind
+  key["device_count"] = jax.device_count()
+  return key
+
+
+def _digest(entry_key: Dict[str, Any]) -> str:
+  return hashlib.sha256(json.dumps(entry_key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _read(path: str) -> Dict[str, Any]:
+  if not os.path.exists(path):
+    return {}
+  with open(path, "r", encoding="utf-8") as f:
+    return json.load(f)
+
+
+def load_layout(path: str, config) -> Optional[Dict[str, Any]]:
+  """Returns the stored layout keys for config, or None if this model, batch and hardware was never tuned."""
+  entry = _read(path).get(_digest(layout_cache_entry_key(config)))
+  if entry is None:
+    return None
+  return {name: entry["layout"][name] for name in LAYOUT_KEYS}
+
+
+def store_layout(path: str, config, layout: Dict[str, Any], metrics: Optional[Dict[str, Any]] = None) -> None:
+  """Stores layout as the tuned layout for config, replacing any earlier entry with the same key."""
+  entry_key = layout_cache_entry_key(config)
+  database = _read(path)
+  database[_digest(entry_key)] = {
+      "key": entry_key,
+      "layout": {name: layout[name] for name in LAYOUT_KEYS},
+      "metrics": metrics or {},
+  }
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, exist_ok=True)
+  tmp_path = f"{path}.tmp"
+  with open(tmp_path, "w", encoding="utf-8") as f:
+    json.dump(database, f, indent=2, sort_keys=True)
+  os.replace(tmp_path, path)
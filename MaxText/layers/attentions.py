@@ -71,6 +71,7 @@ CACHE_BATCH = common_types.CACHE_BATCH
 CACHE_SEQUENCE = common_types.CACHE_SEQUENCE
 CACHE_HEADS = common_types.CACHE_HEADS
 CACHE_KV = common_types.CACHE_KV
+CACHE_PAGES = common_types.CACHE_PAGES
 CACHE_SCALE_BATCH = common_types.CACHE_SCALE_BATCH
 CACHE_SCALE_SEQUENCE = common_types.CACHE_SCALE_SEQUENCE
 CACHE_SCALE_HEADS = common_types.CACHE_SCALE_HEADS
@@ -103,6 +104,23 @@ def validate_compute_axis_order(s: AxisIdxes) -> None:
     raise ValueError("Invalid compute_axis_order was passed. Valid options ", valid_compute_axis_order)
 
 
+def scatter_token_into_cache(cache: Array, token: Array, write_positions: Array, axis_names: AxisNames) -> Array:
+  """Writes token, laid out like cache with a sequence axis of length 1, into cache at the per batch row
+  write_positions [batch], with a single scatter for the whole batch."""
+  batch_axis = axis_names.index(CACHE_BATCH) if CACHE_BATCH in axis_names else axis_names.index(CACHE_SCALE_BATCH)
+  sequence_axis = (
+      axis_names.index(CACHE_SEQUENCE) if CACHE_SEQUENCE in axis_names else axis_names.index(CACHE_SCALE_SEQUENCE)
+  )
+  indices = [slice(None)] * cache.ndim
+  indices[batch_axis] = jnp.arange(cache.shape[batch_axis])
+  indices[sequence_axis] = write_positions
+  update = jnp.squeeze(token, axis=sequence_axis)
+  if abs(batch_axis - sequence_axis) > 1:
+    # Index arrays which aren't adjacent put their broadcast dimension first.
+    update = jnp.moveaxis(update, batch_axis if batch_axis < sequence_axis else batch_axis - 1, 0)
+  return cache.at[tuple(indices)].set(update.astype(cache.dtype))
+
+
 def apply_mask_to_logits(logits: Array, mask: Array):
   """Applies a floating-point mask to a set of logits.
 
@@ -169,7 +187,30 @@ class AttentionOp(nn.Module):
   # Following Pallas MHA Flash Attention Reference.
   # https://github.com/google/jax/blob/main/jax/experimental/pallas/ops/tpu/flash_attention.py
   # This mask models (1) separate sequences (decoder_segment_ids) and (2) causality
-  def generate_attention_mask(self, query, key, decoder_segment_ids: Array | None, model_mode: str) -> Array | None:
+  def generate_attention_mask(
+      self,
+      query,
+      key,
+      decoder_segment_ids: Array | None,
+      model_mode: str,
+      query_positions: Array | None = None,
+      key_positions: Array | None = None,
+  ) -> Array | None:
+    """Generates the attention mask, or None when every key is attended to.
+
+    When query_positions [b, t] and key_positions [b, s] are given, as for a chunk attending to the caches it
+    extends, the causal and sliding window masks are computed from the token positions rather than from the
+    query and key indices.
+    """
+    if query_positions is not None:
+      mask = decoder_segment_ids[:, None, :] == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
+      mask = mask & (key_positions[:, None, :] <= query_positions[:, :, None])
+      if self.attention_type == AttentionType.LOCAL_SLIDING:
+        if self.sliding_window_size is None:
+          raise ValueError("Sliding_window_size must be set if Local Sliding attention type")
+        mask = mask & (query_positions[:, :, None] - key_positions[:, None, :] < self.sliding_window_size)
+      return jnp.where(mask[:, None, None, :, :], 0.0, DEFAULT_MASK_VALUE)
+
     mask = None
     if model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE:
       mask = decoder_segment_ids[:, None, None, None, :] == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
@@ -196,7 +237,9 @@ class AttentionOp(nn.Module):
     elif causal_mask is not None:
       output_mask = causal_mask
 
-    if self.attention_type == AttentionType.LOCAL_SLIDING and output_mask is not None:
+    # A windowed ar cache only holds the window, kv_cache_autoregressive masks the prefill cache to it.
+    windowed_autoregression = model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE and self._uses_window_cache()
+    if self.attention_type == AttentionType.LOCAL_SLIDING and output_mask is not None and not windowed_autoregression:
       if self.sliding_window_size is None:
         raise ValueError("Sliding_window_size must be set if Local Sliding attention type")
 
@@ -223,6 +266,13 @@ class AttentionOp(nn.Module):
         lengths = jnp.sum(decoder_segment_ids, axis=-1)
 
       return self.ragged_attention(query, key, value, lengths, self.ragged_block_size)
+    elif (
+        model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE
+        and self.config.decode_sequence_splits > 1
+        and self.attention_kernel in ("dot_product", "autoselected")
+        and self.attention_type != AttentionType.LOCAL_SLIDING  # the sliding mask depends on whole cache positions
+    ):
+      return self.apply_attention_sequence_split(query, key, value, decoder_segment_ids)
     elif (
         self.attention_kernel == "dot_product"
         or (self.attention_kernel == "autoselected" and model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE)
@@ -258,11 +308,23 @@ class AttentionOp(nn.Module):
   def ragged_attention(
       self, query: Array, key: Array | KVTensor, value: Array | KVTensor, lengths: Array, block_size: int
   ) -> tuple[Array, Array, Array]:
-    """Ragged Attention."""
-    if isinstance(query, KVTensor) or isinstance(query, KVTensor):
-      raise TypeError("Ragged attention does not currently support quantized tensors.")
+    """Ragged Attention. Quantized keys and values are passed to the kernel with their scales and dequantized per block."""
+    key_scale = value_scale = None
+    if self.kv_quant and self.kv_quant.group_size:
+      # The kernel takes a single scale per token and head, group-wise scales are applied beforehand.
+      key, value = self.kv_quant.dequant(key), self.kv_quant.dequant(value)
+    if isinstance(key, KVTensor):
+      key, key_scale = key.qvalue, key.scale[0]
+    if isinstance(value, KVTensor):
+      value, value_scale = value.qvalue, value.scale[0]
     b = nn.logical_to_mesh_axes(self.ragged_lengths_names)
     bsnd = nn.logical_to_mesh_axes(self.cache_logical_axis_names)
+    # Scales have a kv axis of size 1, and a heads axis of size 1 with heads_and_dkv, so they are broadcast over the
+    # kv heads to be sharded like their keys and values.
+    bsn1 = jax.sharding.PartitionSpec(*bsnd[:-1], None)
+    if key_scale is not None:
+      key_scale = jnp.broadcast_to(key_scale, key.shape[:-1] + (1,))
+      value_scale = jnp.broadcast_to(value_scale, value.shape[:-1] + (1,))
 
     @functools.partial(
         shard_map,
@@ -272,18 +334,98 @@ class AttentionOp(nn.Module):
             bsnd,
             bsnd,
             b,
+            bsn1,
+            bsn1,
             None,
         ),
         out_specs=bsnd,
         check_rep=False,
     )
-    def wrap_ragged_attention(query, key, value, lengths, block_size):
+    def wrap_ragged_attention(query, key, value, lengths, key_scale, value_scale, block_size):
       if query.shape[-2] == key.shape[-2]:
-        return ragged_mha(query, key, value, lengths, block_size=block_size)
+        return ragged_mha(query, key, value, lengths, key_scale=key_scale, value_scale=value_scale, block_size=block_size)
       else:
-        return ragged_gqa(query, key, value, lengths, block_size=block_size)
+        return ragged_gqa(query, key, value, lengths, key_scale=key_scale, value_scale=value_scale, block_size=block_size)
 
-    return wrap_ragged_attention(query, key, value, lengths, block_size)
+    return wrap_ragged_attention(query, key, value, lengths, key_scale, value_scale, block_size)
+
+  def apply_attention_sequence_split(
+      self, query: Array, key: Array | KVTensor, value: Array | KVTensor, decoder_segment_ids: Array
+  ) -> tuple[Array, Array, Array]:
+    """Autoregressive attention over a kv cache split into decode_sequence_splits chunks along the sequence.
+
+    The chunks are folded into the batch so a single apply_attention_dot computes the local attention of
+    every chunk in parallel, then the local maxes and sums are merged as in normalize_attention. With
+    decode_sequence_split_axis, the chunks are spread over that mesh axis and merged across it.
+
+    Returns:
+      the unnormalized output, max and sum of the attention over the whole cache.
+    """
+    batch, cache_length = decoder_segment_ids.shape
+    num_splits = self.config.decode_sequence_splits
+    chunk_length = -(-cache_length // num_splits)
+    padding = num_splits * chunk_length - cache_length
+
+    def split(x):
+      """[b, s, ...] -> [b, num_splits, s / num_splits, ...], padded sequence positions are masked."""
+      x = jnp.pad(x, [(0, 0), (0, padding)] + [(0, 0)] * (x.ndim - 2))
+      return jnp.reshape(x, (batch, num_splits, chunk_length) + x.shape[2:])
+
+    def local_attention(query, key, value, segment_ids):
+      """Attention of query over every chunk of key and value, merged over the chunks."""
+      splits = segment_ids.shape[1]
+      fold = lambda x: jnp.reshape(x, (x.shape[0] * splits,) + x.shape[2:])
+      local_outs, local_maxes, local_sums = self.apply_attention_dot(
+          jnp.repeat(query, splits, axis=0),
+          jax.tree.map(fold, key),
+          jax.tree.map(fold, value),
+          fold(segment_ids),
+          common_types.MODEL_MODE_AUTOREGRESSIVE,
+      )
+      unfold = lambda x: jnp.reshape(x, (x.shape[0] // splits, splits) + x.shape[1:])
+      return self.merge_local_attentions(unfold(local_outs), unfold(local_maxes), unfold(local_sums), axis=1)
+
+    key, value, segment_ids = jax.tree.map(split, key), jax.tree.map(split, value), split(decoder_segment_ids)
+    axis = self.config.decode_sequence_split_axis
+    if not axis:
+      return local_attention(query, key, value, segment_ids)
+
+    bsnd = nn.logical_to_mesh_axes(self.cache_logical_axis_names)
+    if any(axis in (mesh_axes if isinstance(mesh_axes, tuple) else (mesh_axes,)) for mesh_axes in bsnd):
+      raise ValueError(f"decode_sequence_split_axis {axis} can't also shard the kv cache, which is sharded as {bsnd}.")
+    btnd = jax.sharding.PartitionSpec(bsnd[0], None, bsnd[2], bsnd[3])
+    btn1 = jax.sharding.PartitionSpec(bsnd[0], None, bsnd[2], None)
+    chunked = jax.sharding.PartitionSpec(bsnd[0], axis, None, bsnd[2], bsnd[3])
+    chunked_scale = jax.sharding.PartitionSpec(bsnd[0], axis, None, bsnd[2], None)
+
+    def unpack(x):
+      """Passes a quantized cache as values and scales, with the scales broadcast over the kv heads."""
+      if isinstance(x, KVTensor):
+        scale = x.scale[0]
+        return x.qvalue, jnp.broadcast_to(scale, x.qvalue.shape[:-1] + scale.shape[-1:]), x.dequant_dtype
+      return x, None, None
+
+    (key, key_scale, key_dtype), (value, value_scale, value_dtype) = unpack(key), unpack(value)
+
+    def pack(x, scale, dtype):
+      return x if scale is None else KVTensor(qvalue=x, scale=[scale], scale_t=None, dequant_dtype=dtype, bias=[])
+
+    @functools.partial(
+        shard_map,
+        mesh=self.mesh,
+        in_specs=(btnd, chunked, chunked_scale, chunked, chunked_scale, jax.sharding.PartitionSpec(bsnd[0], axis, None)),
+        out_specs=(btnd, btn1, btn1),
+        check_rep=False,
+    )
+    def wrap_local_attention(query, key, key_scale, value, value_scale, segment_ids):
+      local_out, local_max, local_sum = local_attention(
+          query, pack(key, key_scale, key_dtype), pack(value, value_scale, value_dtype), segment_ids
+      )
+      global_max = jax.lax.pmax(local_max, axis)
+      weights = jnp.exp(local_max - global_max)
+      return jax.lax.psum(weights * local_out, axis), global_max, jax.lax.psum(weights * local_sum, axis)
+
+    return wrap_local_attention(query, key, key_scale, value, value_scale, segment_ids)
 
   def tpu_flash_attention(
       self,
@@ -461,6 +603,8 @@ class AttentionOp(nn.Module):
       value: Array | KVTensor,
       decoder_segment_ids: Array | None,
       model_mode: str = common_types.MODEL_MODE_TRAIN,
+      query_positions: Array | None = None,
+      key_positions: Array | None = None,
   ):
     """Apply Attention."""
     validate_compute_axis_order(self.compute_axis_order)
@@ -481,7 +625,9 @@ class AttentionOp(nn.Module):
     # Casting softmaxt computation for float32 for model stability.
     if model_mode == common_types.MODEL_MODE_TRAIN and self.float32_logits:
       attn_weights = attn_weights.astype(jnp.float32)
-    attn_mask = self.generate_attention_mask(query, key, decoder_segment_ids, model_mode)
+    attn_mask = self.generate_attention_mask(
+        query, key, decoder_segment_ids, model_mode, query_positions=query_positions, key_positions=key_positions
+    )
     if attn_mask is not None:
       attn_weights = apply_mask_to_logits(attn_weights, attn_mask)
     return self.compute_local_attention(attn_weights, value, q_seq_len, model_mode)
@@ -569,12 +715,14 @@ class AttentionOp(nn.Module):
   def _get_cached_kv_dtype(self, dtype):
     return self.kv_quant.dtype if self.kv_quant else dtype
 
-  def _get_cache_scale_logical_shape(self, batch, heads):
+  def _get_cache_scale_logical_shape(self, batch, heads, cache_length, kv_head_size):
     assert self.kv_quant
     if self.kv_quant.axis_cfg == "dkv":
-      return (batch, self.max_prefill_predict_length, heads, 1)
+      return (batch, cache_length, heads, 1)
+    if self.kv_quant.axis_cfg == "dkv_groups":
+      return (batch, cache_length, heads, self.kv_quant.scale_size(kv_head_size))
     if self.kv_quant.axis_cfg == "heads_and_dkv":
-      return (batch, self.max_prefill_predict_length, 1, 1)
+      return (batch, cache_length, 1, 1)
     raise f"Invalid config for kv_quant_axis:{self.kv_quant.axis_cfg}"
 
   def _get_prefill_cache_vars(self, batch, heads, kv_head_size):
@@ -608,7 +756,9 @@ class AttentionOp(nn.Module):
     )
 
     if self.kv_quant:
-      cache_scale_logical_shape = self._get_cache_scale_logical_shape(batch, heads)
+      cache_scale_logical_shape = self._get_cache_scale_logical_shape(
+          batch, heads, self.max_prefill_predict_length, kv_head_size
+      )
       cache_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.prefill_cache_axis_order)
       cache_scale_shape = self.transpose_tuple(cache_scale_logical_shape, self.prefill_cache_axis_order)
 
@@ -634,10 +784,25 @@ class AttentionOp(nn.Module):
     value_vars = (cached_value_var, cached_value_scale_var)
     return key_vars, value_vars, cached_segment_id_var
 
+  def _uses_window_cache(self) -> bool:
+    return self.config.sliding_window_kv_cache and self.attention_type == AttentionType.LOCAL_SLIDING
+
+  def _ar_cache_length(self) -> int:
+    """Length of the ar cache, only the sliding window for local sliding layers with sliding_window_kv_cache,
+    and the whole sequence with unified_kv_cache."""
+    if self.config.unified_kv_cache:
+      return self.max_target_length
+    cache_length = self.max_target_length - self.max_prefill_predict_length
+    if self._uses_window_cache():
+      if not self.sliding_window_size:
+        raise ValueError("Sliding_window_size must be set if Local Sliding attention type")
+      return min(cache_length, self.sliding_window_size)
+    return cache_length
+
   def _get_ar_cache_vars(self, batch, heads, kv_head_size):
 
     dtype = self._get_cached_kv_dtype(self.dtype)
-    cache_length = self.max_target_length - self.max_prefill_predict_length
+    cache_length = self._ar_cache_length()
     cache_logical_shape = (batch, cache_length, heads, kv_head_size)
 
     cache_axis_names = self.transpose_tuple(self.cache_logical_axis_names, self.ar_cache_axis_order)
@@ -685,7 +850,7 @@ class AttentionOp(nn.Module):
     )
 
     if self.kv_quant:
-      cache_scale_logical_shape = self._get_cache_scale_logical_shape(batch, heads)
+      cache_scale_logical_shape = self._get_cache_scale_logical_shape(batch, heads, cache_length, kv_head_size)
       cache_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
       cache_scale_shape = self.transpose_tuple(cache_scale_logical_shape, self.ar_cache_axis_order)
 
@@ -712,6 +877,86 @@ class AttentionOp(nn.Module):
     value_vars = (cached_value_var, cached_value_scale_var)
     return key_vars, value_vars, cached_segment_id_var, cache_index_var, cached_lengths_var
 
+  def _get_paged_ar_cache_vars(self, batch, heads, kv_head_size):
+    """Creates the paged ar cache variables.
+
+    Keys and values live in a pool of `num_pages` pages of `ar_cache_page_size` tokens that is shared by
+    every slot. Each slot owns a row of `cache_ar_page_table`, where 0 marks an unallocated page and
+    p + 1 refers to page p of the pool. `cache_ar_page_owner` records which slot (slot + 1) holds a page,
+    with 0 marking a free page. `cache_ar_page_fault` marks the slots which needed a page when none was free,
+    whose tokens from then on are not in the cache.
+    """
+    dtype = self.dtype
+    cache_length = self.max_target_length - self.max_prefill_predict_length
+    page_size = self.config.ar_cache_page_size
+    pages_per_slot = -(-cache_length // page_size)
+    # Never allocate more than the worst case, this keeps the batch 1 prefill results small.
+    num_pages = batch * pages_per_slot
+    if self.config.ar_cache_num_pages > 0:
+      num_pages = min(num_pages, self.config.ar_cache_num_pages)
+
+    pool_axis_names = (CACHE_PAGES, CACHE_SEQUENCE, CACHE_HEADS, CACHE_KV)
+    pool_shape = (num_pages, page_size, heads, kv_head_size)
+
+    cached_key_pages_var = self.variable(
+        "cache",
+        "cached_ar_key_pages",
+        nn.with_logical_partitioning(jnp.zeros, pool_axis_names),
+        pool_shape,
+        dtype,
+    )
+    cached_value_pages_var = self.variable(
+        "cache",
+        "cached_ar_value_pages",
+        nn.with_logical_partitioning(jnp.zeros, pool_axis_names),
+        pool_shape,
+        dtype,
+    )
+    page_table_var = self.variable(
+        "cache",
+        "cache_ar_page_table",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH, CACHE_PAGES)),
+        (batch, pages_per_slot),
+        jnp.int32,
+    )
+    page_owner_var = self.variable(
+        "cache",
+        "cache_ar_page_owner",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_PAGES,)),
+        (num_pages,),
+        jnp.int32,
+    )
+    slot_active_var = self.variable(
+        "cache",
+        "cache_ar_slot_active",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH,)),
+        (batch,),
+        jnp.int32,
+    )
+    page_fault_var = self.variable(
+        "cache",
+        "cache_ar_page_fault",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH,)),
+        (batch,),
+        jnp.int32,
+    )
+    cached_segment_id_var = self.variable(
+        "cache",
+        "cache_ar_segment_id",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH, CACHE_SEQUENCE)),
+        (batch, cache_length),
+        jnp.int32,
+    )
+    cached_lengths_var = self.variable(
+        "cache",
+        "cached_ar_lengths",
+        nn.with_logical_partitioning(jnp.zeros, (CACHE_BATCH,)),
+        (batch,),
+        jnp.int32,
+    )
+    page_vars = (page_table_var, page_owner_var, slot_active_var, page_fault_var)
+    return cached_key_pages_var, cached_value_pages_var, page_vars, cached_segment_id_var, cached_lengths_var
+
   def kv_cache_prefill(
       self,
       key: Array,
@@ -732,11 +977,18 @@ class AttentionOp(nn.Module):
     """
     batch, _, heads, kv_head_size = key.shape
     assert key.dtype == value.dtype, "Key and Value Dtypes should match."
+    if self.config.unified_kv_cache:
+      return self.kv_cache_prefill_unified(key, value, decoder_segment_ids)
 
     cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
         batch, heads, kv_head_size
     )
-    _ = self._get_ar_cache_vars(batch, heads, kv_head_size)  # initialize it now
+    if self.config.paged_ar_cache:
+      # initialize it now, rows which are prefilled own their slot in the paged ar cache.
+      _, _, (_, _, slot_active_var, _), _, _ = self._get_paged_ar_cache_vars(batch, heads, kv_head_size)
+      slot_active_var.value = jnp.ones_like(slot_active_var.value)
+    else:
+      _ = self._get_ar_cache_vars(batch, heads, kv_head_size)  # initialize it now
 
     key_shaped_for_cache = jnp.transpose(key, self.prefill_cache_axis_order)
     value_shaped_for_cache = jnp.transpose(value, self.prefill_cache_axis_order)
@@ -758,24 +1010,258 @@ class AttentionOp(nn.Module):
 
     return key, value, decoder_segment_ids
 
+  def kv_cache_prefill_unified(
+      self,
+      key: Array,
+      value: Array,
+      decoder_segment_ids: Array,
+  ):
+    """In prefill mode with unified_kv_cache, the prompt is written at the start of the single per sequence
+    cache, and the cache length is set to the prompt length so decoding appends right after the prompt.
+
+    Args:
+      key: in shape [b, s, n, d].
+      value: in shape [b, s, n, d].
+      decoder_segment_ids: [b, s] -- marking segment ids for tokens
+
+    Returns:
+      key, value, decoder_segment_id.
+    """
+    batch, sequence, heads, kv_head_size = key.shape
+    cached_key_vars, cached_value_vars, cached_segment_id_var, _, cached_lengths_var = self._get_ar_cache_vars(
+        batch, heads, kv_head_size
+    )
+    if decoder_segment_ids is None:
+      decoder_segment_ids = jnp.zeros((batch, sequence), dtype=jnp.int32) + common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
+    cache_length = self._ar_cache_length()
+    start = jnp.zeros((batch,), dtype=jnp.int32)
+
+    key_axis_names = self.transpose_tuple(self.cache_logical_axis_names, self.ar_cache_axis_order)
+    key_shaped_for_cache = jnp.transpose(key, self.ar_cache_axis_order)
+    value_shaped_for_cache = jnp.transpose(value, self.ar_cache_axis_order)
+
+    if self.kv_quant:
+      key_shaped_for_cache, key_scale_shaped_for_cache = self.kv_quant.quantize(key_shaped_for_cache, key_axis_names)
+      value_shaped_for_cache, value_scale_shaped_for_cache = self.kv_quant.quantize(value_shaped_for_cache, key_axis_names)
+      scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
+      cached_key_vars[1].value = self._update_cache_chunk(
+          cached_key_vars[1].value, key_scale_shaped_for_cache, start, scale_axis_names, cache_length
+      )
+      cached_value_vars[1].value = self._update_cache_chunk(
+          cached_value_vars[1].value, value_scale_shaped_for_cache, start, scale_axis_names, cache_length
+      )
+
+    cached_key_vars[0].value = self._update_cache_chunk(
+        cached_key_vars[0].value, key_shaped_for_cache, start, key_axis_names, cache_length
+    )
+    cached_value_vars[0].value = self._update_cache_chunk(
+        cached_value_vars[0].value, value_shaped_for_cache, start, key_axis_names, cache_length
+    )
+    cached_segment_id_var.value = self._update_cache_chunk(
+        cached_segment_id_var.value, decoder_segment_ids, start, (CACHE_BATCH, CACHE_SEQUENCE), cache_length
+    )
+    cached_lengths_var.value = jnp.sum(
+        decoder_segment_ids == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR, axis=-1, dtype=jnp.int32
+    )
+    return key, value, decoder_segment_ids
+
+  def _update_cache_chunk(self, cache: Array, chunk: Array, start: Array, axis_names: AxisNames, cache_length: int) -> Array:
+    """Grows cache to cache_length along the sequence axis and writes chunk into it, starting at a per
+    batch row start position. The positions of a chunk past cache_length are dropped rather than shifting
+    the chunk back over valid entries."""
+    batch_axis = axis_names.index(CACHE_BATCH) if CACHE_BATCH in axis_names else axis_names.index(CACHE_SCALE_BATCH)
+    sequence_axis = (
+        axis_names.index(CACHE_SEQUENCE) if CACHE_SEQUENCE in axis_names else axis_names.index(CACHE_SCALE_SEQUENCE)
+    )
+    padding = [(0, 0)] * cache.ndim
+    padding[sequence_axis] = (0, cache_length - cache.shape[sequence_axis])
+    cache = jnp.pad(cache, padding)
+    row_sequence_axis = sequence_axis - 1 if batch_axis < sequence_axis else sequence_axis
+
+    def update_row(c, x, i):
+      index = (slice(None),) * row_sequence_axis + (i + jnp.arange(x.shape[row_sequence_axis]),)
+      return c.at[index].set(x.astype(c.dtype), mode="drop")
+
+    return jax.vmap(update_row, in_axes=(batch_axis, batch_axis, 0), out_axes=batch_axis)(cache, chunk, start)
+
+  def kv_cache_prefill_continuation(
+      self,
+      key: Array,
+      value: Array,
+      decoder_segment_ids: Array,
+  ):
+    """In prefill continuation mode, the prefill cache already holds a prefix of the prompt. We append
+    this chunk of the prompt right after the prefix and return both parts for attention.
+
+    The prefill cache only holds as many positions as the earlier prefill was padded to, so it is grown
+    to max_prefill_predict_length here. That keeps the cache shape fixed across continuation steps. Every
+    row's prefix plus the chunk must fit in max_prefill_predict_length.
+
+    Args:
+      key: in shape [b, s, n, d].
+      value: in shape [b, s, n, d].
+      decoder_segment_ids: [b, s] -- marking segment ids for tokens
+
+    Returns:
+      tuple of (key, value, segment_id, positions) for the new chunk, and a tuple holding the same for the
+      existing prefix, positions [b, s] being the position of every token.
+    """
+    batch, _, heads, kv_head_size = key.shape
+    if self.config.unified_kv_cache:
+      raise ValueError("Prefill continuation isn't supported with unified_kv_cache.")
+    if not self.has_variable("cache", "cached_prefill_key"):
+      raise ValueError("Error, we can't continue a prefill if we haven't seeded the KV Cache.")
+
+    cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
+        batch, heads, kv_head_size
+    )
+    prefix_segment_ids = cached_prefill_segment_id_var.value
+    cached_prefix = (
+        self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
+        self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
+        prefix_segment_ids,
+        jnp.broadcast_to(jnp.arange(prefix_segment_ids.shape[-1]), prefix_segment_ids.shape),
+    )
+    prefix_lengths = jnp.sum(prefix_segment_ids == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR, axis=-1, dtype=jnp.int32)
+    chunk_positions = prefix_lengths[:, None] + jnp.arange(key.shape[1])
+    cache_length = self.max_prefill_predict_length
+
+    prefill_key_axis_names = self.transpose_tuple(self.cache_logical_axis_names, self.prefill_cache_axis_order)
+    key_shaped_for_cache = jnp.transpose(key, self.prefill_cache_axis_order)
+    value_shaped_for_cache = jnp.transpose(value, self.prefill_cache_axis_order)
+
+    if self.kv_quant:
+      key_shaped_for_cache, key_scale_shaped_for_cache = self.kv_quant.quantize(key_shaped_for_cache, prefill_key_axis_names)
+      value_shaped_for_cache, value_scale_shaped_for_cache = self.kv_quant.quantize(
+          value_shaped_for_cache, prefill_key_axis_names
+      )
+      prefill_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.prefill_cache_axis_order)
+      cached_prefill_key_vars[1].value = self._update_cache_chunk(
+          cached_prefill_key_vars[1].value,
+          key_scale_shaped_for_cache,
+          prefix_lengths,
+          prefill_scale_axis_names,
+          cache_length,
+      )
+      cached_prefill_value_vars[1].value = self._update_cache_chunk(
+          cached_prefill_value_vars[1].value,
+          value_scale_shaped_for_cache,
+          prefix_lengths,
+          prefill_scale_axis_names,
+          cache_length,
+      )
+
+    cached_prefill_key_vars[0].value = self._update_cache_chunk(
+        cached_prefill_key_vars[0].value, key_shaped_for_cache, prefix_lengths, prefill_key_axis_names, cache_length
+    )
+    cached_prefill_value_vars[0].value = self._update_cache_chunk(
+        cached_prefill_value_vars[0].value, value_shaped_for_cache, prefix_lengths, prefill_key_axis_names, cache_length
+    )
+    cached_prefill_segment_id_var.value = self._update_cache_chunk(
+        cached_prefill_segment_id_var.value, decoder_segment_ids, prefix_lengths, (CACHE_BATCH, CACHE_SEQUENCE), cache_length
+    )
+
+    return (key, value, decoder_segment_ids, chunk_positions), (cached_prefix,)
+
+  def kv_cache_autoregressive_chunk(
+      self,
+      key: Array,
+      value: Array,
+  ):
+    """In autoregressive chunk mode, every sequence appends several tokens to the ar cache at its own
+    length, rather than one token.
+
+    Args:
+      key: in shape [b, s, n, d].
+      value: in shape [b, s, n, d].
+
+    Returns:
+      tuple of (key, value, segment_id, positions) for the new chunk, and the same for the prefill and ar
+      caches as they were before this chunk, positions [b, s] being the position of every token.
+    """
+    batch, chunk_length, heads, kv_head_size = key.shape
+    if not self.has_variable("cache", "cache_ar_index"):
+      raise ValueError("Error, we can't do autoregression if we haven't seeded the KV Cache.")
+    if self.config.paged_ar_cache:
+      raise ValueError("Autoregressive chunks aren't supported with paged_ar_cache.")
+    if self._uses_window_cache():
+      raise ValueError("Autoregressive chunks aren't supported with sliding_window_kv_cache.")
+    if self.config.unified_kv_cache:
+      raise ValueError("Autoregressive chunks aren't supported with unified_kv_cache.")
+
+    cached_ar_key_vars, cached_ar_value_vars, cached_ar_segment_id_var, _, cache_ar_lengths_var = self._get_ar_cache_vars(
+        batch, heads, kv_head_size
+    )
+    cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
+        batch, heads, kv_head_size
+    )
+    prefill_segment_ids = cached_prefill_segment_id_var.value
+    prefill_lengths = jnp.sum(
+        prefill_segment_ids == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR, axis=-1, dtype=jnp.int32
+    )
+    lengths = cache_ar_lengths_var.value
+    cached_prefill = (
+        self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
+        self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
+        prefill_segment_ids,
+        jnp.broadcast_to(jnp.arange(prefill_segment_ids.shape[-1]), prefill_segment_ids.shape),
+    )
+    cached_ar = (
+        self.get_cached_values(cached_ar_key_vars, key.dtype, self.ar_cache_axis_order),
+        self.get_cached_values(cached_ar_value_vars, value.dtype, self.ar_cache_axis_order),
+        cached_ar_segment_id_var.value,
+        prefill_lengths[:, None] + jnp.arange(cached_ar_segment_id_var.value.shape[-1]),
+    )
+    chunk_positions = (prefill_lengths + lengths)[:, None] + jnp.arange(chunk_length)
+
+    cache_length = self.max_target_length - self.max_prefill_predict_length
+    ar_key_axis_names = self.transpose_tuple(self.cache_logical_axis_names, self.ar_cache_axis_order)
+    key_shaped_for_cache = jnp.transpose(key, self.ar_cache_axis_order)
+    value_shaped_for_cache = jnp.transpose(value, self.ar_cache_axis_order)
+
+    if self.kv_quant:
+      key_shaped_for_cache, key_scale_shaped_for_cache = self.kv_quant.quantize(key_shaped_for_cache, ar_key_axis_names)
+      value_shaped_for_cache, value_scale_shaped_for_cache = self.kv_quant.quantize(
+          value_shaped_for_cache, ar_key_axis_names
+      )
+      ar_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
+      cached_ar_key_vars[1].value = self._update_cache_chunk(
+          cached_ar_key_vars[1].value, key_scale_shaped_for_cache, lengths, ar_scale_axis_names, cache_length
+      )
+      cached_ar_value_vars[1].value = self._update_cache_chunk(
+          cached_ar_value_vars[1].value, value_scale_shaped_for_cache, lengths, ar_scale_axis_names, cache_length
+      )
+
+    cached_ar_key_vars[0].value = self._update_cache_chunk(
+        cached_ar_key_vars[0].value, key_shaped_for_cache, lengths, ar_key_axis_names, cache_length
+    )
+    cached_ar_value_vars[0].value = self._update_cache_chunk(
+        cached_ar_value_vars[0].value, value_shaped_for_cache, lengths, ar_key_axis_names, cache_length
+    )
+    chunk_segment_ids = jnp.zeros((batch, chunk_length), dtype=jnp.int32) + common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
+    cached_ar_segment_id_var.value = self._update_cache_chunk(
+        cached_ar_segment_id_var.value, chunk_segment_ids, lengths, (CACHE_BATCH, CACHE_SEQUENCE), cache_length
+    )
+    cache_ar_lengths_var.value = lengths + chunk_length
+
+    return (key, value, chunk_segment_ids, chunk_positions), (cached_prefill, cached_ar)
+
   def update_ar_key_value(
       self,
       one_token_key: Array,
       one_token_value: Array,
       cached_key_vars: tuple[nn.Variable, nn.Variable | None],
       cached_value_vars: tuple[nn.Variable, nn.Variable | None],
-      one_hot_indices: Array,
-      lengths: Array,
-      use_ragged_attention: bool,
+      write_positions: Array,
   ) -> None:
-    """Adds a single token's results to the ar kv cache
+    """Adds a single token's results to the ar kv cache, for every sequence in one scatter per cache
 
     Args:
         one_token_key (Array): Key of one token to add to the cache
         one_token_value (Array): Value of one token to add to the cache
         cached_ar_key (tuple[nn.Variable, nn.Variable|None],): Cached keys to add new token key to, possibly with scale
         cached_ar_value (tuple[nn.Variable, nn.Variable|None],: Cached values to add new token value to, possible with scale
-        one_hot_indices (Array): Location of the new token within the cache
+        write_positions (Array): [batch] location of every sequence's new token within the cache
 
     Returns:
         tuple[Array, Array]: Updated caches for key and value with new token info added
@@ -798,57 +1284,23 @@ class AttentionOp(nn.Module):
           one_token_value_shaped_for_cache, ar_cache_axis_names
       )
 
-    ar_cache_update_idx = jnp.squeeze(one_hot_indices)
-    ar_cache_sequence_axis = ar_cache_update_axis = ar_cache_axis_names.index(CACHE_SEQUENCE)
-    ar_cache_batch_axis = ar_cache_axis_names.index(CACHE_BATCH)
-
-    if use_ragged_attention:
-      cache_locations = [slice(None)] * 4
-      new_token_locations = [slice(None)] * 4
-      new_token_locations[ar_cache_sequence_axis] = 0
-
-      def key_body(i, val):
-        cache_locations[ar_cache_batch_axis] = i
-        cache_locations[ar_cache_sequence_axis] = lengths[i]
-        new_token_locations[ar_cache_batch_axis] = i
-        return val.at[tuple(cache_locations)].set(one_token_key_shaped_for_cache[tuple(new_token_locations)])
-
-      def value_body(i, val):
-        cache_locations[ar_cache_batch_axis] = i
-        cache_locations[ar_cache_sequence_axis] = lengths[i]
-        new_token_locations[ar_cache_batch_axis] = i
-        return val.at[tuple(cache_locations)].set(one_token_value_shaped_for_cache[tuple(new_token_locations)])
-
-      cached_key_var.value = jax.lax.fori_loop(
-          0, one_token_key_shaped_for_cache.shape[0], key_body, cached_key_var.value, unroll=8
-      )
-      cached_value_var.value = jax.lax.fori_loop(
-          0, one_token_value_shaped_for_cache.shape[0], value_body, cached_value_var.value, unroll=8
-      )
-
-    else:
-      one_hot_indices = one_hot_indices.astype(int)
-      cached_key_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_key_var.value, one_token_key_shaped_for_cache, ar_cache_update_idx, ar_cache_update_axis
-      )
-      cached_value_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_value_var.value, one_token_value_shaped_for_cache, ar_cache_update_idx, ar_cache_update_axis
-      )
+    cached_key_var.value = scatter_token_into_cache(
+        cached_key_var.value, one_token_key_shaped_for_cache, write_positions, ar_cache_axis_names
+    )
+    cached_value_var.value = scatter_token_into_cache(
+        cached_value_var.value, one_token_value_shaped_for_cache, write_positions, ar_cache_axis_names
+    )
 
     cached_key_var.value = nn.with_logical_constraint(cached_key_var.value, ar_cache_axis_names)
     cached_value_var.value = nn.with_logical_constraint(cached_value_var.value, ar_cache_axis_names)
 
     if self.kv_quant:
       ar_cache_scale_axis_names = self.transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
-      ar_cache_scale_update_axis = ar_cache_scale_axis_names.index(CACHE_SCALE_SEQUENCE)
-      cached_key_scale_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_key_scale_var.value, one_token_key_scale_shaped_for_cache, ar_cache_update_idx, ar_cache_scale_update_axis
+      cached_key_scale_var.value = scatter_token_into_cache(
+          cached_key_scale_var.value, one_token_key_scale_shaped_for_cache, write_positions, ar_cache_scale_axis_names
       )
-      cached_value_scale_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_value_scale_var.value,
-          one_token_value_scale_shaped_for_cache,
-          ar_cache_update_idx,
-          ar_cache_scale_update_axis,
+      cached_value_scale_var.value = scatter_token_into_cache(
+          cached_value_scale_var.value, one_token_value_scale_shaped_for_cache, write_positions, ar_cache_scale_axis_names
       )
 
     return
@@ -863,20 +1315,154 @@ class AttentionOp(nn.Module):
         scale_value /= quantizations.MAX_INT8
       elif dtype == jnp.int4:
         scale_value /= quantizations.MAX_INT4
+      elif dtype == jnp.float8_e4m3fn:
+        scale_value /= quantizations.MAX_FP8_E4M3
 
       cache_value = KVTensor(qvalue=cache_value, scale=[scale_value], scale_t=None, dequant_dtype=target_dtype, bias=[])
     cache_value_in_logical_shape = jax.tree.map(lambda x: self.reverse_transepose(x, cache_axis_order), cache_value)
     return cache_value_in_logical_shape
 
+  def kv_cache_autoregressive_paged(self, key: Array, value: Array):
+    """In autoregressive mode with a paged ar cache, we allocate pages for the slots which need them and
+       write this token through the block table.
+
+    Args:
+      key: in shape [b, 1, n, d].
+      value: in shape [b, 1, n, d].
+
+    Returns:
+      tuple of (key, value, segment_id) for the prefill cache, and of (key pages, value pages, segment_id,
+      lengths, page table) for the ar cache, to be read by paged_attention.
+    """
+    batch, sequence, heads, kv_head_size = key.shape
+    if sequence != 1:
+      raise ValueError(f"Sequence length should be 1 during autoregression, got {sequence=}")
+    if not self.has_variable("cache", "cache_ar_page_table"):
+      raise ValueError("Error, we can't do autoregression if we haven't seeded the KV Cache.")
+
+    cached_key_pages_var, cached_value_pages_var, page_vars, cached_ar_segment_id_var, cache_ar_lengths_var = (
+        self._get_paged_ar_cache_vars(batch, heads, kv_head_size)
+    )
+    page_table_var, page_owner_var, slot_active_var, page_fault_var = page_vars
+    num_pages, page_size = cached_key_pages_var.value.shape[:2]
+    pages_per_slot = page_table_var.value.shape[1]
+    cache_length = cached_ar_segment_id_var.value.shape[1]
+
+    slots = jnp.arange(batch)
+    lengths = cache_ar_lengths_var.value
+    page_in_slot = jnp.minimum(lengths // page_size, pages_per_slot - 1)
+    page_offset = lengths % page_size
+    in_budget = (lengths < cache_length) & (slot_active_var.value > 0)
+
+    # Allocate one free page to every active slot that starts a new page this step.
+    page_table = page_table_var.value
+    current_page = page_table[slots, page_in_slot]
+    needs_page = in_budget & (current_page == 0)
+    free_pages = jnp.nonzero(page_owner_var.value == 0, size=batch, fill_value=num_pages)[0]
+    need_rank = jnp.cumsum(needs_page) - 1
+    new_page = jnp.where(needs_page, free_pages[jnp.clip(need_rank, 0, batch - 1)], num_pages)
+    allocated = new_page < num_pages
+    page_table = page_table.at[slots, page_in_slot].set(jnp.where(allocated, new_page + 1, current_page))
+    page_table_var.value = page_table
+    page_owner_var.value = page_owner_var.value.at[new_page].set(slots + 1, mode="drop")
+    # With the pool exhausted the token can't be cached, the slot is marked so its output is reported as invalid.
+    page_fault_var.value = jnp.where(needs_page & ~allocated, 1, page_fault_var.value)
+
+    # Write the new token, tokens of slots without a page (pool exhausted or inactive) are dropped.
+    write_page = page_table[slots, page_in_slot] - 1
+    write_page = jnp.where(in_budget & (write_page >= 0), write_page, num_pages)
+    cached_key_pages_var.value = cached_key_pages_var.value.at[write_page, page_offset].set(
+        key[:, 0].astype(cached_key_pages_var.value.dtype), mode="drop"
+    )
+    cached_value_pages_var.value = cached_value_pages_var.value.at[write_page, page_offset].set(
+        value[:, 0].astype(cached_value_pages_var.value.dtype), mode="drop"
+    )
+    written = write_page < num_pages
+    segment_idx = jnp.where(written, lengths, cache_length)
+    cached_ar_segment_id_var.value = cached_ar_segment_id_var.value.at[slots, segment_idx].set(
+        common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR, mode="drop"
+    )
+    cache_ar_lengths_var.value = cache_ar_lengths_var.value.at[:].add(1)
+
+    cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
+        batch, heads, kv_head_size
+    )
+    cached_prefill = (
+        self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
+        self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
+        cached_prefill_segment_id_var.value,
+    )
+    # The pages are attended to in place by paged_attention, through the page table.
+    cached_ar = (
+        cached_key_pages_var.value,
+        cached_value_pages_var.value,
+        cached_ar_segment_id_var.value,
+        cache_ar_lengths_var.value,
+        page_table,
+    )
+    return cached_prefill, cached_ar
+
+  def paged_attention(
+      self, query: Array, key_pages: Array, value_pages: Array, segment_ids: Array, lengths: Array, page_table: Array
+  ) -> tuple[Array, Array, Array]:
+    """Autoregressive attention over the paged ar cache, reading one page of every slot at a time.
+
+    The pages are looked up in the page table and their local attentions merged with a running max and sum,
+    so no dense [b, cache_length] copy of the cache is built and only the pages up to the longest slot are
+    visited.
+
+    Args:
+      query: in shape [b, 1, n, d].
+      key_pages: pool in shape [num_pages, page_size, n_kv, d].
+      value_pages: pool in shape [num_pages, page_size, n_kv, d].
+      segment_ids: [b, cache_length] -- marking the cached tokens of every slot
+      lengths: [b] number of tokens every slot has written
+      page_table: [b, pages_per_slot] holding p + 1 for page p of the pool and 0 for unallocated pages
+
+    Returns:
+      the unnormalized output, max and sum of the exponentials, as apply_attention_dot returns them.
+    """
+    page_size = key_pages.shape[1]
+    pages_per_slot = page_table.shape[1]
+    cache_length = segment_ids.shape[1]
+    segment_ids = jnp.pad(segment_ids, ((0, 0), (0, pages_per_slot * page_size - cache_length)))
+    num_pages = jnp.clip(jnp.max(-(-jnp.minimum(lengths, cache_length) // page_size)), 1, pages_per_slot)
+
+    def attend_page(i):
+      # Unallocated pages read page 0 of the pool, their tokens are masked by the segment ids.
+      pages = jnp.maximum(page_table[:, i] - 1, 0)
+      page_segment_ids = jax.lax.dynamic_slice_in_dim(segment_ids, i * page_size, page_size, axis=1)
+      return self.apply_attention_dot(
+          query,
+          key_pages[pages].astype(query.dtype),
+          value_pages[pages].astype(query.dtype),
+          page_segment_ids,
+          common_types.MODEL_MODE_AUTOREGRESSIVE,
+      )
+
+    def merge_page(i, carry):
+      out, local_max, local_sum = carry
+      page_out, page_max, page_sum = attend_page(i)
+      new_max = jnp.maximum(local_max, page_max)
+      weight, page_weight = jnp.exp(local_max - new_max), jnp.exp(page_max - new_max)
+      return out * weight + page_out * page_weight, new_max, local_sum * weight + page_sum * page_weight
+
+    return jax.lax.fori_loop(1, num_pages, merge_page, attend_page(0))
+
   def kv_cache_autoregressive(
       self,
       key: Array,
       value: Array,
-      use_ragged_attention: bool = False,
   ):
     """In autoregressive mode, we update the cache for this entry and
        then return the full cache.
 
+    Every sequence writes at its own length in the ar cache, wrapping around once it is full, so a slot
+    gets the whole ar cache no matter when it was inserted. With sliding_window_kv_cache, the ar cache of a
+    local sliding layer is a ring holding the last sliding_window_size tokens, and the prefill cache is
+    masked to the tokens still in the window. With unified_kv_cache, the prompt is at the start of the ar
+    cache, which is then returned as the only cache.
+
     Args:
       key: in shape [b, 1, n, d].
       value: in shape [b, 1, n, d].
@@ -894,50 +1480,65 @@ class AttentionOp(nn.Module):
     if not is_initialized:
       raise ValueError("Error, we can't do autoregression if we haven't seeded the KV Cache.")
 
-    cached_ar_key_vars, cached_ar_value_vars, cached_ar_segment_id_var, cache_ar_index_var, cache_ar_lengths_var = (
-        self._get_ar_cache_vars(batch, heads, kv_head_size)
+    # cache_ar_index only marks a seeded cache, every sequence writes at its own position.
+    cached_ar_key_vars, cached_ar_value_vars, cached_ar_segment_id_var, _, cache_ar_lengths_var = self._get_ar_cache_vars(
+        batch, heads, kv_head_size
     )
+    cache_length = self._ar_cache_length()
+    write_positions = jnp.mod(cache_ar_lengths_var.value, cache_length)
 
     self.update_ar_key_value(
         key,
         value,
         cached_ar_key_vars,
         cached_ar_value_vars,
-        cache_ar_index_var.value,
-        cache_ar_lengths_var.value,
-        use_ragged_attention,
+        write_positions,
     )
     active_indicator = jnp.zeros((batch, 1), dtype=jnp.int32) + common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
-    cached_ar_segment_id_var.value = jax.lax.dynamic_update_index_in_dim(
-        cached_ar_segment_id_var.value, active_indicator, jnp.squeeze(cache_ar_index_var.value), 1
-    )
-    cache_ar_index_var.value = jnp.mod(
-        cache_ar_index_var.value + 1, self.max_target_length - self.max_prefill_predict_length
+    cached_ar_segment_id_var.value = scatter_token_into_cache(
+        cached_ar_segment_id_var.value, active_indicator, write_positions, (CACHE_BATCH, CACHE_SEQUENCE)
     )
     cache_ar_lengths_var.value = cache_ar_lengths_var.value.at[:].add(1)
 
+    if self.config.unified_kv_cache:
+      cached_unified = (
+          self.get_cached_values(cached_ar_key_vars, key.dtype, self.ar_cache_axis_order),
+          self.get_cached_values(cached_ar_value_vars, value.dtype, self.ar_cache_axis_order),
+          cached_ar_segment_id_var.value,
+          cache_ar_lengths_var.value,
+      )
+      return cached_unified, None
+
     # The below retrieves the existing prefill cache variables, not creating new ones
     cached_prefill_key_vars, cached_prefill_value_vars, cached_prefill_segment_id_var = self._get_prefill_cache_vars(
         batch, heads, kv_head_size
     )
 
+    prefill_segment_ids = cached_prefill_segment_id_var.value
+    ar_lengths = cache_ar_lengths_var.value
+    if self._uses_window_cache():
+      # The prefill cache holds token i at index i, the current token is at position prefill length + ar length - 1.
+      prefill_lengths = jnp.sum(prefill_segment_ids == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR, axis=-1)
+      window_start = prefill_lengths + ar_lengths - self.sliding_window_size
+      in_window = jnp.arange(prefill_segment_ids.shape[-1])[None, :] >= window_start[:, None]
+      prefill_segment_ids = jnp.where(in_window, prefill_segment_ids, 0)
+      ar_lengths = jnp.minimum(ar_lengths, cache_length)
+
     cached_prefill = (
         self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
         self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
-        cached_prefill_segment_id_var.value,
+        prefill_segment_ids,
     )
 
     cached_ar = (
         self.get_cached_values(cached_ar_key_vars, key.dtype, self.ar_cache_axis_order),
         self.get_cached_values(cached_ar_value_vars, value.dtype, self.ar_cache_axis_order),
         cached_ar_segment_id_var.value,
-        cache_ar_lengths_var.value,
+        ar_lengths,
     )
     return cached_prefill, cached_ar
 
-  def kv_cache(
-      self, key: Array, value: Array, decoder_segment_ids: Array, model_mode: str, use_ragged_attention: bool = False
-  ) -> tuple:
+  def kv_cache(self, key: Array, value: Array, decoder_segment_ids: Array, model_mode: str) -> tuple:
     """KV cache takes the current state and updates the state accordingly.
 
     The key and value have dimension [b, s, n_kv, d],
@@ -962,11 +1563,28 @@ class AttentionOp(nn.Module):
       return (key, value, decoder_segment_ids), None
     elif model_mode == common_types.MODEL_MODE_PREFILL:
       return self.kv_cache_prefill(key, value, decoder_segment_ids), None
+    elif model_mode == common_types.MODEL_MODE_PREFILL_CONTINUATION:
+      return self.kv_cache_prefill_continuation(key, value, decoder_segment_ids)
+    elif model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE_CHUNK:
+      return self.kv_cache_autoregressive_chunk(key, value)
+    elif model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE and self.config.paged_ar_cache:
+      return self.kv_cache_autoregressive_paged(key, value)
     elif model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE:
-      return self.kv_cache_autoregressive(key, value, use_ragged_attention)
+      return self.kv_cache_autoregressive(key, value)
     else:
       raise ValueError(f"Model Mode isn't supported! {model_mode=}")
 
+  def merge_local_attentions(self, local_outs, local_maxes, local_sums, axis):
+    """Merges local attentions stacked along axis into the unnormalized output, max and sum over all of them,
+    like normalize_attention does for a list of local attentions before normalizing."""
+    global_max = jnp.max(local_maxes, axis=axis, keepdims=True)
+    weights = jnp.exp(local_maxes - global_max)
+    return (
+        jnp.sum(weights * local_outs, axis=axis),
+        jnp.squeeze(global_max, axis=axis),
+        jnp.sum(weights * local_sums, axis=axis),
+    )
+
   def normalize_attention(self, local_outs, local_maxes, local_sums):
     """Normalize across multiple localized attentions
 
@@ -992,16 +1610,39 @@ class AttentionOp(nn.Module):
 
   @nn.compact
   def __call__(self, query, key, value, decoder_segment_ids, model_mode):
-    prefill_kv_cache, ar_kv_cache = self.kv_cache(
-        key, value, decoder_segment_ids, model_mode, use_ragged_attention=self.use_ragged_attention
-    )
+    prefill_kv_cache, ar_kv_cache = self.kv_cache(key, value, decoder_segment_ids, model_mode)
+
+    if model_mode in (common_types.MODEL_MODE_PREFILL_CONTINUATION, common_types.MODEL_MODE_AUTOREGRESSIVE_CHUNK):
+      # The new chunk attends causally to itself and to the tokens of the caches it extends, masked by position
+      # so that a sliding window is measured from every query's own position.
+      chunk_kv_cache, cached_kv_caches = prefill_kv_cache, ar_kv_cache
+      chunk_positions = chunk_kv_cache[3]
+      local_attentions = [
+          self.apply_attention_dot(
+              query, chunk_kv_cache[0], chunk_kv_cache[1], chunk_kv_cache[2], common_types.MODEL_MODE_PREFILL
+          )
+      ]
+      for cached_kv_cache in cached_kv_caches:
+        local_attentions.append(
+            self.apply_attention_dot(
+                query,
+                cached_kv_cache[0],
+                cached_kv_cache[1],
+                cached_kv_cache[2],
+                common_types.MODEL_MODE_AUTOREGRESSIVE,
+                query_positions=chunk_positions,
+                key_positions=cached_kv_cache[3],
+            )
+        )
+      unnormalized_outputs, exponentials_maxes, exponentials_sums = (list(x) for x in zip(*local_attentions))
+      return self.normalize_attention(unnormalized_outputs, exponentials_maxes, exponentials_sums)
 
     prefill_unnormalized_output, prefill_exponentials_max, prefill_exponentials_sum = self.apply_attention(
         query=query,
         key=prefill_kv_cache[0],
         value=prefill_kv_cache[1],
         decoder_segment_ids=prefill_kv_cache[2],
-        lengths=None,
+        lengths=prefill_kv_cache[3] if len(prefill_kv_cache) > 3 else None,
         model_mode=model_mode,
         use_ragged_attention=self.use_ragged_attention,
     )
@@ -1012,15 +1653,18 @@ class AttentionOp(nn.Module):
         return prefill_unnormalized_output / prefill_exponentials_sum
       return prefill_unnormalized_output
 
-    ar_unnormalized_output, ar_exponentials_max, ar_exponentials_sum = self.apply_attention(
-        query=query,
-        key=ar_kv_cache[0],
-        value=ar_kv_cache[1],
-        decoder_segment_ids=ar_kv_cache[2],
-        lengths=ar_kv_cache[3],
-        model_mode=model_mode,
-        use_ragged_attention=self.use_ragged_attention,
-    )
+    if model_mode == common_types.MODEL_MODE_AUTOREGRESSIVE and self.config.paged_ar_cache:
+      ar_unnormalized_output, ar_exponentials_max, ar_exponentials_sum = self.paged_attention(query, *ar_kv_cache)
+    else:
+      ar_unnormalized_output, ar_exponentials_max, ar_exponentials_sum = self.apply_attention(
+          query=query,
+          key=ar_kv_cache[0],
+          value=ar_kv_cache[1],
+          decoder_segment_ids=ar_kv_cache[2],
+          lengths=ar_kv_cache[3],
+          model_mode=model_mode,
+          use_ragged_attention=self.use_ragged_attention,
+      )
 
     if ar_unnormalized_output is not None:
       unnormalized_outputs = [prefill_unnormalized_output, ar_unnormalized_output]
@@ -1179,24 +1823,28 @@ class Attention(nn.Module):
     )(out)
     return out_proj
 
-  def apply_rotary_embedding(self, inputs: Array, inputs_positions: Array, name: str):
+  def rotary_embedding(self, name: str):
+    max_position = self.config.max_target_length if self.config.rope_precompute_table else 0
     if self.config.model_name.startswith("llama3.1"):
-      rotary_embedding = embeddings.LLaMARotaryEmbedding(
+      return embeddings.LLaMARotaryEmbedding(
           min_timescale=self.config.rope_min_timescale,
           max_timescale=self.config.rope_max_timescale,
           embedding_dims=self.head_dim,
           fprop_dtype=self.dtype,
+          max_position=max_position,
           name=name,
       )
-    else:
-      rotary_embedding = RotaryEmbedding(
-          min_timescale=self.config.rope_min_timescale,
-          max_timescale=self.config.rope_max_timescale,
-          embedding_dims=self.head_dim,
-          fprop_dtype=self.dtype,
-          name=name,
-      )
-    inputs = rotary_embedding(inputs, inputs_positions)
+    return RotaryEmbedding(
+        min_timescale=self.config.rope_min_timescale,
+        max_timescale=self.config.rope_max_timescale,
+        embedding_dims=self.head_dim,
+        fprop_dtype=self.dtype,
+        max_position=max_position,
+        name=name,
+    )
+
+  def apply_rotary_embedding(self, inputs: Array, inputs_positions: Array, name: str, sin_cos=None):
+    inputs = self.rotary_embedding(name)(inputs, inputs_positions, sin_cos=sin_cos)
     return inputs
 
   @nn.compact
@@ -1240,9 +1888,11 @@ class Attention(nn.Module):
       key = self.kv_projection(inputs_kv, proj_name="key")
       value = self.kv_projection(inputs_kv, proj_name="value")
 
-    # apply ROPE
-    query = self.apply_rotary_embedding(query, inputs_positions, name="query_rotary")
-    key = self.apply_rotary_embedding(key, inputs_positions, name="key_rotary")
+    # apply ROPE, with sin and cos computed once for query and key
+    query_rotary = self.rotary_embedding(name="query_rotary")
+    sin_cos = query_rotary.sin_cos(inputs_positions)
+    query = query_rotary(query, inputs_positions, sin_cos=sin_cos)
+    key = self.apply_rotary_embedding(key, inputs_positions, name="key_rotary", sin_cos=sin_cos)
 
     # annotate with sharding constraint.
     query = nn.with_logical_constraint(query, self.query_axis_names)
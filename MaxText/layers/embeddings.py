@@ -14,12 +14,14 @@
 
 """Embedding Layers."""
 
-from typing import Any, Optional
+import functools
+from typing import Any, Optional, Tuple
 
 from flax import linen as nn
 import jax
 from jax import lax
 import jax.numpy as jnp
+import numpy as np
 from layers import initializers
 
 Config = Any
@@ -32,6 +34,66 @@ with_logical_partitioning = nn.with_logical_partitioning
 
 _MAX_WAVELENGTH = 10_000
 
+# LLaMA3.1 ROPE scaling, see LLaMARotaryEmbedding.
+_LLAMA3_SCALE_FACTOR = 8
+_LLAMA3_LOW_FREQ_FACTOR = 1
+_LLAMA3_HIGH_FREQ_FACTOR = 4
+_LLAMA3_OLD_CONTEXT_LEN = 8192  # original llama3 length
+
+
+def _llama3_scaled_frequencies(freq: np.ndarray) -> np.ndarray:
+  """Host side, vectorized LLaMARotaryEmbedding._apply_scaling_factor."""
+  low_freq_wavelen = _LLAMA3_OLD_CONTEXT_LEN / _LLAMA3_LOW_FREQ_FACTOR
+  high_freq_wavelen = _LLAMA3_OLD_CONTEXT_LEN / _LLAMA3_HIGH_FREQ_FACTOR
+  wavelen = 2 * np.pi / freq
+  smooth = (_LLAMA3_OLD_CONTEXT_LEN / wavelen - _LLAMA3_LOW_FREQ_FACTOR) / (
+      _LLAMA3_HIGH_FREQ_FACTOR - _LLAMA3_LOW_FREQ_FACTOR
+  )
+  scaled = np.where(
+      wavelen > low_freq_wavelen,
+      freq / _LLAMA3_SCALE_FACTOR,
+      (1 - smooth) * freq / _LLAMA3_SCALE_FACTOR + smooth * freq,
+  )
+  return np.where(wavelen < high_freq_wavelen, freq, scaled)
+
+
+@functools.lru_cache(maxsize=None)
+def rotary_sin_cos_table(
+    min_timescale: float,
+    max_timescale: float,
+    embedding_dims: int,
+    max_position: int,
+    interleaved: bool = False,
+    use_scale: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+  """Returns sin and cos of position / timescale for every position < max_position.
+
+  The tables are computed once per process on the host, so every layer and both query and key gather from the same
+  constant instead of evaluating sin and cos on every call. interleaved selects the LLaMA layout, which repeats every
+  timescale twice, and use_scale applies the llama3.1 frequency scaling.
+
+  Returns:
+    sin and cos tables of shape [max_position, embedding_dims // 2], or [max_position, embedding_dims] if interleaved.
+  """
+  fraction = 2 * np.arange(0, embedding_dims // 2) / embedding_dims
+  if interleaved:
+    fraction = np.repeat(fraction, 2)
+  timescale = min_timescale * (max_timescale / min_timescale) ** fraction
+  if use_scale:
+    timescale = 1.0 / _llama3_scaled_frequencies(1.0 / timescale)
+  sinusoid_inp = np.arange(max_position, dtype=np.float64)[:, np.newaxis] / timescale
+  return np.sin(sinusoid_inp).astype(np.float32), np.cos(sinusoid_inp).astype(np.float32)
+
+
+def _gather_sin_cos(tables: Tuple[np.ndarray, np.ndarray], position: Array) -> Tuple[Array, Array]:
+  """Gathers the [B, S] positions from the sin and cos tables, shaped [B, S, 1, dims] to broadcast over heads.
+
+  Positions past the end of the tables can't raise under jit, they are clamped to the last row, so callers size the
+  tables to every position they use (max_target_length).
+  """
+  position = position.astype(jnp.int32)
+  return tuple(jnp.take(table, position, axis=0, mode="clip")[:, :, jnp.newaxis, :] for table in tables)
+
 
 class Embed(nn.Module):
   """A parameterized function from integers [0, n) to d-dimensional vectors.
@@ -113,6 +175,8 @@ class RotaryEmbedding(nn.Module):
     max_timescale: End of the geometric index. Determines the frequency of the
       added signal.
     embedding_dims: Dimension of the embedding to be generated.
+    max_position: If positive, sin and cos are gathered from tables precomputed
+      for the positions below it instead of being evaluated on every call.
   """
 
   min_timescale: int
@@ -120,6 +184,7 @@ class RotaryEmbedding(nn.Module):
   embedding_dims: int = 0
   cast_as_fprop_dtype: bool = True
   fprop_dtype: DType = jnp.bfloat16
+  max_position: int = 0
 
   def setup(self) -> None:
     if self.embedding_dims % 2:
@@ -133,10 +198,19 @@ class RotaryEmbedding(nn.Module):
     fraction = 2 * jnp.arange(0, half_embedding_dim) / self.embedding_dims
     self.timescale = self.min_timescale * (self.max_timescale / self.min_timescale) ** fraction
 
+  def sin_cos(self, position: jax.Array) -> Tuple[jax.Array, jax.Array]:
+    """Returns sin and cos of the [B, S] positions over the timescales, shaped [B, S, 1, H // 2]."""
+    if self.max_position > 0:
+      tables = rotary_sin_cos_table(self.min_timescale, self.max_timescale, self.embedding_dims, self.max_position)
+      return _gather_sin_cos(tables, position)
+    sinusoid_inp = position[:, :, jnp.newaxis, jnp.newaxis] / self.timescale
+    return jnp.sin(sinusoid_inp), jnp.cos(sinusoid_inp)
+
   def __call__(
       self,  # pytype: disable=signature-mismatch  # overriding-parameter-count-checks
       inputs: jax.Array,
       position: Optional[jax.Array] = None,
+      sin_cos: Optional[Tuple[jax.Array, jax.Array]] = None,
   ) -> jax.Array:
     """Generates a jax.Array of sinusoids with different frequencies.
 
@@ -147,12 +221,14 @@ class RotaryEmbedding(nn.Module):
       position: Optional position jax.Array which denotes the position of each
         token in the sequence. This only needs to be supplied when the sequence
         is packed. It is of shape [B, S].
+      sin_cos: Optional sin and cos from self.sin_cos(position), so query and
+        key can share them.
 
     Returns:
       a jax.Array of shape [B, S, N, H] which includes the inputs together with
       the rotary position embedding incorporated in it.
     """
-    assert position is not None
+    assert position is not None or sin_cos is not None
     if len(inputs.shape) != 4:
       raise ValueError("Input is assumed to be a rank 4 tensor of shape" "[batch, sequence, heads, dims].")
     if self.embedding_dims != inputs.shape[3]:
@@ -160,10 +236,9 @@ class RotaryEmbedding(nn.Module):
           "The embedding dims of the rotary position embedding" "must match the hidden dimension of the inputs."
       )
 
-    position = position[:, :, jnp.newaxis, jnp.newaxis]
-    sinusoid_inp = position / self.timescale
-    sin = jnp.sin(sinusoid_inp).astype(inputs.dtype)
-    cos = jnp.cos(sinusoid_inp).astype(inputs.dtype)
+    sin, cos = sin_cos if sin_cos is not None else self.sin_cos(position)
+    sin = sin.astype(inputs.dtype)
+    cos = cos.astype(inputs.dtype)
     first_half, second_half = jnp.split(inputs, 2, axis=-1)
     first_part = first_half * cos - second_half * sin
     second_part = second_half * cos + first_half * sin
@@ -182,10 +257,10 @@ class LLaMARotaryEmbedding(RotaryEmbedding):
   use_scale: bool = True
 
   def _apply_scaling_factor(self, freq):
-    scale_factor = 8
-    low_freq_factor = 1
-    high_freq_factor = 4
-    old_context_len = 8192  # original llama3 length
+    scale_factor = _LLAMA3_SCALE_FACTOR
+    low_freq_factor = _LLAMA3_LOW_FREQ_FACTOR
+    high_freq_factor = _LLAMA3_HIGH_FREQ_FACTOR
+    old_context_len = _LLAMA3_OLD_CONTEXT_LEN
 
     low_freq_wavelen = old_context_len / low_freq_factor
     high_freq_wavelen = old_context_len / high_freq_factor
@@ -224,7 +299,27 @@ class LLaMARotaryEmbedding(RotaryEmbedding):
     # Expand timescale dimensions for broadcasting
     self.timescale = timescale[jnp.newaxis, jnp.newaxis, jnp.newaxis, :]
 
-  def __call__(self, inputs: jax.Array, position: Optional[jax.Array] = None) -> jax.Array:
+  def sin_cos(self, position: jax.Array) -> Tuple[jax.Array, jax.Array]:
+    """Returns sin and cos of the [B, S] positions over the interleaved timescales, shaped [B, S, 1, H]."""
+    if self.max_position > 0:
+      tables = rotary_sin_cos_table(
+          self.min_timescale,
+          self.max_timescale,
+          self.embedding_dims,
+          self.max_position,
+          interleaved=True,
+          use_scale=self.use_scale,
+      )
+      return _gather_sin_cos(tables, position)
+    sinusoid_inp = position[:, :, jnp.newaxis, jnp.newaxis] / self.timescale
+    return jnp.sin(sinusoid_inp), jnp.cos(sinusoid_inp)
+
+  def __call__(
+      self,
+      inputs: jax.Array,
+      position: Optional[jax.Array] = None,
+      sin_cos: Optional[Tuple[jax.Array, jax.Array]] = None,
+  ) -> jax.Array:
     """Applies LLaMA variant of rotary position embedding.
 
     Args:
@@ -232,6 +327,8 @@ class LLaMARotaryEmbedding(RotaryEmbedding):
         embedding. It is assumed of shape [B, S, N, H].
       position: Optional position array [B, S]. Only needed when the sequence
         is packed.
+      sin_cos: Optional sin and cos from self.sin_cos(position), so query and
+        key can share them.
 
     Returns:
       A jax.Array of shape [B, S, N, H] with rotary position embeddings applied.
@@ -254,17 +351,13 @@ class LLaMARotaryEmbedding(RotaryEmbedding):
         inputs_shifted_left,
     )
 
-    # Determine positions if not provided
-    if position is None:
-      seq_length = inputs.shape[1]
-      position = jnp.arange(seq_length, dtype=jnp.float32)[jnp.newaxis, :]
-
-    # Calculate sinusoidal input
-    position = position[:, :, jnp.newaxis, jnp.newaxis]
-    sinusoid_inp = position / self.timescale
-
-    sin = jnp.sin(sinusoid_inp)
-    cos = jnp.cos(sinusoid_inp)
+    if sin_cos is None:
+      # Determine positions if not provided
+      if position is None:
+        seq_length = inputs.shape[1]
+        position = jnp.arange(seq_length, dtype=jnp.float32)[jnp.newaxis, :]
+      sin_cos = self.sin_cos(position)
+    sin, cos = sin_cos
 
     # Apply alternating sign
     sign = jnp.tile(jnp.array([-1, 1]), self.embedding_dims // 2)
@@ -33,6 +33,7 @@ from typing import Tuple, Sequence
 
 MAX_INT8 = 127.5
 MAX_INT4 = 7.5
+MAX_FP8_E4M3 = float(jnp.finfo(jnp.float8_e4m3fn).max)
 
 Array = common_types.Array
 Config = common_types.Config
@@ -315,17 +316,22 @@ def configure_kv_quant(config):
 class KVQuant:
   axis_cfg = ""
   dtype = None
+  group_size = 0
 
   def __init__(self, config: Config):
     assert config.quantize_kvcache
     self.axis_cfg = config.kv_quant_axis
     self.dtype = self._get_dtype(config.kv_quant_dtype)
+    if self.axis_cfg == "dkv_groups":
+      self.group_size = config.kv_quant_group_size
 
   def _get_dtype(self, dtype_cfg: str):
     if dtype_cfg == "int4":
       return jnp.int4
     if dtype_cfg == "int8":
       return jnp.int8
+    if dtype_cfg == "fp8":
+      return jnp.float8_e4m3fn
     raise ValueError(f"Invalid kv_quant_dtype: {dtype_cfg}")
 
   def _get_max_axis(self, axis_names: AxisNames):
@@ -335,19 +341,48 @@ class KVQuant:
       return (axis_names.index(CACHE_HEADS), axis_names.index(CACHE_KV))
     raise ValueError(f"Invalid KV quant axis cfg: {self.axis_cfg}")
 
+  def scale_size(self, kv_head_size: int) -> int:
+    """Size of the kv axis of the scales, one scale per group of channels with dkv_groups."""
+    return kv_head_size // self.group_size if self.group_size else 1
+
+  def _get_scale(self, kv: Array, axis_names: AxisNames) -> Array:
+    """Returns the abs max scale of kv, with a kv axis of size scale_size."""
+    if not self.group_size:
+      return jnp.max(jnp.abs(kv), axis=self._get_max_axis(axis_names), keepdims=True)
+    kv_axis = axis_names.index(CACHE_KV)
+    grouped_shape = kv.shape[:kv_axis] + (kv.shape[kv_axis] // self.group_size, self.group_size) + kv.shape[kv_axis + 1 :]
+    return jnp.max(jnp.abs(jnp.reshape(kv, grouped_shape)), axis=kv_axis + 1)
+
+  def _expand_scale(self, scale: Array, kv_axis: int) -> Array:
+    """Repeats group scales so they broadcast against the kv they scale."""
+    return jnp.repeat(scale, self.group_size, axis=kv_axis) if self.group_size else scale
+
   def quantize(self, kv: Array, axis_names: AxisNames):
     """Quantize key/values stored in kvcache."""
     assert self.axis_cfg, "KV quant axis cannot be None"
-    max_axis = self._get_max_axis(axis_names)
-    scale = jnp.max(jnp.abs(kv), axis=max_axis, keepdims=True)
+    scale = self._get_scale(kv, axis_names)
+    full_scale = self._expand_scale(scale, axis_names.index(CACHE_KV))
     if self.dtype == jnp.int8:
-      value = jnp.int8(jnp.rint(kv * (MAX_INT8 / scale)))
+      value = jnp.int8(jnp.rint(kv * (MAX_INT8 / full_scale)))
       return value, scale
     if self.dtype == jnp.int4:
-      value = jnp.int4(jnp.rint(kv * (MAX_INT4 / scale)))
+      value = jnp.int4(jnp.rint(kv * (MAX_INT4 / full_scale)))
+      return value, scale
+    if self.dtype == jnp.float8_e4m3fn:
+      value = (kv * (MAX_FP8_E4M3 / full_scale)).astype(jnp.float8_e4m3fn)
       return value, scale
     raise ValueError(f"Invalid KV quant dtype:{self.dtype}.")
 
+  def dequantizes_in_einsum(self) -> bool:
+    """Group-wise scales and fp8 values aren't supported by the AQT einsum, the cache is dequantized inside
+    the attention einsums instead."""
+    return self.group_size > 0 or self.dtype == jnp.float8_e4m3fn
+
+  def dequant(self, kv: aqt_tensor.QTensor) -> Array:
+    """Dequantizes a cached kv tensor in [..., d] layout, whose scale is already divided by the dtype's max."""
+    scale = self._expand_scale(kv.scale[0], kv.qvalue.ndim - 1)
+    return kv.qvalue.astype(kv.dequant_dtype) * scale.astype(kv.dequant_dtype)
+
   def einsum_fn_with_rhs_qtensor(
       self,
       kv: Array | aqt_tensor.QTensor,
@@ -356,6 +391,9 @@ class KVQuant:
   ):
     # Assumes kv is already quantized.
     einsum = jnp.einsum
+    if isinstance(kv, aqt_tensor.QTensor) and self.dequantizes_in_einsum():
+      # the convert and scale of the rhs are fused into the einsum by XLA.
+      return lambda subscripts, lhs, rhs: jnp.einsum(subscripts, lhs, self.dequant(rhs))
     if isinstance(kv, aqt_tensor.QTensor):
       num_bits = 4 if kv.qvalue.dtype == jnp.int4 else 8
       kv_cfg = aqt_config.dot_general_make(
@@ -13,9 +13,11 @@
 # limitations under the License.
 
 """Implementation of Engine API for MaxText"""
+import concurrent.futures
 import copy as cp
 import functools
-from typing import Any, Optional, Tuple, Callable
+import time
+from typing import Any, Callable, Iterator, Optional, Tuple
 
 import flax
 from flax import linen as nn
@@ -34,8 +36,11 @@ from jetstream.engine import tokenizer_pb2
 from jetstream.engine import tokenizer_api
 from jetstream.engine import token_utils
 
+import max_logging
 import max_utils
 import inference_utils
+import kv_layout_cache
+import prefix_cache
 import pyconfig
 import jaxlib
 
@@ -45,6 +50,7 @@ warnings.simplefilter("ignore", category=FutureWarning)
 
 Prefix = Any
 Params = Any
+SlotState = Any
 
 
 @struct.dataclass
@@ -80,6 +86,16 @@ class MaxEngineConfig:
     return self.keys
 
 
+def _config_with_cached_kv_layout(config):
+  """Returns config with the KV cache layout tuned by kv_layout_autotuner.py for this model, batch and hardware."""
+  layout = kv_layout_cache.load_layout(config.kv_layout_cache_path, config)
+  if layout is None:
+    max_logging.log(f"No tuned KV cache layout in {config.kv_layout_cache_path} for this model, batch and hardware.")
+    return config
+  max_logging.log(f"Using the KV cache layout tuned in {config.kv_layout_cache_path}: {layout}")
+  return MaxEngineConfig({**config.get_keys(), **layout})
+
+
 class MaxEngine(engine_api.Engine):
   """The computational core of the generative model server.
 
@@ -88,6 +104,8 @@ class MaxEngine(engine_api.Engine):
   """
 
   def __init__(self, config):
+    if config.use_kv_layout_cache:
+      config = _config_with_cached_kv_layout(config)
     self.config = config
 
     # Mesh definition
@@ -98,6 +116,9 @@ class MaxEngine(engine_api.Engine):
     quant = quantizations.configure_quantization(config)
     self.model = models.Transformer(config, mesh=self._mesh, quant=quant)
     self.replicated_sharding = jax.sharding.NamedSharding(self._mesh, P(None))
+    self.logits_spec = nn.logical_to_mesh_axes(
+        ("activation_embed_and_logits_batch", "activation_length", "activation_vocab"), config.logical_axis_rules
+    )
 
     self.abstract_params = None
     self.kv_cache_annotations = None
@@ -105,6 +126,13 @@ class MaxEngine(engine_api.Engine):
     self.kv_cache_shardings = None
     self.state_mesh_annotations = None
 
+    # Seconds spent in every startup phase, reported by load_params.
+    self.startup_timings = {}
+
+    self.prefix_cache = None
+    if config.enable_prefix_caching:
+      self.prefix_cache = prefix_cache.PrefixCache(config.prefix_caching_max_entries, config.prefix_caching_block_size)
+
   def load_params(self, *args, rng: Optional[jax.random.PRNGKey] = None, **kwargs) -> Params:
     """Load Parameters, typically from GCS"""
     # pylint: disable=unused-argument
@@ -117,7 +145,12 @@ class MaxEngine(engine_api.Engine):
       self.model.quant.quant_mode = quantizations.get_quant_mode("serve")
 
     rng1, rng2, rng3 = jax.random.split(rng, 3)
-    state, self.state_mesh_annotations = max_utils.setup_decode_state(self.model, self.config, rng1, self._mesh, None)
+    load_start = time.time()
+    if self.config.compile_during_restore:
+      state = self._restore_while_compiling(rng1, rng2)
+    else:
+      state, self.state_mesh_annotations = max_utils.setup_decode_state(self.model, self.config, rng1, self._mesh, None)
+      self.startup_timings["restore"] = time.time() - load_start
     # pylint: disable=isinstance-second-argument-not-valid-type
     self.abstract_params = jax.tree_util.tree_map(
         lambda x: jax.ShapeDtypeStruct(shape=x.shape, dtype=x.dtype, sharding=x.sharding)
@@ -131,12 +164,95 @@ class MaxEngine(engine_api.Engine):
     )
 
     if self.model.quant and not self.config.checkpoint_is_quantized:
+      quantize_start = time.time()
       params = self.quantize_params(state, rng3)
+      self.startup_timings["quantize"] = time.time() - quantize_start
     else:
       params = state.params
+    self.startup_timings["load_params"] = time.time() - load_start
+    max_logging.log(f"Startup phases (s): {self.startup_timings}")
     max_utils.print_mem_stats("After load_params")
     return params
 
+  def _restore_while_compiling(self, restore_rng: jax.random.PRNGKey, cache_rng: jax.random.PRNGKey) -> Any:
+    """Restores the decode state on a background thread, meanwhile compiling prefill for every bucket,
+    insert and generate from the abstract params.
+
+    The compiled executables land in the jit caches of prefill, insert and generate, so that the first calls
+    with matching shapes and shardings, e.g. JetStream's warmup, skip compilation.
+    """
+    start = time.time()
+    abstract_state, self.state_mesh_annotations, _ = max_utils.get_abstract_state(
+        self.model, None, self.config, restore_rng, self._mesh, False
+    )
+    self.abstract_params = abstract_state.params
+    self.kv_cache_annotations = max_utils.get_kv_cache_annotations(self.model, self.config, cache_rng, self._mesh)
+    self.kv_cache_shardings = jax.tree_util.tree_map(
+        lambda x: jax.sharding.NamedSharding(self._mesh, x), self.kv_cache_annotations
+    )
+    self.startup_timings["abstract_shapes"] = time.time() - start
+
+    def restore():
+      restore_start = time.time()
+      state, _ = max_utils.setup_decode_state(self.model, self.config, restore_rng, self._mesh, None)
+      self.startup_timings["restore"] = time.time() - restore_start
+      return state
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      restored_state = executor.submit(restore)
+      if self.model.quant and not self.config.checkpoint_is_quantized:
+        # Quantizing at load changes the params tree, which is only known after the restore.
+        max_logging.log("compile_during_restore: not compiling during restore, the params are quantized after it.")
+      else:
+        self.compile_from_abstract_params()
+      state = restored_state.result()
+    self.startup_timings["restore_and_compile"] = time.time() - start
+    return state
+
+  def compile_from_abstract_params(self, prefill_lengths: Optional[list[int]] = None) -> None:
+    """Compiles prefill for every length of prefill_lengths, insert and generate, before the params exist.
+
+    Calls are lowered the way JetStream makes them, so the executables are reused once the params arrive.
+    prefill_lengths defaults to the JetStream prefill buckets up to max_prefill_predict_length.
+    """
+    if prefill_lengths is None:
+      max_prefill = self.config.max_prefill_predict_length
+      prefill_lengths = [length for length in token_utils.DEFAULT_PREFILL_BUCKETS if length < max_prefill] + [max_prefill]
+
+    def abstract(shardings, shape_dtypes):
+      return jax.tree_util.tree_map(
+          lambda sharding, x: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=sharding), shardings, shape_dtypes
+      )
+
+    abstract_decode_state, decode_state_shardings = self._abstract_decode_state()
+    abstract_decode_state = abstract(decode_state_shardings, max_utils.unbox_logicallypartioned(abstract_decode_state))
+    for length in prefill_lengths:
+      start = time.time()
+      # The jitted methods take self as their static first argument.
+      lowered_prefill = MaxEngine._prefill_jit.lower(
+          self,
+          params=self.abstract_params,
+          existing_prefix=None,
+          padded_tokens=jax.ShapeDtypeStruct((length,), jnp.int32),
+          true_length=jax.ShapeDtypeStruct((), jnp.int32, weak_type=True),
+          sampler=None,
+          rng=None,
+          sampling_params=None,
+      )
+      compiled_prefill = lowered_prefill.compile()
+      self.startup_timings[f"compile_prefill_{length}"] = time.time() - start
+
+      start = time.time()
+      abstract_prefix = abstract(compiled_prefill.output_shardings, lowered_prefill.out_info)[0]
+      MaxEngine.insert.lower(
+          self, abstract_prefix, abstract_decode_state, slot=jax.ShapeDtypeStruct((), jnp.int32, weak_type=True)
+      ).compile()
+      self.startup_timings[f"compile_insert_{length}"] = time.time() - start
+
+    start = time.time()
+    MaxEngine.generate.lower(self, self.abstract_params, abstract_decode_state).compile()
+    self.startup_timings["compile_generate"] = time.time() - start
+
   def quantize_params(self, state, rng: Optional[jax.random.PRNGKey] = None):
     """Forward pass to quantize decode params."""
     if rng is None:
@@ -169,72 +285,259 @@ class MaxEngine(engine_api.Engine):
     self.model.quant.quant_mode = quantizations.get_quant_mode("serve")
     return params
 
-  @functools.partial(jax.jit, static_argnums=(0,))
   def prefill(
       self,
       *,
       params: Params,
-      existing_prefix: Optional[jax.Array] = None,
+      existing_prefix: Optional[Prefix] = None,
       padded_tokens: jax.Array,
       true_length: int,
       sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
       rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict[str, Any]] = None,
   ) -> Tuple[Prefix, engine_api.ResultTokens]:
     """Computes a kv-cache for a new generate request.
 
     Args:
       params: Scalar multiplier.
       existing_prefix: If provided, represents a prefix that has already been
-        processed by the underlying model.
+        processed by the underlying model. The padded tokens must fit in the
+        prefill cache after it.
       padded_tokens: Logically appended tokens to any existing prefix, this is
         what we compute prefill on.
       true_length: The real length of the tokens, pre-pad.
+      sampling_params: With decode_sampling_per_slot, overrides of the config's
+        temperature, top_k, top_p and greedy for this request. They are kept
+        in the prefix and move into the slot on insert.
     Returns:
       kv_cache: For the resulting text.
     """
-    if existing_prefix:
-      raise ValueError("We don't know what to do with existing_prefix")
+    if (
+        existing_prefix is not None
+        or (self.prefix_cache is None and self.config.prefill_chunk_size <= 0)
+        or isinstance(padded_tokens, jax.core.Tracer)
+        or isinstance(true_length, jax.core.Tracer)
+    ):
+      return self._prefill_jit(
+          params=params,
+          existing_prefix=existing_prefix,
+          padded_tokens=padded_tokens,
+          true_length=true_length,
+          sampler=sampler,
+          rng=rng,
+          sampling_params=sampling_params,
+      )
+
+    tokens = jax.device_get(padded_tokens)[: int(true_length)].tolist()
+    matched_length, cached_prefix = 0, None
+    if self.prefix_cache is not None:
+      matched_length, cached_prefix = self.prefix_cache.lookup(tokens)
+
+    if cached_prefix is None and (self.config.prefill_chunk_size <= 0 or len(tokens) <= self.config.prefill_chunk_size):
+      # Called exactly as compile_from_abstract_params lowers it, so that the precompiled executable is reused.
+      prefix, result = self._prefill_jit(
+          params=params,
+          existing_prefix=None,
+          padded_tokens=padded_tokens,
+          true_length=true_length,
+          sampler=sampler,
+          rng=rng,
+          sampling_params=sampling_params,
+      )
+    else:
+      if cached_prefix is not None:
+        cached_prefix = self._truncate_prefix(cached_prefix, matched_length)
+      for prefix, result in self._prefill_pieces(
+          params,
+          cached_prefix,
+          tokens[matched_length:],
+          matched_length,
+          padded_tokens.dtype,
+          sampler,
+          rng,
+          sampling_params,
+      ):
+        pass
+
+    if self.prefix_cache is not None and tokens not in self.prefix_cache:
+      # insert() donates the prefix, so the cache keeps its own copy.
+      self.prefix_cache.insert(tokens, jax.tree_util.tree_map(jnp.copy, prefix))
+    return prefix, result
+
+  def prefill_chunks(
+      self,
+      *,
+      params: Params,
+      existing_prefix: Optional[Prefix] = None,
+      padded_tokens: jax.Array,
+      true_length: int,
+      sampler: Optional[Callable[[Any], Any]] = None,
+      rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict[str, Any]] = None,
+  ) -> Iterator[Tuple[Prefix, engine_api.ResultTokens]]:
+    """Prefills a prompt prefill_chunk_size tokens at a time.
+
+    The prefix and result are yielded after every chunk, so that a caller can run generate steps
+    between the chunks of a long prompt. Every chunk continues from the previous prefix, so only the
+    last yielded pair holds the prefill of the whole prompt and should be inserted.
+    """
+    start_position = 0 if existing_prefix is None else int(jax.device_get(existing_prefix["next_pos"])[0, 0])
+    tokens = jax.device_get(padded_tokens)[: int(true_length)].tolist()
+    yield from self._prefill_pieces(
+        params, existing_prefix, tokens, start_position, padded_tokens.dtype, sampler, rng, sampling_params
+    )
+
+  def _prefill_pieces(
+      self,
+      params: Params,
+      existing_prefix: Optional[Prefix],
+      tokens: list[int],
+      start_position: int,
+      dtype: jnp.dtype,
+      sampler: Optional[Callable[[Any], Any]],
+      rng: Optional[jax.random.PRNGKey],
+      sampling_params: Optional[dict[str, Any]],
+  ) -> Iterator[Tuple[Prefix, engine_api.ResultTokens]]:
+    """Prefills tokens after existing_prefix in chunks of prefill_chunk_size, or in a single power of two
+    bucket when chunking is disabled, yielding the prefix and result after each one."""
+    max_prefill_length = self.config.max_prefill_predict_length
+    if start_position + len(tokens) > max_prefill_length:
+      raise ValueError(f"Prompt of {start_position + len(tokens)} tokens doesn't fit in {max_prefill_length=}")
+
+    prefix = existing_prefix
+    while tokens:
+      if self.config.prefill_chunk_size > 0:
+        padded_length = self.config.prefill_chunk_size
+      else:
+        padded_length = 1 << (len(tokens) - 1).bit_length()
+      padded_length = min(padded_length, max_prefill_length - start_position)
+      chunk, tokens = tokens[:padded_length], tokens[padded_length:]
+      prefix, result = self._prefill_jit(
+          params=params,
+          existing_prefix=prefix,
+          padded_tokens=jnp.zeros((padded_length,), dtype=dtype).at[: len(chunk)].set(chunk),
+          true_length=len(chunk),
+          sampler=sampler,
+          rng=rng,
+          sampling_params=sampling_params,
+      )
+      start_position += len(chunk)
+      yield prefix, result
+
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def _truncate_prefix(self, prefix: Prefix, length: int) -> Prefix:
+    """Drops every cached token of prefix from position length onwards."""
+
+    def truncate(path, x):
+      if path[-1].key != "cache_prefill_segment_id":
+        return x
+      is_boxed = isinstance(x, flax.linen.spmd.LogicallyPartitioned)
+      segment_ids = x.unbox() if is_boxed else x
+      segment_ids = jnp.where(jnp.arange(segment_ids.shape[-1]) < length, segment_ids, 0)
+      return x.replace_boxed(segment_ids) if is_boxed else segment_ids
+
+    cache = jax.tree_util.tree_map_with_path(
+        truncate, prefix["cache"], is_leaf=lambda k: isinstance(k, flax.linen.spmd.LogicallyPartitioned)
+    )
+    return prefix | {"cache": cache, "next_pos": jnp.full((1, 1), length, dtype=jnp.int32)}
+
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def _prefill_jit(
+      self,
+      *,
+      params: Params,
+      existing_prefix: Optional[Prefix] = None,
+      padded_tokens: jax.Array,
+      true_length: int,
+      sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
+      rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict[str, Any]] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Jitted prefill, continuing from existing_prefix when one is given."""
+    return self._prefill_rows(
+        params,
+        existing_prefix,
+        jnp.expand_dims(padded_tokens, 0),
+        jnp.full((1,), true_length, dtype=jnp.int32),
+        rng,
+        sampling_params,
+    )
+
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def prefill_batch(
+      self,
+      *,
+      params: Params,
+      padded_tokens: jax.Array,
+      true_lengths: jax.Array,
+      sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
+      rng: Optional[jax.random.PRNGKey] = None,
+      sampling_params: Optional[dict[str, Any]] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Computes kv-caches for several new generate requests in one model call.
+
+    Args:
+      params: Scalar multiplier.
+      padded_tokens: [num_prompts, padded_length] prompts, padded to a shared length.
+      true_lengths: [num_prompts] real lengths of the prompts, pre-pad.
+      sampling_params: With decode_sampling_per_slot, overrides of the config's
+        sampling parameters, either scalars or [num_prompts] arrays.
+    Returns:
+      kv_cache: Prefix holding one row per prompt, to be placed into slots with insert_batch.
+    """
+    return self._prefill_rows(params, None, padded_tokens, true_lengths, rng, sampling_params)
 
+  def _prefill_rows(
+      self,
+      params: Params,
+      existing_prefix: Optional[Prefix],
+      input_tokens: jax.Array,
+      true_lengths: jax.Array,
+      rng: Optional[jax.random.PRNGKey],
+      sampling_params: Optional[dict[str, Any]] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Prefills every row of input_tokens [BATCH, SEQUENCE], which holds true_lengths [BATCH] real tokens."""
     if rng is None:
       rng = jax.random.PRNGKey(0)
 
-    input_tokens = jnp.expand_dims(padded_tokens, 0)  # [BATCH, SEQUENCE]
-    positions = jnp.expand_dims(jnp.arange(0, input_tokens.shape[1]), 0)
+    batch_size, padded_length = input_tokens.shape
+    if existing_prefix is None:
+      start_positions = jnp.zeros((batch_size, 1), dtype=jnp.int32)
+      model_mode = common_types.MODEL_MODE_PREFILL
+      model_vars = params
+    else:
+      start_positions = existing_prefix["next_pos"]
+      model_mode = common_types.MODEL_MODE_PREFILL_CONTINUATION
+      model_vars = params | {"cache": existing_prefix["cache"]}
 
-    zero_to_n = jnp.arange(0, padded_tokens.shape[0])
-    ones_to_keep = zero_to_n < true_length
-    one_d_output = ones_to_keep * common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
-    sequence_indicator = jnp.expand_dims(one_d_output, 0)
+    zero_to_n = jnp.expand_dims(jnp.arange(0, padded_length), 0)
+    positions = zero_to_n + start_positions
+    ones_to_keep = zero_to_n < jnp.expand_dims(true_lengths, 1)
+    sequence_indicator = ones_to_keep * common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR
 
     rng, new_rng = jax.random.split(rng)
     with self._mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
       flat_logits, new_vars = self.model.apply(
-          params,
+          model_vars,
           input_tokens,
           positions,
           decoder_segment_ids=sequence_indicator,
           enable_dropout=False,
-          model_mode=common_types.MODEL_MODE_PREFILL,
+          model_mode=model_mode,
           rngs={"params": new_rng},
           mutable=["cache"],
       )
 
-    next_pos = jnp.full((1, 1), true_length, dtype=jnp.int32)
-    generated_tokens = jnp.zeros((1, 1), dtype=jnp.int32)
-    selected_logits = jax.lax.dynamic_slice(
-        flat_logits, (0, true_length - 1, 0), (flat_logits.shape[0], 1, flat_logits.shape[2])
-    )
-    selected_logits = jax.lax.with_sharding_constraint(selected_logits, self.replicated_sharding)
+    next_pos = (start_positions + jnp.expand_dims(true_lengths, 1)).astype(jnp.int32)
+    generated_tokens = jnp.zeros((batch_size, 1), dtype=jnp.int32)
+    selected_logits = jnp.take_along_axis(flat_logits, (true_lengths - 1)[:, None, None], axis=1)
+    selected_logits = self._constrain_logits(selected_logits)
 
     # sampling first token
-    first_generated_token = inference_utils.sampling(
-        selected_logits,
-        rng,
-        self.config.decode_sampling_strategy,
-        topk=self.config.decode_sampling_top_k,
-        nucleus_topp=self.config.decode_sampling_nucleus_p,
-        temperature=self.config.decode_sampling_temperature,
-    )
+    slot_sampling_params = None
+    if self.config.decode_sampling_per_slot:
+      slot_sampling_params = self._slot_sampling_params(batch_size, sampling_params)
+    first_generated_token = self._sample(selected_logits, rng, slot_sampling_params)
 
     all_valid = jnp.ones(first_generated_token.shape, dtype=jnp.int8)
     result = engine_api.ResultTokens(
@@ -250,13 +553,80 @@ class MaxEngine(engine_api.Engine):
         samples_per_slot=1,
     )
 
-    return {
-        "logits": selected_logits,
+    prefix = self._kept_logits(selected_logits) | {
         "cache": new_vars["cache"],
         "next_pos": next_pos,
         "generated_tokens": generated_tokens,
         "tokens": first_generated_token,
-    }, result
+    }
+    if slot_sampling_params is not None:
+      prefix["sampling"] = slot_sampling_params
+    return prefix, result
+
+  def _constrain_logits(self, logits: jax.Array) -> jax.Array:
+    """Replicates logits for sampling, unless decode_sharded_sampling keeps them sharded over the vocab."""
+    if self.config.decode_sharded_sampling:
+      return jax.lax.with_sharding_constraint(logits, jax.sharding.NamedSharding(self._mesh, self.logits_spec))
+    return jax.lax.with_sharding_constraint(logits, self.replicated_sharding)
+
+  def _kept_logits(self, logits: jax.Array) -> dict[str, Any]:
+    """What the prefix and decode state keep of logits [batch, 1, vocab]: the logits themselves, unless
+    decode_sharded_sampling drops them, and the top decode_num_top_logprobs log probabilities."""
+    kept = {}
+    if not self.config.decode_sharded_sampling:
+      kept["logits"] = logits
+    if self.config.decode_num_top_logprobs > 0:
+      top_k_fn = jax.lax.top_k
+      if self.config.decode_sharded_sampling:
+        top_k_fn = functools.partial(inference_utils.sharded_top_k, mesh=self._mesh, logits_spec=self.logits_spec)
+      values, tokens = inference_utils.top_logprobs(logits, self.config.decode_num_top_logprobs, top_k_fn)
+      kept["logprobs"] = {"values": values, "tokens": tokens}
+    return kept
+
+  def _slot_sampling_params(self, batch_size: int, sampling_params: Optional[dict[str, Any]] = None) -> dict[str, jax.Array]:
+    """Per slot sampling parameters of shape [batch_size]: the config's, overridden by sampling_params."""
+    strategy = self.config.decode_sampling_strategy
+    slot_sampling_params = {
+        "temperature": self.config.decode_sampling_temperature,
+        "top_k": self.config.decode_sampling_top_k if strategy == "topk" else 0,
+        "top_p": self.config.decode_sampling_nucleus_p if strategy == "nucleus" else 1.0,
+        "greedy": strategy == "greedy",
+    }
+    if sampling_params is not None:
+      if unknown := set(sampling_params) - set(slot_sampling_params):
+        raise ValueError(f"Unknown sampling parameters {unknown}, expected some of {list(slot_sampling_params)}")
+      slot_sampling_params |= sampling_params
+    dtypes = {"temperature": jnp.float32, "top_k": jnp.int32, "top_p": jnp.float32, "greedy": jnp.bool_}
+    return {
+        name: jnp.broadcast_to(jnp.asarray(value, dtype=dtypes[name]), (batch_size,))
+        for name, value in slot_sampling_params.items()
+    }
+
+  def _sample(self, logits: jax.Array, rng: jax.random.PRNGKey, slot_sampling_params: Optional[dict[str, jax.Array]]):
+    """Samples with the per slot parameters when given, otherwise with the config's sampling strategy."""
+    if self.config.decode_sharded_sampling:
+      if slot_sampling_params is not None:
+        return inference_utils.sample_per_slot_sharded(logits, rng, self._mesh, self.logits_spec, **slot_sampling_params)
+      return inference_utils.sampling_sharded(
+          logits,
+          rng,
+          self.config.decode_sampling_strategy,
+          self._mesh,
+          self.logits_spec,
+          topk=self.config.decode_sampling_top_k,
+          nucleus_topp=self.config.decode_sampling_nucleus_p,
+          temperature=self.config.decode_sampling_temperature,
+      )
+    if slot_sampling_params is not None:
+      return inference_utils.sample_per_slot(logits, rng, **slot_sampling_params)
+    return inference_utils.sampling(
+        logits,
+        rng,
+        self.config.decode_sampling_strategy,
+        topk=self.config.decode_sampling_top_k,
+        nucleus_topp=self.config.decode_sampling_nucleus_p,
+        temperature=self.config.decode_sampling_temperature,
+    )
 
   @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(2,))
   def generate(
@@ -266,10 +636,160 @@ class MaxEngine(engine_api.Engine):
       sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
       rng: Optional[jax.random.PRNGKey] = None,
   ) -> Tuple[DecodeState, engine_api.ResultTokens]:
-    """Run one generate step"""
+    """Run one generate step
+
+    With paged_ar_cache the pages of the slots which filled their ar cache or hit a page fault are released, as
+    generate doesn't know when a slot is done otherwise, see release.
+    """
     if rng is None:
       rng = jax.random.PRNGKey(0)
+    decode_state, result = self._generate_step(params, decode_state, rng)
+    if self.config.paged_ar_cache:
+      max_generated_tokens = self.config.max_target_length - self.config.max_prefill_predict_length
+      released = (decode_state["generated_tokens"][:, 0] >= max_generated_tokens) | self.page_faults(decode_state["cache"])
+      decode_state = decode_state | {"cache": self.release_slots(decode_state["cache"], released)}
+    return decode_state, result
+
+  @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(1,))
+  def release(self, decode_state: DecodeState, released: jax.Array) -> DecodeState:
+    """Frees the pages of the paged ar cache held by the released [batch] slots, e.g. once the caller saw them
+    finish, so they don't keep allocating pages until they are inserted into again."""
+    return decode_state | {"cache": self.release_slots(decode_state["cache"], released)}
+
+  @functools.partial(jax.jit, static_argnums=(0, 3), donate_argnums=(2,))
+  def generate_n(
+      self,
+      params: Params,
+      decode_state: DecodeState,
+      n: int,
+      eos_id: int = -1,
+      rng: Optional[jax.random.PRNGKey] = None,
+  ) -> Tuple[DecodeState, jax.Array, jax.Array]:
+    """Run n generate steps on device.
 
+    A slot is done once it has sampled eos_id or filled its ar cache, and stops advancing from then on. With
+    paged_ar_cache the pages of the done slots are released after every step, so the other slots can allocate
+    them, and a slot which hit a page fault is done as well.
+
+    Returns:
+      decode_state, tokens [n, batch] sampled at every step and done [n, batch] marking the slots which
+      were done after every step. A slot's token at step i is part of its output unless the slot was
+      already done after step i - 1.
+    """
+    if rng is None:
+      rng = jax.random.PRNGKey(0)
+    max_generated_tokens = self.config.max_target_length - self.config.max_prefill_predict_length
+
+    def keep_done(done, path, new_cache, old_cache, annotations):
+      if path[-1].key not in ("cached_ar_lengths", "cache_ar_segment_id"):
+        return new_cache  # the tokens written past a done slot's length are masked out.
+      shape = [1] * new_cache.ndim
+      shape[annotations.index("cache_batch")] = -1
+      return jnp.where(jnp.reshape(done, shape), old_cache, new_cache)
+
+    def step(carry, step_rng):
+      decode_state, done = carry
+      new_state, _ = self._generate_step(params, decode_state, step_rng)
+      # Done slots stop advancing, they keep their position, last token and ar cache length.
+      decode_state = new_state | {
+          "cache": jax.tree_util.tree_map_with_path(
+              functools.partial(keep_done, done), new_state["cache"], decode_state["cache"], self.kv_cache_annotations_named
+          ),
+          **{
+              key: jnp.where(done[:, None], decode_state[key], new_state[key])
+              for key in ("next_pos", "generated_tokens", "tokens")
+          },
+      }
+      new_token = decode_state["tokens"][:, 0]
+      done = done | (new_token == eos_id) | (decode_state["generated_tokens"][:, 0] >= max_generated_tokens)
+      if self.config.paged_ar_cache:
+        done = done | self.page_faults(decode_state["cache"])
+        decode_state = decode_state | {"cache": self.release_slots(decode_state["cache"], done)}
+      return (decode_state, done), (new_token, done)
+
+    done = jnp.zeros(decode_state["tokens"].shape[:1], dtype=jnp.bool_)
+    (decode_state, _), (tokens, done) = jax.lax.scan(step, (decode_state, done), jax.random.split(rng, n))
+    return decode_state, tokens, done
+
+  def autoregressive_chunk(
+      self,
+      params: Params,
+      cache: Any,
+      tokens: jax.Array,
+      positions: jax.Array,
+      rng: jax.random.PRNGKey,
+  ) -> Tuple[jax.Array, Any]:
+    """Runs tokens [batch, s] at positions [batch, s] through the model, appending them to every slot's
+    tokens in the ar cache.
+
+    Returns:
+      logits [batch, s, vocab] and the updated cache.
+    """
+    with self._mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
+      logits, new_vars = self.model.apply(
+          params | {"cache": cache},
+          tokens,
+          positions,
+          enable_dropout=False,
+          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE_CHUNK,
+          rngs={"params": rng},
+          mutable=["cache"],
+      )
+    return logits, jax.lax.with_sharding_constraint(new_vars["cache"], self.kv_cache_shardings)
+
+  def truncate_ar_cache(self, cache: Any, lengths: jax.Array) -> Any:
+    """Rolls every slot of the ar cache back to its first lengths [batch] tokens."""
+
+    def truncate(path, x):
+      path_key = path[-1].key
+      if path_key == "cached_ar_lengths":
+        return jnp.broadcast_to(lengths, x.shape).astype(x.dtype)
+      elif path_key == "cache_ar_segment_id":
+        return jnp.where(jnp.arange(x.shape[-1]) < lengths[:, None], x, 0)
+      return x
+
+    return jax.tree_util.tree_map_with_path(truncate, cache)
+
+  def release_slots(self, cache: Any, released: jax.Array) -> Any:
+    """Returns the pages of the paged ar cache held by the released [batch] slots to the free pool.
+
+    The released slots stop allocating pages until they are inserted into again.
+    """
+
+    def release(path, x):
+      path_key = path[-1].key
+      if path_key == "cache_ar_page_owner":
+        return jnp.where((x > 0) & released[jnp.maximum(x - 1, 0)], 0, x)
+      elif path_key == "cache_ar_page_table":
+        return jnp.where(released[:, None], 0, x)
+      elif path_key == "cache_ar_slot_active":
+        return jnp.where(released, 0, x)
+      return x
+
+    return jax.tree_util.tree_map_with_path(release, cache)
+
+  def page_faults(self, cache: Any) -> jax.Array:
+    """Returns [batch] marking the slots which needed a page of the paged ar cache when the pool had none free.
+
+    Their tokens past that point are missing from the cache, so their output is not valid anymore.
+    """
+
+    def fault(path, x, annotations):
+      if path[-1].key != "cache_ar_page_fault":
+        return None
+      x = jnp.moveaxis(x, annotations.index("cache_batch"), 0)
+      return jnp.any(jnp.reshape(x, (x.shape[0], -1)) > 0, axis=1)
+
+    faults = jax.tree_util.tree_leaves(jax.tree_util.tree_map_with_path(fault, cache, self.kv_cache_annotations_named))
+    return functools.reduce(jnp.logical_or, faults)
+
+  def _generate_step(
+      self,
+      params: Params,
+      decode_state: DecodeState,
+      rng: jax.random.PRNGKey,
+  ) -> Tuple[DecodeState, engine_api.ResultTokens]:
+    """One generate step, shared by generate and generate_n."""
     previous_token = decode_state["tokens"]
 
     rng, new_rng = jax.random.split(rng)
@@ -285,22 +805,17 @@ class MaxEngine(engine_api.Engine):
           mutable=["cache"],
       )
 
-    out_logits = jax.lax.with_sharding_constraint(out_logits, self.replicated_sharding)
+    out_logits = self._constrain_logits(out_logits)
     new_cache = jax.lax.with_sharding_constraint(new_vars["cache"], self.kv_cache_shardings)
 
     # sampling tokens
-    new_token = inference_utils.sampling(
-        out_logits,
-        rng,
-        self.config.decode_sampling_strategy,
-        topk=self.config.decode_sampling_top_k,
-        nucleus_topp=self.config.decode_sampling_nucleus_p,
-        temperature=self.config.decode_sampling_temperature,
-    )
+    new_token = self._sample(out_logits, rng, decode_state.get("sampling"))
 
-    all_valid = jnp.ones(new_token.shape, dtype=jnp.int8)
+    valid = jnp.ones(new_token.shape, dtype=jnp.int8)
+    if self.config.paged_ar_cache:
+      valid = jnp.where(self.page_faults(new_cache)[:, None], 0, valid).astype(jnp.int8)
     result = engine_api.ResultTokens(
-        data=jnp.concatenate((new_token, all_valid, decode_state["generated_tokens"]), axis=1),
+        data=jnp.concatenate((new_token, valid, decode_state["generated_tokens"]), axis=1),
         # Tokens are shape [batch, speculations], so when we concatenate
         # tokens, validity and length along their index 1 dimension then they
         # occupy 0:speculations.
@@ -312,13 +827,17 @@ class MaxEngine(engine_api.Engine):
         samples_per_slot=1,
     )
 
-    return {
-        "logits": out_logits,
-        "cache": new_cache,
-        "next_pos": decode_state["next_pos"] + 1,
-        "generated_tokens": decode_state["generated_tokens"] + 1,
-        "tokens": new_token,
-    }, result
+    return (
+        decode_state
+        | self._kept_logits(out_logits)
+        | {
+            "cache": new_cache,
+            "next_pos": decode_state["next_pos"] + 1,
+            "generated_tokens": decode_state["generated_tokens"] + 1,
+            "tokens": new_token,
+        },
+        result,
+    )
 
   @functools.partial(
       jax.jit,
@@ -335,12 +854,69 @@ class MaxEngine(engine_api.Engine):
       slot: int,
   ) -> DecodeState:
     """Insert into KV cache"""
-    unboxed_prefix = max_utils.unbox_logicallypartioned(prefix)
+    return self._insert_rows(max_utils.unbox_logicallypartioned(prefix), decode_state, slot)
+
+  @functools.partial(
+      jax.jit,
+      static_argnums=(0,),
+      donate_argnums=(
+          1,
+          2,
+      ),
+  )
+  def insert_batch(
+      self,
+      prefix: Prefix,
+      decode_state: DecodeState,
+      slots: jax.Array,
+  ) -> DecodeState:
+    """Inserts every row of a prefix from prefill_batch into KV cache, row i going to slots[i]"""
+    return self._insert_rows(max_utils.unbox_logicallypartioned(prefix), decode_state, slots)
+
+  def _write_rows(self, full: jax.Array, rows: jax.Array, slots: jax.Array | int, batch_idx: int) -> jax.Array:
+    """Writes rows into full, row i of batch axis batch_idx going to slots[i], or the single row to slot.
+
+    Along the other axes the rows are written at the start of full, which may be longer.
+    """
+    rows = rows.astype(full.dtype)
+    if jnp.ndim(slots) == 0:
+      start_indices = [0] * full.ndim
+      start_indices[batch_idx] = slots
+      return jax.lax.dynamic_update_slice(full, rows, start_indices)
+    index = tuple(slots if axis == batch_idx else slice(0, rows.shape[axis]) for axis in range(full.ndim))
+    return full.at[index].set(rows)
+
+  def _insert_rows(
+      self,
+      unboxed_prefix: Prefix,
+      decode_state: DecodeState,
+      slots: jax.Array | int,
+  ) -> DecodeState:
+    """Copies the rows of an unboxed prefix into decode_state, row i going to slots[i], or a single row
+    prefix to slot, with a single update of every leaf."""
+    num_rows = unboxed_prefix["tokens"].shape[0]
 
     def copy(path, partial_cache, full_cache, annotations):
       path_key = path[-1].key
-      if path_key in ["cache_ar_index", "cached_ar_key", "cached_ar_value", "cached_ar_key_scale", "cached_ar_value_scale"]:
+      prompt_in_ar_cache = self.config.unified_kv_cache and path_key in [
+          "cached_ar_key",
+          "cached_ar_value",
+          "cached_ar_key_scale",
+          "cached_ar_value_scale",
+      ]
+      if not prompt_in_ar_cache and path_key in [
+          "cache_ar_index",
+          "cached_ar_key",
+          "cached_ar_value",
+          "cached_ar_key_scale",
+          "cached_ar_value_scale",
+          "cached_ar_key_pages",
+          "cached_ar_value_pages",
+      ]:
         return full_cache  # we don't even zero these out because we can mask them out.
+      elif path_key == "cache_ar_page_owner":
+        ### return the pages held by the previous occupants of these slots to the pool
+        return jnp.where(jnp.isin(full_cache, jnp.reshape(slots, (-1,)) + 1), 0, full_cache)
 
       batch_idx = -1
       if "cache_batch" in annotations:
@@ -351,56 +927,144 @@ class MaxEngine(engine_api.Engine):
       if batch_idx < 0:
         raise ValueError(f"Batch index {batch_idx=} shouldn't be less than zero for {path_key}, got {annotations=}")
 
-      if path_key == "cache_ar_segment_id":
+      s = list(full_cache.shape)
+      s[batch_idx] = num_rows
+      zeros = jnp.zeros(tuple(s), dtype=full_cache.dtype)
+
+      if prompt_in_ar_cache:
+        ### the prompt is at the start of the unified cache, past max_prefill_predict_length the prefix only holds zeros
+        if "cache_sequence" in annotations:
+          sequence_idx = annotations.index("cache_sequence")
+        else:
+          sequence_idx = annotations.index("cache_scale_sequence")
+        prompt = jax.lax.slice_in_dim(partial_cache, 0, self.config.max_prefill_predict_length, axis=sequence_idx)
+        return self._write_rows(full_cache, prompt, slots, batch_idx)
+      elif path_key == "cache_ar_segment_id" and self.config.unified_kv_cache:
+        ### masks the previous occupant's tokens past the prompt
+        return self._write_rows(full_cache, partial_cache, slots, batch_idx)
+      elif path_key in ["cache_ar_segment_id", "cache_ar_page_table"]:
         ### goal: zero this out in case there is existing data
-        s = list(full_cache.shape)
-        s[batch_idx] = 1
-        zeros = jnp.zeros(tuple(s), dtype=jnp.int32)
-        return jax.lax.dynamic_update_index_in_dim(full_cache, zeros, slot, batch_idx)
+        return self._write_rows(full_cache, zeros, slots, batch_idx)
       elif path_key == "cache_prefill_segment_id":
-        s = list(full_cache.shape)
-        s[batch_idx] = 1
-        zeros = jnp.zeros(tuple(s), dtype=jnp.int32)
         ## zero out in case prefill cache is too small to cover
-        full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, zeros, slot, batch_idx)
+        full_cache = self._write_rows(full_cache, zeros, slots, batch_idx)
         ## copy prefill cachce
-        full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slot, batch_idx)
-        return full_cache
+        return self._write_rows(full_cache, partial_cache, slots, batch_idx)
       elif path_key == "cached_ar_lengths":
-        return full_cache.at[slot].set(0)
+        ### with unified_kv_cache, decoding continues right after the prompt
+        return self._write_rows(full_cache, partial_cache if self.config.unified_kv_cache else zeros, slots, batch_idx)
+      elif path_key == "cache_ar_slot_active":
+        return self._write_rows(full_cache, jnp.ones_like(zeros), slots, batch_idx)
+      elif path_key == "cache_ar_page_fault":
+        return self._write_rows(full_cache, zeros, slots, batch_idx)
       elif path_key in [
           "cached_prefill_key",
           "cached_prefill_value",
           "cached_prefill_key_scale",
           "cached_prefill_value_scale",
       ]:
-        return jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slot, batch_idx)
+        return self._write_rows(full_cache, partial_cache, slots, batch_idx)
       else:
         raise ValueError(f"We don't have a strategy for inserting {path_key}")
 
     inserted_cache = jax.tree_util.tree_map_with_path(
         copy, unboxed_prefix["cache"], decode_state["cache"], self.kv_cache_annotations_named
     )
-    inserted_logits = jax.lax.dynamic_update_index_in_dim(decode_state["logits"], unboxed_prefix["logits"], slot, 0)
-    inserted_next_pos = jax.lax.dynamic_update_index_in_dim(decode_state["next_pos"], unboxed_prefix["next_pos"], slot, 0)
-    inserted_generated_tokens = jax.lax.dynamic_update_index_in_dim(
-        decode_state["generated_tokens"], unboxed_prefix["generated_tokens"], slot, 0
+    inserted_next_pos = self._write_rows(decode_state["next_pos"], unboxed_prefix["next_pos"], slots, 0)
+    inserted_generated_tokens = self._write_rows(
+        decode_state["generated_tokens"], unboxed_prefix["generated_tokens"], slots, 0
     )
-    inserted_tokens = jax.lax.dynamic_update_index_in_dim(decode_state["tokens"], unboxed_prefix["tokens"], slot, 0)
+    inserted_tokens = self._write_rows(decode_state["tokens"], unboxed_prefix["tokens"], slots, 0)
 
-    inserted_logits = jax.lax.with_sharding_constraint(inserted_logits, self.replicated_sharding)
     inserted_generated_tokens = jax.lax.with_sharding_constraint(inserted_generated_tokens, self.replicated_sharding)
     inserted_next_pos = jax.lax.with_sharding_constraint(inserted_next_pos, self.replicated_sharding)
     inserted_tokens = jax.lax.with_sharding_constraint(inserted_tokens, self.replicated_sharding)
     inserted_cache = jax.lax.with_sharding_constraint(inserted_cache, self.kv_cache_shardings)
 
-    return {
-        "logits": inserted_logits,
+    inserted_state = {
         "cache": inserted_cache,
         "next_pos": inserted_next_pos,
         "generated_tokens": inserted_generated_tokens,
         "tokens": inserted_tokens,
     }
+    if "logits" in decode_state:
+      inserted_logits = self._write_rows(decode_state["logits"], unboxed_prefix["logits"], slots, 0)
+      inserted_state["logits"] = jax.lax.with_sharding_constraint(inserted_logits, self.replicated_sharding)
+    for key in ("sampling", "logprobs"):
+      if key in decode_state:
+        inserted_state[key] = jax.tree_util.tree_map(
+            lambda full, partial: self._write_rows(full, partial, slots, 0),
+            decode_state[key],
+            unboxed_prefix[key],
+        )
+    return inserted_state
+
+  def offload_slot(self, decode_state: DecodeState, slot: int) -> SlotState:
+    """Copies everything decode_state holds for slot, its kv cache rows included, to pinned host memory.
+
+    The copy is asynchronous and the slot can be reused by insert right away. Pass the result to
+    prefetch_slot ahead of time and then to restore_slot to resume the sequence in any free slot,
+    without prefilling it again.
+    """
+    if self.config.paged_ar_cache:
+      raise ValueError("Offloading slots isn't supported with paged_ar_cache, whose pages are shared across slots.")
+    slot_state = self._slot_row(decode_state, slot)
+    host_shardings = jax.tree_util.tree_map(lambda x: x.sharding.with_memory_kind("pinned_host"), slot_state)
+    return jax.device_put(slot_state, host_shardings)
+
+  def prefetch_slot(self, slot_state: SlotState) -> SlotState:
+    """Starts the asynchronous copy of an offloaded slot back to device memory."""
+    device_shardings = jax.tree_util.tree_map(lambda x: x.sharding.with_memory_kind("device"), slot_state)
+    return jax.device_put(slot_state, device_shardings)
+
+  def restore_slot(self, slot_state: SlotState, decode_state: DecodeState, slot: int) -> DecodeState:
+    """Writes a slot offloaded by offload_slot into slot of decode_state, prefetching it if that hasn't
+    been done yet."""
+    if any(x.sharding.memory_kind != "device" for x in jax.tree_util.tree_leaves(slot_state)):
+      slot_state = self.prefetch_slot(slot_state)
+    return self._restore_row(slot_state, decode_state, slot)
+
+  def _slot_batch_axis(self, annotations: tuple[str, ...]) -> int:
+    if "cache_batch" in annotations:
+      return annotations.index("cache_batch")
+    elif "cache_scale_batch" in annotations:
+      return annotations.index("cache_scale_batch")
+    return -1  # shared across the batch, e.g. the ar cache index.
+
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def _slot_row(self, decode_state: DecodeState, slot: int) -> SlotState:
+    """Selects slot of every entry of decode_state, keeping the batch dimension."""
+
+    def take_row(cache, annotations):
+      batch_idx = self._slot_batch_axis(annotations)
+      return cache if batch_idx < 0 else jax.lax.dynamic_slice_in_dim(cache, slot, 1, axis=batch_idx)
+
+    slot_state = {"cache": jax.tree_util.tree_map(take_row, decode_state["cache"], self.kv_cache_annotations_named)}
+    for key in decode_state:
+      if key != "cache":
+        slot_state[key] = jax.tree_util.tree_map(lambda x: jax.lax.dynamic_slice_in_dim(x, slot, 1), decode_state[key])
+    return slot_state
+
+  @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(2,))
+  def _restore_row(self, slot_state: SlotState, decode_state: DecodeState, slot: int) -> DecodeState:
+    """Copies every entry of a single slot state into slot of decode_state."""
+
+    def copy(partial_cache, full_cache, annotations):
+      batch_idx = self._slot_batch_axis(annotations)
+      return full_cache if batch_idx < 0 else jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slot, batch_idx)
+
+    restored_cache = jax.tree_util.tree_map(
+        copy, slot_state["cache"], decode_state["cache"], self.kv_cache_annotations_named
+    )
+    restored_state = {"cache": jax.lax.with_sharding_constraint(restored_cache, self.kv_cache_shardings)}
+    for key in decode_state:
+      if key != "cache":
+        restored_state[key] = jax.tree_util.tree_map(
+            lambda full, partial: jax.lax.dynamic_update_index_in_dim(full, partial, slot, 0),
+            decode_state[key],
+            slot_state[key],
+        )
+    return restored_state
 
   def get_prefix_destination_sharding(self) -> Any:
     return jax.sharding.NamedSharding(mesh=self.mesh, spec=jax.sharding.PartitionSpec())
@@ -423,7 +1087,26 @@ class MaxEngine(engine_api.Engine):
       **kwargs,  # pylint: disable=unused-argument
   ) -> DecodeState:
     """Initialises any state which a generation step transforms."""
+    start = time.time()
+    abstract_outputs, shardings = self._abstract_decode_state(rng)
+
+    @functools.partial(jax.jit, out_shardings=shardings)
+    def initialize():
+      return jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), abstract_outputs)
+
+    zeroed = max_utils.unbox_logicallypartioned(initialize())
+    if "sampling" in zeroed:
+      # every slot starts from the config's sampling parameters rather than zeros.
+      zeroed["sampling"] = jax.device_put(self._slot_sampling_params(zeroed["tokens"].shape[0]), self.replicated_sharding)
+    self.startup_timings["init_decode_state"] = time.time() - start
+    return zeroed
+
+  def _abstract_decode_state(self, rng: Optional[jax.random.PRNGKey] = None) -> Tuple[Any, Any]:
+    """Shapes and shardings of the decode state, without allocating it. Also sets kv_cache_annotations_named.
 
+    Returns:
+      the boxed abstract decode state and its shardings.
+    """
     if rng is None:
       rng = jax.random.PRNGKey(0)
 
@@ -447,13 +1130,26 @@ class MaxEngine(engine_api.Engine):
       next_pos = jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1), dtype=jnp.int32)
       generated_tokens = jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1), dtype=jnp.int32)
       tokens = jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1), dtype=jnp.int32)
-      return {
-          "logits": jnp.zeros((int(self.config.per_device_batch_size * jax.device_count()), 1, self.config.vocab_size)),
+      decode_state = {
           "cache": cache["cache"],
           "next_pos": next_pos,
           "generated_tokens": generated_tokens,
           "tokens": tokens,
       }
+      if not self.config.decode_sharded_sampling:
+        decode_state["logits"] = jnp.zeros(
+            (int(self.config.per_device_batch_size * jax.device_count()), 1, self.config.vocab_size)
+        )
+      if self.config.decode_num_top_logprobs > 0:
+        batch_size = int(self.config.per_device_batch_size * jax.device_count())
+        logprobs_shape = (batch_size, 1, self.config.decode_num_top_logprobs)
+        decode_state["logprobs"] = {
+            "values": jnp.zeros(logprobs_shape, dtype=jnp.float32),
+            "tokens": jnp.zeros(logprobs_shape, dtype=jnp.int32),
+        }
+      if self.config.decode_sampling_per_slot:
+        decode_state["sampling"] = self._slot_sampling_params(int(self.config.per_device_batch_size * jax.device_count()))
+      return decode_state
 
     with nn_partitioning.axis_rules(self.config.logical_axis_rules):
       abstract_outputs = jax.eval_shape(init, self.abstract_params)
@@ -466,19 +1162,13 @@ class MaxEngine(engine_api.Engine):
         lambda mesh_annotation: jax.sharding.NamedSharding(self._mesh, mesh_annotation), mesh_annotations
     )
 
-    @functools.partial(jax.jit, out_shardings=shardings)
-    def initialize():
-      return jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), abstract_outputs)
-
-    cache = initialize()["cache"]
-
     def is_lp(k):
       return isinstance(k, flax.linen.spmd.LogicallyPartitioned)
 
-    self.kv_cache_annotations_named = jax.tree_util.tree_map(lambda x: tuple(x.names), cache, is_leaf=is_lp)
-    del cache
-    zeroed = max_utils.unbox_logicallypartioned(initialize())
-    return zeroed
+    self.kv_cache_annotations_named = jax.tree_util.tree_map(
+        lambda x: tuple(x.names), abstract_outputs["cache"], is_leaf=is_lp
+    )
+    return abstract_outputs, shardings
 
   @property
   def max_concurrent_decodes(self) -> int:
@@ -505,6 +1195,217 @@ class MaxEngine(engine_api.Engine):
     raise NotImplementedError
 
 
+class SpeculativeMaxEngine(engine_api.Engine):
+  """Speculative decoding of a target MaxEngine with a smaller draft MaxEngine.
+
+  Every generate step the draft model proposes num_draft_tokens tokens one at a time, and the target
+  model scores all of them in one forward pass over its ar cache. Proposals are accepted by speculative
+  sampling, so the output follows the target model's distribution, and the rejected tokens are rolled
+  back from both ar caches. Each step emits between 1 and num_draft_tokens + 1 tokens per slot along the
+  speculations dimension of ResultTokens, fewer once the slot's ar cache is nearly full.
+
+  Params and decode states are dicts with a "target" and a "draft" entry. Sampling follows the target
+  config: greedy when decode_sampling_strategy is greedy, and otherwise weighted sampling at
+  decode_sampling_temperature.
+  """
+
+  def __init__(self, target: MaxEngine, draft: MaxEngine, num_draft_tokens: int):
+    if num_draft_tokens <= 0:
+      raise ValueError(f"num_draft_tokens must be positive, got {num_draft_tokens=}")
+    if target.config.vocab_size != draft.config.vocab_size:
+      raise ValueError(
+          f"Draft vocab_size {draft.config.vocab_size} doesn't match target vocab_size {target.config.vocab_size}"
+      )
+    if target.max_concurrent_decodes != draft.max_concurrent_decodes:
+      raise ValueError("Draft and target engines must have the same number of decode slots.")
+    if target.config.paged_ar_cache or draft.config.paged_ar_cache:
+      raise ValueError("Speculative decoding doesn't support paged_ar_cache.")
+    if target.config.decode_sharded_sampling or draft.config.decode_sharded_sampling:
+      raise ValueError("Speculative decoding verifies against full logits, it doesn't support decode_sharded_sampling.")
+    self.target = target
+    self.draft = draft
+    self.num_draft_tokens = num_draft_tokens
+
+  def load_params(self, *args, rng: Optional[jax.random.PRNGKey] = None, **kwargs) -> Params:
+    """Load the target and draft Parameters"""
+    if rng is None:
+      rng = jax.random.PRNGKey(0)
+    target_rng, draft_rng = jax.random.split(rng)
+    return {
+        "target": self.target.load_params(*args, rng=target_rng, **kwargs),
+        "draft": self.draft.load_params(*args, rng=draft_rng, **kwargs),
+    }
+
+  def prefill(
+      self,
+      *,
+      params: Params,
+      existing_prefix: Optional[Prefix] = None,
+      padded_tokens: jax.Array,
+      true_length: int,
+      sampler: Optional[Callable[[Any], Any]] = None,
+      rng: Optional[jax.random.PRNGKey] = None,
+  ) -> Tuple[Prefix, engine_api.ResultTokens]:
+    """Prefills the prompt in both models; the first token is sampled from the target model."""
+    target_prefix, result = self.target.prefill(
+        params=params["target"],
+        existing_prefix=None if existing_prefix is None else existing_prefix["target"],
+        padded_tokens=padded_tokens,
+        true_length=true_length,
+        sampler=sampler,
+        rng=rng,
+    )
+    draft_prefix, _ = self.draft.prefill(
+        params=params["draft"],
+        existing_prefix=None if existing_prefix is None else existing_prefix["draft"],
+        padded_tokens=padded_tokens,
+        true_length=true_length,
+        sampler=sampler,
+        rng=rng,
+    )
+    return {"target": target_prefix, "draft": draft_prefix}, result
+
+  def insert(self, prefix: Prefix, decode_state: DecodeState, slot: int) -> DecodeState:
+    """Insert into both KV caches"""
+    return {
+        "target": self.target.insert(prefix["target"], decode_state["target"], slot),
+        "draft": self.draft.insert(prefix["draft"], decode_state["draft"], slot),
+    }
+
+  @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(2,))
+  def generate(
+      self,
+      params: Params,
+      decode_state: DecodeState,
+      sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
+      rng: Optional[jax.random.PRNGKey] = None,
+  ) -> Tuple[DecodeState, engine_api.ResultTokens]:
+    """Run one speculative generate step"""
+    if rng is None:
+      rng = jax.random.PRNGKey(0)
+    num_draft_tokens = self.num_draft_tokens
+    greedy = self.target.config.decode_sampling_strategy == "greedy"
+    temperature = self.target.config.decode_sampling_temperature
+    target_state, draft_state = decode_state["target"], decode_state["draft"]
+    draft_rng, target_rng, accept_rng = jax.random.split(rng, 3)
+
+    # The draft runs one step past its last proposal, so that its cache holds every proposal.
+    def draft_step(carry, step_rng):
+      cache, token, position = carry
+      apply_rng, token_rng = jax.random.split(step_rng)
+      logits, cache = self.draft.autoregressive_chunk(params["draft"], cache, token, position, apply_rng)
+      logits = logits[:, 0, :]
+      if greedy:
+        next_token = jnp.argmax(logits, axis=-1)
+      else:
+        next_token = jax.random.categorical(token_rng, logits / temperature)
+      next_token = next_token.astype(jnp.int32)
+      return (cache, next_token[:, None], position + 1), (next_token, logits)
+
+    (draft_cache, _, _), (draft_tokens, draft_logits) = jax.lax.scan(
+        draft_step,
+        (draft_state["cache"], target_state["tokens"], target_state["next_pos"]),
+        jax.random.split(draft_rng, num_draft_tokens + 1),
+    )
+    draft_tokens = jnp.transpose(draft_tokens[:num_draft_tokens])  # [batch, num_draft_tokens]
+    draft_logits = jnp.transpose(draft_logits[:num_draft_tokens], (1, 0, 2))  # [batch, num_draft_tokens, vocab]
+
+    # The target scores the last token and every proposal in one pass.
+    verify_tokens = jnp.concatenate((target_state["tokens"], draft_tokens), axis=1)
+    verify_positions = target_state["next_pos"] + jnp.arange(num_draft_tokens + 1)[None, :]
+    target_logits, target_cache = self.target.autoregressive_chunk(
+        params["target"], target_state["cache"], verify_tokens, verify_positions, target_rng
+    )
+
+    # A slot never emits more tokens than its ar caches have room left for.
+    cache_length = min(
+        config.max_target_length - config.max_prefill_predict_length for config in (self.target.config, self.draft.config)
+    )
+    new_tokens, valid, num_new_tokens, num_kept = inference_utils.speculative_accept(
+        draft_tokens,
+        draft_logits,
+        target_logits,
+        accept_rng,
+        greedy,
+        temperature,
+        cache_length - target_state["generated_tokens"][:, 0],
+    )
+    num_new_tokens = num_new_tokens[:, None]
+    next_token = jnp.where(
+        num_new_tokens > 0, jnp.take_along_axis(new_tokens, num_kept[:, None], axis=1), target_state["tokens"]
+    )
+
+    # Every slot has fed all its generated tokens through the ar cache, keep the accepted ones.
+    ar_lengths = target_state["generated_tokens"][:, 0] + num_new_tokens[:, 0]
+    target_cache = self.target.truncate_ar_cache(target_cache, ar_lengths)
+    draft_cache = self.draft.truncate_ar_cache(draft_cache, ar_lengths)
+    next_logits = jnp.take_along_axis(target_logits, num_kept[:, None, None], axis=1)
+    next_logits = jax.lax.with_sharding_constraint(next_logits, self.target.replicated_sharding)
+
+    result = engine_api.ResultTokens(
+        data=jnp.concatenate((new_tokens, valid, target_state["generated_tokens"]), axis=1),
+        # Tokens are shape [batch, speculations], so when we concatenate
+        # tokens, validity and length along their index 1 dimension then they
+        # occupy 0:speculations.
+        tokens_idx=(0, num_draft_tokens + 1),
+        # Validity occupies the same amount of space, but next in line.
+        valid_idx=(num_draft_tokens + 1, 2 * (num_draft_tokens + 1)),
+        # And lengths is rank 1.
+        length_idx=(2 * (num_draft_tokens + 1), 2 * (num_draft_tokens + 1) + 1),
+        samples_per_slot=1,
+    )
+
+    target_state = target_state | {
+        "logits": next_logits,
+        "cache": target_cache,
+        "next_pos": target_state["next_pos"] + num_new_tokens,
+        "generated_tokens": target_state["generated_tokens"] + num_new_tokens,
+        "tokens": next_token,
+    }
+    draft_state = target_state | {"logits": draft_state["logits"], "cache": draft_cache}
+    return {"target": target_state, "draft": draft_state}, result
+
+  def get_prefix_destination_sharding(self) -> Any:
+    return self.target.get_prefix_destination_sharding()
+
+  def get_tokenizer(self) -> tokenizer_pb2.TokenizerParameters:
+    return self.target.get_tokenizer()
+
+  def build_tokenizer(self, metadata: tokenizer_pb2.TokenizerParameters) -> tokenizer_api.Tokenizer:
+    return self.target.build_tokenizer(metadata)
+
+  def init_decode_state(self, *args, rng: Optional[jax.random.PRNGKey] = None, **kwargs) -> DecodeState:
+    """Initialises the decode states of both models."""
+    return {
+        "target": self.target.init_decode_state(*args, rng=rng, **kwargs),
+        "draft": self.draft.init_decode_state(*args, rng=rng, **kwargs),
+    }
+
+  @property
+  def max_concurrent_decodes(self) -> int:
+    """Free slots."""
+    return self.target.max_concurrent_decodes
+
+  @property
+  def max_prefill_length(self) -> int:
+    """Maximum prefill length."""
+    return min(self.target.max_prefill_length, self.draft.max_prefill_length)
+
+  @property
+  def samples_per_slot(self) -> int:
+    """Number of samples per slot."""
+    return 1
+
+  @property
+  def mesh(self) -> jax.sharding.Mesh:
+    return self.target.mesh
+
+  @property
+  def colocated_cpus(self) -> None:
+    """CPU devices colocated with the engine's accelerators."""
+    raise NotImplementedError
+
+
 def set_engine_vars_from_base_engine(engine: engine_api.Engine, base_engine: engine_api.Engine, rng: jax.random.PRNGKey):
   """Set internal vars from base_engine, which has already loaded the checkpoint and has sharding,
   mesh, and kv cache related vars set.
@@ -0,0 +1,93 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Host side LRU store of prefill results, looked up by the longest shared token prefix."""
+
+import collections
+from typing import Any, Optional, Sequence, Tuple
+
+
+class PrefixCache:
+  """Keeps the most recently used prefill results and finds the longest cached prefix of a prompt.
+
+  Every stored prompt is indexed by the hash of each of its block aligned prefixes, so a lookup costs
+  one dict probe per block. Hash hits are confirmed against the stored tokens before they are used.
+  """
+
+  def __init__(self, max_entries: int, block_size: int):
+    if max_entries <= 0:
+      raise ValueError(f"max_entries must be positive, got {max_entries=}")
+    if block_size <= 0:
+      raise ValueError(f"block_size must be positive, got {block_size=}")
+    self.max_entries = max_entries
+    self.block_size = block_size
+    # tokens -> prefix, ordered from least to most recently used.
+    self._entries: collections.OrderedDict[Tuple[int, ...], Any] = collections.OrderedDict()
+    # hash of a block aligned token prefix -> tokens of the entry it was taken from.
+    self._index: dict[int, Tuple[int, ...]] = {}
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def __contains__(self, tokens: Sequence[int]) -> bool:
+    return tuple(tokens) in self._entries
+
+  def _block_aligned_lengths(self, num_tokens: int):
+    return range(self.block_size, num_tokens + 1, self.block_size)
+
+  def lookup(self, tokens: Sequence[int]) -> Tuple[int, Optional[Any]]:
+    """Finds the longest block aligned cached prefix of tokens which leaves at least one token uncached.
+
+    Returns:
+      (matched_length, prefix) where prefix holds a prefill of at least matched_length tokens, or (0, None)
+      if nothing matches.
+    """
+    tokens = tuple(tokens)
+    for length in reversed(self._block_aligned_lengths(len(tokens) - 1)):
+      entry_tokens = self._index.get(hash(tokens[:length]))
+      if entry_tokens is None or entry_tokens[:length] != tokens[:length]:
+        continue
+      self._entries.move_to_end(entry_tokens)
+      return length, self._entries[entry_tokens]
+    return 0, None
+
+  def insert(self, tokens: Sequence[int], prefix: Any) -> None:
+    """Stores the prefill of tokens, evicting the least recently used entries when full."""
+    tokens = tuple(tokens)
+    if tokens in self._entries:
+      self._entries.move_to_end(tokens)
+      return
+    self._entries[tokens] = prefix
+    for length in self._block_aligned_lengths(len(tokens)):
+      self._index[hash(tokens[:length])] = tokens
+    while len(self._entries) > self.max_entries:
+      self._evict()
+
+  def _evict(self) -> None:
+    evicted_tokens, _ = self._entries.popitem(last=False)
+    for length in self._block_aligned_lengths(len(evicted_tokens)):
+      key = hash(evicted_tokens[:length])
+      if self._index.get(key) == evicted_tokens:
+        # Another entry sharing this prefix may still serve it.
+        replacement = next((t for t in reversed(self._entries) if t[:length] == evicted_tokens[:length]), None)
+        if replacement is None:
+          del self._index[key]
+        else:
+          self._index[key] = replacement
+
+  def clear(self) -> None:
+    self._entries.clear()
+    self._index.clear()
@@ -60,13 +60,21 @@ def validate_compute_axis_order(s: str) -> None:
 
 
 def validate_kv_quant_axis(s: str, quantize_kvcache: bool) -> None:
-  valid_kv_quant_axis = ("", "dkv", "heads_and_dkv")
+  valid_kv_quant_axis = ("", "dkv", "heads_and_dkv", "dkv_groups")
   if s not in valid_kv_quant_axis:  # currently supported kv_quant_axis
     raise ValueError("Invalid kv_quant_axis was passed. Valid options ", valid_kv_quant_axis)
   if quantize_kvcache and s == "":
     raise ValueError("kv_quant_axis can not be '' when quantize_kvcache is True")
 
 
+def validate_kv_quant_groups(keys):
+  if not keys["quantize_kvcache"] or keys["kv_quant_axis"] != "dkv_groups":
+    return
+  group_size = keys["kv_quant_group_size"]
+  if group_size <= 0 or keys["head_dim"] % group_size != 0:
+    raise ValueError(f"kv_quant_group_size must be positive and divide head_dim={keys['head_dim']}, got {group_size}")
+
+
 def validate_attention_kernel(s: str) -> None:
   valid_attention_kernels = ("autoselected", "dot_product", "flash", "cudnn_flash_te")
   if s not in valid_attention_kernels:  # currently supported attention
@@ -85,12 +93,91 @@ def validate_profiler_type(s: str) -> None:
     raise ValueError("Invalid profiler type was passed. Valid options ", valid_profiler_types)
 
 
+def validate_paged_ar_cache(keys):
+  if not keys["paged_ar_cache"]:
+    return
+  if keys["ar_cache_page_size"] <= 0:
+    raise ValueError(f"ar_cache_page_size must be positive when paged_ar_cache is True, got {keys['ar_cache_page_size']}")
+  if keys["quantize_kvcache"]:
+    raise ValueError("paged_ar_cache doesn't currently support quantize_kvcache.")
+  if keys["use_ragged_attention"]:
+    raise ValueError("paged_ar_cache doesn't currently support use_ragged_attention.")
+
+
+def validate_sliding_window_kv_cache(keys):
+  if not keys["sliding_window_kv_cache"]:
+    return
+  if keys["paged_ar_cache"]:
+    raise ValueError("sliding_window_kv_cache doesn't currently support paged_ar_cache.")
+
+
+def validate_unified_kv_cache(keys):
+  if not keys["unified_kv_cache"]:
+    return
+  if keys["paged_ar_cache"]:
+    raise ValueError("unified_kv_cache doesn't currently support paged_ar_cache.")
+  if keys["sliding_window_kv_cache"]:
+    raise ValueError("unified_kv_cache doesn't currently support sliding_window_kv_cache.")
+  if keys["enable_prefix_caching"] or keys["prefill_chunk_size"] > 0:
+    raise ValueError("unified_kv_cache doesn't currently support prefix caching or chunked prefill.")
+
+
+def validate_decode_sequence_splits(keys):
+  if keys["decode_sequence_splits"] < 0:
+    raise ValueError(f"decode_sequence_splits can't be negative, got {keys['decode_sequence_splits']}")
+  axis = keys["decode_sequence_split_axis"]
+  if axis and axis not in keys["mesh_axes"]:
+    raise ValueError(f"decode_sequence_split_axis must be one of {keys['mesh_axes']}, got {axis}")
+  if axis and keys["decode_sequence_splits"] <= 1:
+    raise ValueError("decode_sequence_split_axis needs decode_sequence_splits > 1.")
+
+
+def validate_kv_layout_cache(keys):
+  if keys["use_kv_layout_cache"] and not keys["kv_layout_cache_path"]:
+    raise ValueError("use_kv_layout_cache needs kv_layout_cache_path.")
+  if keys["kv_layout_autotune_prune_ratio"] < 1.0:
+    raise ValueError(f"kv_layout_autotune_prune_ratio must be at least 1, got {keys['kv_layout_autotune_prune_ratio']}")
+
+
+def validate_prefix_caching(keys):
+  if not keys["enable_prefix_caching"]:
+    return
+  if keys["prefix_caching_block_size"] <= 0:
+    raise ValueError(f"prefix_caching_block_size must be positive, got {keys['prefix_caching_block_size']}")
+  if keys["prefix_caching_max_entries"] <= 0:
+    raise ValueError(f"prefix_caching_max_entries must be positive, got {keys['prefix_caching_max_entries']}")
+
+
+def validate_prefill_chunk_size(keys):
+  if keys["prefill_chunk_size"] < 0:
+    raise ValueError(f"prefill_chunk_size must be non-negative, got {keys['prefill_chunk_size']}")
+  if keys["prefill_chunk_size"] > keys["max_prefill_predict_length"]:
+    raise ValueError(
+        f"prefill_chunk_size ({keys['prefill_chunk_size']}) can't exceed "
+        f"max_prefill_predict_length ({keys['max_prefill_predict_length']})"
+    )
+
+
+def validate_decode_num_top_logprobs(keys):
+  if keys["decode_num_top_logprobs"] < 0:
+    raise ValueError(f"decode_num_top_logprobs must be non-negative, got {keys['decode_num_top_logprobs']}")
+
+
 def validate_keys(keys):
   validate_attention_kernel(keys["attention"])
   validate_attention_type(keys["attention_type"])
   validate_profiler_type(keys["profiler"])
   validate_compute_axis_order(keys["compute_axis_order"])
   validate_kv_quant_axis(keys["kv_quant_axis"], keys["quantize_kvcache"])
+  validate_kv_quant_groups(keys)
+  validate_paged_ar_cache(keys)
+  validate_sliding_window_kv_cache(keys)
+  validate_unified_kv_cache(keys)
+  validate_decode_sequence_splits(keys)
+  validate_kv_layout_cache(keys)
+  validate_prefix_caching(keys)
+  validate_prefill_chunk_size(keys)
+  validate_decode_num_top_logprobs(keys)
 
   assert (keys["load_parameters_path"] == "" and keys["load_full_state_path"] == "") or keys[
       "enable_checkpointing"
@@ -0,0 +1,97 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Microbenchmark of nucleus sampling: full vocab sort vs. top-k / approx_max_k candidates.
+
+Example:
+  python3 MaxText/sampling_microbenchmark.py --vocab_sizes=32000,128256,256000 --batch_sizes=1,96
+"""
+import argparse
+import datetime
+import functools
+import json
+
+import jax
+import jax.numpy as jnp
+
+import inference_utils
+
+_WARMUP_ITERS = 2
+
+
+def sorted_nucleus(logits, nucleus_topp, temperature, rng):
+  """Nucleus sampling which always sorts the whole vocab, as it was done before the candidate search."""
+  cutoff_logit = inference_utils.nucleus_cutoff_logit_sorted(logits, nucleus_topp)
+  logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, inference_utils.NEG_INF), logits)
+  return jax.random.categorical(rng, logits / temperature)
+
+
+def benchmark_loop(sample_fn, logits, iters):
+  """Returns the average time in ms of sample_fn over iters calls."""
+  rng = jax.random.PRNGKey(1234)
+  for _ in range(_WARMUP_ITERS):
+    rng, rng_sample = jax.random.split(rng)
+    tokens = sample_fn(logits, rng_sample)
+  jax.block_until_ready(tokens)
+  start = datetime.datetime.now()
+  for _ in range(iters):
+    rng, rng_sample = jax.random.split(rng)
+    tokens = sample_fn(logits, rng_sample)
+  jax.block_until_ready(tokens)
+  end = datetime.datetime.now()
+  return 1000 * (end - start).total_seconds() / iters
+
+
+def main(args):
+  methods = {
+      "sorted": sorted_nucleus,
+      "top_k": functools.partial(inference_utils.sample_nucleus_topp_logits, num_candidates=args.num_candidates),
+      "approx_max_k": functools.partial(
+          inference_utils.sample_nucleus_topp_logits, num_candidates=args.num_candidates, approx=True
+      ),
+  }
+  results = {}
+  for vocab_size in [int(v) for v in args.vocab_sizes.split(",")]:
+    for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+      logits = jax.random.normal(jax.random.PRNGKey(0), (batch_size, 1, vocab_size), dtype=jnp.float32) * args.logit_scale
+      key = f"vocab_{vocab_size}_batch_{batch_size}"
+      results[key] = {}
+      print(f"Nucleus sampling benchmark results for vocab size {vocab_size}, batch size {batch_size}:\n")
+      for name, method in methods.items():
+        sample_fn = jax.jit(functools.partial(method, nucleus_topp=args.nucleus_topp, temperature=args.temperature))
+        results[key][name] = benchmark_loop(lambda logits, rng, fn=sample_fn: fn(logits, rng=rng), logits, args.iters)
+        print(f"\t{name} average time: {results[key][name]:.3f} ms")
+      print("\n\n")
+
+  if args.log_file_path:
+    with open(args.log_file_path, "w", encoding="utf-8") as f:
+      json.dump(results, f, indent=2)
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--vocab_sizes", type=str, default="32000,128256,256000")
+  parser.add_argument("--batch_sizes", type=str, default="1,32,96")
+  parser.add_argument("--num_candidates", type=int, default=inference_utils.NUCLEUS_CANDIDATES)
+  parser.add_argument("--nucleus_topp", type=float, default=0.9)
+  parser.add_argument("--temperature", type=float, default=1.0)
+  parser.add_argument(
+      "--logit_scale", type=float, default=8.0, help="Scale of the random logits, larger values give peakier distributions."
+  )
+  parser.add_argument("--iters", type=int, default=100)
+  parser.add_argument("--log_file_path", type=str, default="")
+  main(parser.parse_args())
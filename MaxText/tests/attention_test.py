@@ -174,6 +174,234 @@ class AttentionTest(unittest.TestCase):
       self.assertTrue(mha_full_this_idx.shape == mha_idx.shape)
       self.assertTrue(jax.numpy.allclose(mha_full_this_idx, mha_idx, rtol=1e-02, atol=1e-02, equal_nan=False))
 
+  @pytest.mark.tpu
+  def test_prefill_continuation(self):
+    """Test that prefilling a prompt in two chunks matches the full attention, and that decoding continues from it"""
+    prefill_length = self.cfg.max_prefill_predict_length
+    chunk_length = prefill_length // 2
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(self.dtype)
+
+    mha_full = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx,
+        lnx,
+        decoder_segment_ids=decoder_segment_ids,
+        inputs_positions=decoder_positions,
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"aqt": self.rng},
+    )
+
+    output_cache = {}
+    chunks = ((0, common_types.MODEL_MODE_PREFILL), (chunk_length, common_types.MODEL_MODE_PREFILL_CONTINUATION))
+    for start, model_mode in chunks:
+      end = start + chunk_length
+      self._attention_as_mha_generic_variable.update(output_cache)
+      mha_chunk, output_cache = self._attention_as_mha_generic.apply(
+          self._attention_as_mha_generic_variable,
+          lnx[:, start:end, :],
+          lnx[:, start:end, :],
+          decoder_segment_ids=decoder_segment_ids[:, start:end],
+          inputs_positions=decoder_positions[:, start:end],
+          deterministic=True,
+          model_mode=model_mode,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      self.assertTrue(jax.numpy.allclose(mha_chunk, mha_full[:, start:end, :], rtol=1e-02, atol=1e-02, equal_nan=False))
+
+    self._attention_as_mha_generic_variable.update(output_cache)
+    mha_idx, _ = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx[:, prefill_length : prefill_length + 1, :],
+        lnx[:, prefill_length : prefill_length + 1, :],
+        inputs_positions=decoder_positions[:, prefill_length : prefill_length + 1],
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
+        rngs={"aqt": self.rng},
+        mutable=["cache"],
+    )
+    self.assertTrue(
+        jax.numpy.allclose(
+            mha_idx, mha_full[:, prefill_length : prefill_length + 1, :], rtol=1e-02, atol=1e-02, equal_nan=False
+        )
+    )
+
+  def test_sliding_window_prefill_continuation(self):
+    """Test that prefilling a prompt in chunks through local sliding attention matches the full attention"""
+    prefill_length = self.cfg.max_prefill_predict_length
+    chunk_length = 4
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(self.dtype)
+
+    sliding_attention = Attention(
+        config=self.cfg,
+        num_query_heads=self.num_query_heads,
+        num_kv_heads=self.num_kv_heads,
+        head_dim=self.head_dim,
+        max_target_length=self.max_target_length,
+        max_prefill_predict_length=self.max_prefill_predict_length,
+        mesh=self.mesh,
+        attention_kernel="dot_product",
+        dtype=self.dtype,
+        attention_type=attentions.AttentionType.LOCAL_SLIDING,
+        sliding_window_size=chunk_length + 1,
+    )
+    sliding_attention_variable = sliding_attention.init(
+        {"params": self.rng, "aqt": self.rng},
+        jnp.ones((self.global_batch_size, self.max_target_length, self.embed_dim)),
+        jnp.ones((self.global_batch_size, self.max_target_length, self.embed_dim)),
+        jnp.ones((self.global_batch_size, self.max_target_length)),
+    )
+    sliding_full = sliding_attention.apply(
+        sliding_attention_variable,
+        lnx,
+        lnx,
+        decoder_segment_ids=decoder_segment_ids,
+        inputs_positions=decoder_positions,
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"aqt": self.rng},
+    )
+
+    # The later chunks' windows start past the first tokens of the cached prefix.
+    output_cache = {}
+    for start in range(0, prefill_length, chunk_length):
+      end = start + chunk_length
+      model_mode = common_types.MODEL_MODE_PREFILL if start == 0 else common_types.MODEL_MODE_PREFILL_CONTINUATION
+      sliding_attention_variable.update(output_cache)
+      sliding_chunk, output_cache = sliding_attention.apply(
+          sliding_attention_variable,
+          lnx[:, start:end, :],
+          lnx[:, start:end, :],
+          decoder_segment_ids=decoder_segment_ids[:, start:end],
+          inputs_positions=decoder_positions[:, start:end],
+          deterministic=True,
+          model_mode=model_mode,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      self.assertTrue(
+          jax.numpy.allclose(sliding_chunk, sliding_full[:, start:end, :], rtol=1e-02, atol=1e-02, equal_nan=False)
+      )
+
+  @pytest.mark.tpu
+  def test_autoregressive_chunk(self):
+    """Test that decoding several tokens per step through the ar cache matches the full attention"""
+    prefill_length = self.cfg.max_prefill_predict_length
+    chunk_length = 4
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(self.dtype)
+
+    mha_full = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx,
+        lnx,
+        decoder_segment_ids=decoder_segment_ids,
+        inputs_positions=decoder_positions,
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"aqt": self.rng},
+    )
+
+    _, output_cache = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx[:, 0:prefill_length, :],
+        lnx[:, 0:prefill_length, :],
+        decoder_segment_ids=decoder_segment_ids[:, 0:prefill_length],
+        inputs_positions=decoder_positions[:, 0:prefill_length],
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_PREFILL,
+        rngs={"aqt": self.rng},
+        mutable=["cache"],
+    )
+
+    for start in range(prefill_length, prefill_length + 3 * chunk_length, chunk_length):
+      end = start + chunk_length
+      self._attention_as_mha_generic_variable.update(output_cache)
+      mha_chunk, output_cache = self._attention_as_mha_generic.apply(
+          self._attention_as_mha_generic_variable,
+          lnx[:, start:end, :],
+          lnx[:, start:end, :],
+          inputs_positions=decoder_positions[:, start:end],
+          deterministic=True,
+          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE_CHUNK,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      self.assertTrue(jax.numpy.allclose(mha_chunk, mha_full[:, start:end, :], rtol=1e-02, atol=1e-02, equal_nan=False))
+
+  @pytest.mark.tpu
+  def test_autoregression_writes_at_slot_length(self):
+    """Test that a slot reset in the middle of decoding writes its ar cache from the start"""
+    prefill_length = self.cfg.max_prefill_predict_length
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(self.dtype)
+
+    _, output_cache = self._attention_as_mha_generic.apply(
+        self._attention_as_mha_generic_variable,
+        lnx[:, 0:prefill_length, :],
+        lnx[:, 0:prefill_length, :],
+        decoder_segment_ids=decoder_segment_ids[:, 0:prefill_length],
+        inputs_positions=decoder_positions[:, 0:prefill_length],
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_PREFILL,
+        rngs={"aqt": self.rng},
+        mutable=["cache"],
+    )
+
+    def decode(idx, output_cache):
+      self._attention_as_mha_generic_variable.update(output_cache)
+      _, output_cache = self._attention_as_mha_generic.apply(
+          self._attention_as_mha_generic_variable,
+          lnx[:, idx : idx + 1, :],
+          lnx[:, idx : idx + 1, :],
+          inputs_positions=decoder_positions[:, idx : idx + 1],
+          deterministic=True,
+          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      return output_cache
+
+    num_steps = 3
+    for idx in range(prefill_length, prefill_length + num_steps):
+      output_cache = decode(idx, output_cache)
+
+    # Reset slot 0 the way MaxEngine.insert does, then decode one more token.
+    op_cache = output_cache["cache"]["AttentionOp_0"]
+    op_cache["cached_ar_lengths"] = op_cache["cached_ar_lengths"].replace_boxed(
+        op_cache["cached_ar_lengths"].unbox().at[0].set(0)
+    )
+    op_cache["cache_ar_segment_id"] = op_cache["cache_ar_segment_id"].replace_boxed(
+        op_cache["cache_ar_segment_id"].unbox().at[0].set(0)
+    )
+    output_cache = decode(prefill_length + num_steps, output_cache)
+
+    op_cache = output_cache["cache"]["AttentionOp_0"]
+    lengths = op_cache["cached_ar_lengths"].unbox()
+    segment_ids = op_cache["cache_ar_segment_id"].unbox()
+    self.assertEqual(int(lengths[0]), 1)
+    self.assertTrue(jnp.array_equal(segment_ids[0] > 0, jnp.arange(segment_ids.shape[1]) < 1))
+    if self.global_batch_size > 1:
+      self.assertTrue(jnp.all(lengths[1:] == num_steps + 1))
+      self.assertTrue(jnp.array_equal(segment_ids[1] > 0, jnp.arange(segment_ids.shape[1]) < num_steps + 1))
+
+  def test_scatter_token_into_cache(self):
+    """Test the batched scatter against writing one slot at a time, for every cache layout"""
+    logical_names = (attentions.CACHE_BATCH, attentions.CACHE_SEQUENCE, attentions.CACHE_HEADS, attentions.CACHE_KV)
+    batch, length, heads, head_dim = 4, 8, 2, 3
+    write_positions = jnp.array([0, 5, 7, 2])
+    logical_cache = jax.random.normal(self.rng, (batch, length, heads, head_dim))
+    logical_token = jax.random.normal(jax.random.PRNGKey(1), (batch, 1, heads, head_dim))
+    expected = logical_cache
+    for i in range(batch):
+      expected = expected.at[i, write_positions[i]].set(logical_token[i, 0])
+
+    for axis_order in itertools.permutations(range(4)):
+      axis_names = tuple(logical_names[i] for i in axis_order)
+      updated = attentions.scatter_token_into_cache(
+          jnp.transpose(logical_cache, axis_order), jnp.transpose(logical_token, axis_order), write_positions, axis_names
+      )
+      self.assertTrue(jnp.array_equal(jnp.transpose(updated, np.argsort(axis_order)), expected), axis_order)
+
   @pytest.mark.tpu
   def test_model_mode_prefill_dtype_float32(self):
     self._test_model_mode_prefill_dtype(jnp.float32)
@@ -720,6 +948,133 @@ class AttentionTest(unittest.TestCase):
         )
     )
 
+  @pytest.mark.tpu
+  def test_paged_ar_cache_autoregression(self):
+    """Test equivalence between the full attention and decoding through a paged ar cache"""
+    self._autoregression_with_config(paged_ar_cache=True, ar_cache_page_size=16)
+
+  @pytest.mark.tpu
+  def test_sliding_window_kv_cache_autoregression(self):
+    """Test equivalence between the full sliding window attention and decoding through a window sized ar cache"""
+    self._autoregression_with_config(
+        attention_kwargs={"attention_type": attentions.AttentionType.LOCAL_SLIDING, "sliding_window_size": 8},
+        sliding_window_kv_cache=True,
+    )
+
+  @pytest.mark.tpu
+  def test_unified_kv_cache_autoregression(self):
+    """Test equivalence between the full attention and decoding through a single prefill+ar cache"""
+    self._autoregression_with_config(unified_kv_cache=True)
+
+  @pytest.mark.tpu
+  def test_decode_sequence_splits_autoregression(self):
+    """Test equivalence between the full attention and decoding over caches split along the sequence"""
+    # 5 doesn't divide either cache length, so the last chunks are padded.
+    self._autoregression_with_config(decode_sequence_splits=5)
+
+  def test_paged_ar_cache_matches_dense_ar_cache(self):
+    """Test that decoding through the paged ar cache matches decoding through the dense ar cache"""
+    # 10 steps fill 3 pages of 4 tokens, the last one partly.
+    _, _, dense_outputs = self._decode_with_config(decode_steps=10)
+    _, _, paged_outputs = self._decode_with_config(decode_steps=10, paged_ar_cache=True, ar_cache_page_size=4)
+    for dense_output, paged_output in zip(dense_outputs, paged_outputs):
+      self.assertTrue(jax.numpy.allclose(dense_output, paged_output, rtol=1e-02, atol=1e-02, equal_nan=False))
+
+  def _autoregression_with_config(self, attention_kwargs=None, **config_overrides):
+    """Checks that prefill followed by autoregression matches the full attention for a config."""
+    rtol, atol = 1e-02, 1e-02
+    attention_full, attention_prefill, attention_decode = self._decode_with_config(attention_kwargs, **config_overrides)
+    prefill_length = attention_prefill.shape[1]
+    self.assertTrue(
+        jax.numpy.allclose(attention_full[:, :prefill_length, :], attention_prefill, rtol=rtol, atol=atol, equal_nan=False)
+    )
+    for idx, attention_idx in enumerate(attention_decode, start=prefill_length):
+      attention_full_this_idx = attention_full[:, idx : idx + 1, :]
+      self.assertTrue(attention_full_this_idx.shape == attention_idx.shape)
+      self.assertTrue(jax.numpy.allclose(attention_full_this_idx, attention_idx, rtol=rtol, atol=atol, equal_nan=False))
+
+  def _decode_with_config(self, attention_kwargs=None, decode_steps=None, **config_overrides):
+    """Runs the full attention, prefill and decode_steps autoregressive steps (all of them by default) for a config.
+
+    Returns:
+      the full attention output, the prefill output and the list of the outputs of every decode step.
+    """
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        per_device_batch_size=1.0,
+        run_name="test",
+        enable_checkpointing=False,
+        max_target_length=128,
+        max_prefill_predict_length=16,
+        attention="dot_product",
+        **config_overrides,
+    )
+    config = pyconfig.config
+
+    prefill_length = config.max_prefill_predict_length
+    decode_total_length = config.max_target_length
+    if decode_steps is not None:
+      decode_total_length = prefill_length + decode_steps
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(config.dtype)
+
+    attention = Attention(
+        mesh=self.mesh,
+        config=config,
+        num_query_heads=config.num_query_heads,
+        num_kv_heads=config.num_kv_heads,
+        head_dim=config.head_dim,
+        max_target_length=config.max_target_length,
+        max_prefill_predict_length=config.max_prefill_predict_length,
+        attention_kernel=config.attention,
+        dtype=config.dtype,
+        **(attention_kwargs or {}),
+    )
+    attention_variable = attention.init(
+        {"params": self.rng, "aqt": self.rng},
+        jnp.ones((self.global_batch_size, config.max_target_length, config.base_emb_dim)),
+        jnp.ones((self.global_batch_size, config.max_target_length, config.base_emb_dim)),
+        jnp.ones((self.global_batch_size, config.max_target_length)),
+    )
+    attention_full = attention.apply(
+        attention_variable,
+        lnx,
+        lnx,
+        decoder_segment_ids=decoder_segment_ids,
+        inputs_positions=decoder_positions,
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"aqt": self.rng},
+    )
+
+    attention_prefill, output_cache = attention.apply(
+        attention_variable,
+        lnx[:, 0:prefill_length, :],
+        lnx[:, 0:prefill_length, :],
+        decoder_segment_ids=decoder_segment_ids[:, 0:prefill_length],
+        inputs_positions=decoder_positions[:, 0:prefill_length],
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_PREFILL,
+        rngs={"aqt": self.rng},
+        mutable=["cache"],
+    )
+
+    attention_decode = []
+    for idx in range(prefill_length, decode_total_length):
+      lnx_idx = lnx[:, idx : idx + 1, :]
+      attention_variable.update(output_cache)
+      attention_idx, output_cache = attention.apply(
+          attention_variable,
+          lnx_idx,
+          lnx_idx,
+          inputs_positions=decoder_positions[:, idx : idx + 1],
+          deterministic=True,
+          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      attention_decode.append(attention_idx)
+    return attention_full, attention_prefill, attention_decode
+
 
 if __name__ == "__main__":
   unittest.main()
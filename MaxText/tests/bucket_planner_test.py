@@ -0,0 +1,93 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the prefill length bucket planner in inference_mlperf/bucket_planner.py """
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference_mlperf"))
+
+import bucket_planner  # pylint: disable=wrong-import-position
+
+# Rounded up to multiples of 32 the candidate lengths are 32, 64, 128 and 224.
+_LENGTH_COUNTS = {10: 5, 40: 5, 100: 1, 200: 3}
+
+
+def _padding(bucket_lengths, length_counts):
+  return sum(
+      count * (bucket_planner.padded_length(bucket_lengths, length) - length) for length, count in length_counts.items()
+  )
+
+
+class BucketPlannerTest(unittest.TestCase):
+
+  def test_optimal_split(self):
+    # Padding of [64, 224] is 640 - 250 + 896 - 700 = 586, less than 1226 for [32, 224] and 1130 for [128, 224].
+    self.assertEqual(bucket_planner.plan_bucket_lengths(_LENGTH_COUNTS, 2), [64, 224])
+
+  def test_matches_exhaustive_search(self):
+    candidates = [32, 64, 128, 224]
+    for num_buckets in range(1, 5):
+      best = min(
+          _padding(list(lengths) + [224], _LENGTH_COUNTS)
+          for lengths in itertools.combinations(candidates[:-1], num_buckets - 1)
+      )
+      lengths = bucket_planner.plan_bucket_lengths(_LENGTH_COUNTS, num_buckets)
+      self.assertLessEqual(len(lengths), num_buckets)
+      self.assertEqual(_padding(lengths, _LENGTH_COUNTS), best)
+
+  def test_more_buckets_than_lengths(self):
+    self.assertEqual(bucket_planner.plan_bucket_lengths(_LENGTH_COUNTS, 10), [32, 64, 128, 224])
+
+  def test_empty_and_invalid(self):
+    self.assertEqual(bucket_planner.plan_bucket_lengths({}, 2), [])
+    with self.assertRaises(ValueError):
+      bucket_planner.plan_bucket_lengths(_LENGTH_COUNTS, 0)
+
+  def test_granularity(self):
+    lengths = bucket_planner.plan_bucket_lengths({10: 1, 150: 1, 190: 2}, 2, granularity=100)
+    self.assertEqual(lengths, [100, 200])
+    self.assertEqual(bucket_planner.plan_bucket_lengths({1: 1, 33: 1}, 1, granularity=16), [48])
+
+  def test_kv_budget(self):
+    buckets = bucket_planner.plan_buckets(_LENGTH_COUNTS, 2, kv_budget_tokens=1000)
+    # batch_size = kv_budget_tokens // (2 * length): slots of max_target_length = 2 * length.
+    self.assertEqual([(b.length, b.batch_size) for b in buckets], [(64, 7), (224, 2)])
+    # A budget smaller than one slot still gets one.
+    buckets = bucket_planner.plan_buckets(_LENGTH_COUNTS, 2, kv_budget_tokens=100)
+    self.assertEqual([b.batch_size for b in buckets], [1, 1])
+
+  def test_bucket_counts(self):
+    short, long = bucket_planner.plan_buckets(_LENGTH_COUNTS, 2, kv_budget_tokens=1000)
+    self.assertEqual((short.num_prompts, short.prompt_tokens, short.padded_tokens), (10, 250, 640))
+    self.assertEqual((long.num_prompts, long.prompt_tokens, long.padded_tokens), (4, 700, 896))
+    self.assertAlmostEqual(short.padding_ratio, 1 - 250 / 640)
+    self.assertEqual(bucket_planner.Bucket(length=64, batch_size=1).padding_ratio, 0.0)
+
+  def test_padded_length(self):
+    self.assertEqual(bucket_planner.padded_length([64, 224], 10), 64)
+    self.assertEqual(bucket_planner.padded_length([64, 224], 64), 64)
+    self.assertEqual(bucket_planner.padded_length([64, 224], 65), 224)
+    # Above the largest bucket the length is rounded up to the granularity.
+    self.assertEqual(bucket_planner.padded_length([64, 224], 225), 256)
+    self.assertEqual(bucket_planner.padded_length([64, 224], 300, granularity=100), 300)
+    self.assertEqual(bucket_planner.padded_length([64, 224], 301, granularity=100), 400)
+
+
+if __name__ == "__main__":
+  unittest.main()
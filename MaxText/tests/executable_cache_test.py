@@ -0,0 +1,94 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the compiled executable cache in inference_mlperf/executable_cache.py """
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import jax.numpy as jnp
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference_mlperf"))
+
+import executable_cache  # pylint: disable=wrong-import-position
+
+
+def _fn(x, y):
+  return x * 2 + y
+
+
+class ExecutableCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.x = jnp.arange(8, dtype=jnp.float32)
+    self.y = jnp.ones(8, dtype=jnp.float32)
+
+  def key(self, **kwargs):
+    key = {"config": {"per_device_batch_size": "1"}, "inputs": executable_cache.tree_digest((self.x, self.y))}
+    return key | kwargs
+
+  def compile(self, cache):
+    """Returns the compiled _fn and whether it was loaded from cache instead of compiled."""
+    with mock.patch.object(executable_cache.log, "info") as log_info:
+      compiled = cache.compile("fn", _fn, self.x, self.y)
+    loaded = any(call.args[0].startswith("Loaded compiled fn") for call in log_info.call_args_list)
+    return compiled, loaded
+
+  def test_round_trip(self):
+    with tempfile.TemporaryDirectory() as directory:
+      compiled, loaded = self.compile(executable_cache.ExecutableCache(directory, self.key()))
+      self.assertFalse(loaded)
+      self.assertTrue(os.path.exists(os.path.join(directory, executable_cache.digest(self.key()), "fn.pickle")))
+
+      compiled_again, loaded = self.compile(executable_cache.ExecutableCache(directory, self.key()))
+      self.assertTrue(loaded)
+      np.testing.assert_array_equal(compiled_again(self.x, self.y), compiled(self.x, self.y))
+
+  def test_miss_on_config_change(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.compile(executable_cache.ExecutableCache(directory, self.key()))
+      _, loaded = self.compile(executable_cache.ExecutableCache(directory, self.key(config={"per_device_batch_size": "2"})))
+      self.assertFalse(loaded)
+
+  def test_miss_on_tree_digest_change(self):
+    other_inputs = executable_cache.tree_digest((jnp.arange(16, dtype=jnp.float32), self.y))
+    self.assertNotEqual(other_inputs, self.key()["inputs"])
+    self.assertNotEqual(executable_cache.tree_digest((self.x, self.y.astype(jnp.bfloat16))), self.key()["inputs"])
+    with tempfile.TemporaryDirectory() as directory:
+      self.compile(executable_cache.ExecutableCache(directory, self.key()))
+      _, loaded = self.compile(executable_cache.ExecutableCache(directory, self.key(inputs=other_inputs)))
+      self.assertFalse(loaded)
+
+  def test_invalidated_on_runtime_change(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.compile(executable_cache.ExecutableCache(directory, self.key()))
+      runtime = executable_cache._runtime() | {"jax": "0.0.0"}  # pylint: disable=protected-access
+      with mock.patch.object(executable_cache, "_runtime", return_value=runtime):
+        cache = executable_cache.ExecutableCache(directory, self.key())
+        self.assertFalse(os.path.exists(os.path.join(cache.path, "fn.pickle")))
+        _, loaded = self.compile(cache)
+        self.assertFalse(loaded)
+      # Reopening with the real runtime invalidates the executables compiled for the other one.
+      cache = executable_cache.ExecutableCache(directory, self.key())
+      self.assertFalse(os.path.exists(os.path.join(cache.path, "fn.pickle")))
+
+
+if __name__ == "__main__":
+  unittest.main()
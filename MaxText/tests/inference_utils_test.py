@@ -0,0 +1,265 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the sampling functions in inference_utils.py """
+import functools
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax.sharding import Mesh, PartitionSpec as P
+
+import inference_utils
+
+
+class SamplePerSlotTest(unittest.TestCase):
+  """Tests for inference_utils.sample_per_slot"""
+
+  def setUp(self):
+    self.rng = jax.random.PRNGKey(0)
+    self.batch_size = 4
+    self.logits = jax.random.normal(self.rng, (self.batch_size, 1, 128))
+    self.argmax = jnp.argmax(self.logits, axis=-1)
+
+  def _sample(self, temperature=1.0, top_k=0, top_p=1.0, greedy=False, rng=None):
+    def per_slot(value, dtype):
+      return jnp.broadcast_to(jnp.asarray(value, dtype=dtype), (self.batch_size,))
+
+    return inference_utils.sample_per_slot(
+        self.logits,
+        self.rng if rng is None else rng,
+        per_slot(temperature, jnp.float32),
+        per_slot(top_k, jnp.int32),
+        per_slot(top_p, jnp.float32),
+        per_slot(greedy, jnp.bool_),
+    )
+
+  def test_greedy_ignores_temperature(self):
+    tokens = self._sample(temperature=0.0, greedy=True)
+    self.assertEqual(tokens.shape, (self.batch_size, 1))
+    self.assertTrue(jnp.array_equal(tokens, self.argmax))
+
+  def test_top_k_one_is_argmax(self):
+    self.assertTrue(jnp.array_equal(self._sample(top_k=1), self.argmax))
+
+  def test_small_top_p_is_argmax(self):
+    self.assertTrue(jnp.array_equal(self._sample(top_p=1e-6), self.argmax))
+
+  def test_top_k_restricts_candidates(self):
+    top_4 = jax.lax.top_k(self.logits, 4)[1]
+    for seed in range(8):
+      tokens = self._sample(top_k=4, rng=jax.random.PRNGKey(seed))
+      self.assertTrue(jnp.all(jnp.any(top_4 == tokens[..., None], axis=-1)))
+
+  def test_mixed_slots(self):
+    tokens = inference_utils.sample_per_slot(
+        self.logits,
+        self.rng,
+        temperature=jnp.array([0.0, 1.0, 1.0, 2.0]),
+        top_k=jnp.array([0, 1, 0, 0], dtype=jnp.int32),
+        top_p=jnp.array([1.0, 1.0, 1e-6, 1.0]),
+        greedy=jnp.array([True, False, False, False]),
+    )
+    self.assertTrue(jnp.array_equal(tokens[:3], self.argmax[:3]))
+
+  def test_uniform_params_match_sampling(self):
+    self.assertTrue(jnp.array_equal(self._sample(greedy=True), inference_utils.sampling(self.logits, self.rng, "greedy")))
+    self.assertTrue(
+        jnp.array_equal(
+            self._sample(temperature=0.5), inference_utils.sampling(self.logits, self.rng, "weighted", temperature=0.5)
+        )
+    )
+    # The nucleus cutoff is taken on the raw logits, before the temperature.
+    for seed in range(4):
+      rng = jax.random.PRNGKey(seed)
+      expected = inference_utils.sampling(self.logits, rng, "nucleus", nucleus_topp=0.5, temperature=2.0)
+      self.assertTrue(jnp.array_equal(self._sample(temperature=2.0, top_p=0.5, rng=rng), expected))
+
+  def test_uniform_nucleus_matches_sampling_over_candidates(self):
+    # A peaked vocab larger than NUCLEUS_CANDIDATES, whose nucleus is found among the candidates.
+    logits = 4.0 * jax.random.normal(self.rng, (self.batch_size, 1, 1024))
+    per_slot = functools.partial(jnp.full, (self.batch_size,))
+    for seed in range(4):
+      rng = jax.random.PRNGKey(seed)
+      tokens = inference_utils.sample_per_slot(
+          logits, rng, per_slot(0.7), per_slot(0, dtype=jnp.int32), per_slot(0.9), per_slot(False)
+      )
+      expected = inference_utils.sampling(logits, rng, "nucleus", nucleus_topp=0.9, temperature=0.7)
+      self.assertTrue(jnp.array_equal(tokens, expected))
+
+  def test_top_k_samples_like_sampling(self):
+    top_4 = jax.lax.top_k(self.logits, 4)[1]
+    for seed in range(8):
+      rng = jax.random.PRNGKey(seed)
+      for tokens in (self._sample(top_k=4, rng=rng), inference_utils.sampling(self.logits, rng, "topk", topk=4)):
+        self.assertTrue(jnp.all(jnp.any(top_4 == tokens[..., None], axis=-1)))
+
+
+class SampleNucleusTest(unittest.TestCase):
+  """Tests the candidate search of inference_utils.sample_nucleus_topp_logits against a full sort"""
+
+  def setUp(self):
+    self.rng = jax.random.PRNGKey(0)
+    self.vocab_size = 1024
+
+  def _kept_tokens(self, logits, nucleus_topp, **kwargs):
+    """Samples many times and returns which tokens were ever drawn."""
+    rngs = jax.random.split(self.rng, 256)
+    sample = jax.vmap(lambda rng: inference_utils.sample_nucleus_topp_logits(logits, nucleus_topp, 1.0, rng, **kwargs))
+    tokens = sample(rngs)
+    return jnp.any(jax.nn.one_hot(tokens, self.vocab_size, dtype=jnp.bool_), axis=0)
+
+  def _allowed_tokens(self, logits, nucleus_topp):
+    return logits >= inference_utils.nucleus_cutoff_logit_sorted(logits, nucleus_topp)
+
+  def test_candidates_match_sorted_cutoff(self):
+    logits = jax.random.normal(self.rng, (2, 1, self.vocab_size)) * 8
+    allowed = self._allowed_tokens(logits, 0.5)
+    self.assertLessEqual(int(jnp.max(jnp.sum(allowed, axis=-1))), 16)
+    kept = self._kept_tokens(logits, 0.5, num_candidates=16)
+    self.assertTrue(jnp.all(allowed | ~kept))
+
+  def test_falls_back_when_candidates_miss_mass(self):
+    logits = jnp.zeros((2, 1, self.vocab_size))  # uniform, so 16 candidates hold 1/64 of the mass
+    for approx in (False, True):
+      kept = self._kept_tokens(logits, 0.9, num_candidates=16, approx=approx)
+      self.assertGreater(int(jnp.sum(kept)), 16)
+
+  def test_small_topp_is_argmax(self):
+    logits = jax.random.normal(self.rng, (4, 1, self.vocab_size))
+    tokens = inference_utils.sample_nucleus_topp_logits(logits, 1e-6, 1.0, self.rng, num_candidates=8)
+    self.assertTrue(jnp.array_equal(tokens, jnp.argmax(logits, axis=-1)))
+
+
+class ShardedSamplingTest(unittest.TestCase):
+  """Tests for sampling from logits sharded over the vocab"""
+
+  def setUp(self):
+    self.rng = jax.random.PRNGKey(0)
+    self.mesh = Mesh(np.array(jax.devices()), ("tensor",))
+    self.logits_spec = P(None, None, "tensor")
+    self.batch_size = 4
+    self.vocab_size = 128 * jax.device_count()
+    self.logits = jax.random.normal(self.rng, (self.batch_size, 1, self.vocab_size))
+    self.argmax = jnp.argmax(self.logits, axis=-1)
+
+  def test_sharded_top_k_matches_top_k(self):
+    values, indices = inference_utils.sharded_top_k(self.logits, 8, self.mesh, self.logits_spec)
+    expected_values, expected_indices = jax.lax.top_k(self.logits, 8)
+    self.assertTrue(jnp.allclose(values, expected_values))
+    self.assertTrue(jnp.array_equal(indices, expected_indices))
+
+  def test_greedy_is_argmax(self):
+    tokens = inference_utils.sampling_sharded(self.logits, self.rng, "greedy", self.mesh, self.logits_spec)
+    self.assertTrue(jnp.array_equal(tokens, self.argmax))
+
+  def test_topk_restricts_candidates(self):
+    top_4 = jax.lax.top_k(self.logits, 4)[1]
+    for seed in range(8):
+      tokens = inference_utils.sampling_sharded(
+          self.logits, jax.random.PRNGKey(seed), "topk", self.mesh, self.logits_spec, topk=4
+      )
+      self.assertTrue(jnp.all(jnp.any(top_4 == tokens[..., None], axis=-1)))
+
+  def test_small_nucleus_is_argmax(self):
+    tokens = inference_utils.sampling_sharded(
+        self.logits, self.rng, "nucleus", self.mesh, self.logits_spec, nucleus_topp=1e-6
+    )
+    self.assertTrue(jnp.array_equal(tokens, self.argmax))
+
+  def test_per_slot_mixed_slots(self):
+    tokens = inference_utils.sample_per_slot_sharded(
+        self.logits,
+        self.rng,
+        self.mesh,
+        self.logits_spec,
+        temperature=jnp.array([0.0, 1.0, 1.0, 2.0]),
+        top_k=jnp.array([0, 1, 0, 0], dtype=jnp.int32),
+        top_p=jnp.array([1.0, 1.0, 1e-6, 1.0]),
+        greedy=jnp.array([True, False, False, False]),
+    )
+    self.assertEqual(tokens.shape, (self.batch_size, 1))
+    self.assertTrue(jnp.array_equal(tokens[:3], self.argmax[:3]))
+
+  def test_top_logprobs(self):
+    values, indices = inference_utils.top_logprobs(self.logits, 4)
+    expected = jnp.take_along_axis(jax.nn.log_softmax(self.logits, axis=-1), indices, axis=-1)
+    self.assertTrue(jnp.allclose(values, expected, atol=1e-5))
+    self.assertTrue(jnp.array_equal(indices[..., 0], self.argmax))
+
+
+class SpeculativeAcceptTest(unittest.TestCase):
+  """Tests for the accept/reject logic of inference_utils.speculative_accept"""
+
+  def setUp(self):
+    self.rng = jax.random.PRNGKey(0)
+    self.vocab_size = 16
+    # Slot 0 agrees with the target on its first two proposals, slot 1 on none.
+    self.target_tokens = jnp.array([[5, 6, 7, 8], [5, 6, 7, 8]], dtype=jnp.int32)
+    self.draft_tokens = jnp.array([[5, 6, 9], [1, 6, 7]], dtype=jnp.int32)
+    self.target_logits = 10.0 * jax.nn.one_hot(self.target_tokens, self.vocab_size)
+    self.draft_logits = 10.0 * jax.nn.one_hot(self.draft_tokens, self.vocab_size)
+
+  def _accept(self, remaining, greedy=True, target_logits=None):
+    return inference_utils.speculative_accept(
+        self.draft_tokens,
+        self.draft_logits,
+        self.target_logits if target_logits is None else target_logits,
+        self.rng,
+        greedy,
+        1.0,
+        jnp.asarray(remaining, dtype=jnp.int32),
+    )
+
+  def test_greedy_accepts_matching_prefix(self):
+    new_tokens, valid, num_new_tokens, num_kept = self._accept([10, 10])
+    np.testing.assert_array_equal(num_new_tokens, [3, 1])
+    np.testing.assert_array_equal(num_kept, [2, 0])
+    np.testing.assert_array_equal(valid, [[1, 1, 1, 0], [1, 0, 0, 0]])
+    np.testing.assert_array_equal(new_tokens[0, :3], [5, 6, 7])
+    self.assertEqual(int(new_tokens[1, 0]), 5)
+
+  def test_caps_tokens_to_remaining_cache(self):
+    new_tokens, valid, num_new_tokens, num_kept = self._accept([2, 10])
+    np.testing.assert_array_equal(num_new_tokens, [2, 1])
+    np.testing.assert_array_equal(num_kept, [1, 0])
+    np.testing.assert_array_equal(valid[0], [1, 1, 0, 0])
+    # The last emitted token is an accepted proposal.
+    self.assertEqual(int(new_tokens[0, num_kept[0]]), 6)
+
+  def test_full_cache_emits_nothing(self):
+    _, valid, num_new_tokens, _ = self._accept([0, 1])
+    np.testing.assert_array_equal(num_new_tokens, [0, 1])
+    np.testing.assert_array_equal(valid, [[0, 0, 0, 0], [1, 0, 0, 0]])
+
+  def test_identical_distributions_accept_every_proposal(self):
+    target_logits = jnp.concatenate((self.draft_logits, self.target_logits[:, -1:]), axis=1)
+    new_tokens, valid, num_new_tokens, _ = self._accept([10, 10], greedy=False, target_logits=target_logits)
+    np.testing.assert_array_equal(num_new_tokens, [4, 4])
+    self.assertTrue(np.all(np.asarray(valid) == 1))
+    np.testing.assert_array_equal(new_tokens[:, :3], self.draft_tokens)
+
+  def test_rejects_proposals_the_target_never_samples(self):
+    target_logits = self.target_logits.at[:, 0].set(0.0)
+    target_logits = target_logits.at[jnp.arange(2), 0, self.draft_tokens[:, 0]].set(inference_utils.NEG_INF)
+    new_tokens, _, num_new_tokens, _ = self._accept([10, 10], greedy=False, target_logits=target_logits)
+    np.testing.assert_array_equal(num_new_tokens, [1, 1])
+    self.assertFalse(np.any(np.asarray(new_tokens[:, 0]) == np.asarray(self.draft_tokens[:, 0])))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -104,6 +104,55 @@ class RaggedAttentionTest(unittest.TestCase):
         msg=f"Avg difference: {jnp.average(abs(ragged_out - reference_out))} > 1e-2",
     )
 
+  def _quantize(self, x, dtype, max_value):
+    """Quantizes x per token and head over head_dim, returning the values and their [b, s, n, 1] scales."""
+    scale = jnp.max(jnp.abs(x), axis=-1, keepdims=True) / max_value
+    return jnp.rint(x / scale).astype(dtype), scale
+
+  def test_ragged_mha_quantized_interpret(self):
+    """Quantized kv is dequantized per block in the kernel, checked in interpret mode so it runs on CPU."""
+    num_heads, max_target_length, block_size = 2, 256, 128
+    q = jax.random.normal(self.k1, (self.batch_size, 1, num_heads, self.head_dim), dtype=self.dtype)
+    k = jax.random.normal(self.k2, (self.batch_size, max_target_length, num_heads, self.head_dim), dtype=self.dtype)
+    v = jax.random.normal(self.k3, (self.batch_size, max_target_length, num_heads, self.head_dim), dtype=self.dtype)
+    lengths = jnp.array([1, 100, 129, 256], dtype=jnp.int32)
+
+    for dtype, max_value in ((jnp.int8, 127), (jnp.int4, 7)):
+      qk, k_scale = self._quantize(k, dtype, max_value)
+      qv, v_scale = self._quantize(v, dtype, max_value)
+      ragged_out, _, ragged_denom = ragged_mha(
+          q, qk, qv, lengths, key_scale=k_scale, value_scale=v_scale, block_size=block_size, interpret=True
+      )
+      ragged_out = ragged_out / ragged_denom
+      reference_out, _, _ = reference_mha(q, qk, qv, lengths, k_scale=k_scale, v_scale=v_scale)
+      dequantized_out, _, _ = reference_mha(q, qk.astype(self.dtype) * k_scale, qv.astype(self.dtype) * v_scale, lengths)
+      self.assertTrue(jnp.allclose(ragged_out, reference_out, atol=1e-3), msg=f"{dtype=}")
+      self.assertTrue(jnp.allclose(reference_out, dequantized_out, atol=1e-5), msg=f"{dtype=}")
+
+  def test_ragged_gqa_quantized_interpret(self):
+    """Quantized kv with one scale per token shared across kv heads, as with heads_and_dkv kv quantization."""
+    num_query_heads, num_kv_heads, max_target_length, block_size = 4, 2, 256, 128
+    q = jax.random.normal(self.k1, (self.batch_size, 1, num_query_heads, self.head_dim), dtype=self.dtype)
+    k = jax.random.normal(self.k2, (self.batch_size, max_target_length, num_kv_heads, self.head_dim), dtype=self.dtype)
+    v = jax.random.normal(self.k3, (self.batch_size, max_target_length, num_kv_heads, self.head_dim), dtype=self.dtype)
+    lengths = jnp.array([1, 100, 129, 256], dtype=jnp.int32)
+
+    k_scale = jnp.max(jnp.abs(k), axis=(-2, -1), keepdims=True) / 127
+    v_scale = jnp.max(jnp.abs(v), axis=(-2, -1), keepdims=True) / 127
+    qk = jnp.rint(k / k_scale).astype(jnp.int8)
+    qv = jnp.rint(v / v_scale).astype(jnp.int8)
+    ragged_out, _, ragged_denom = ragged_gqa(
+        q, qk, qv, lengths, key_scale=k_scale, value_scale=v_scale, block_size=block_size, interpret=True
+    )
+    ragged_out = ragged_out / ragged_denom
+    reference_out, _, _ = reference_gqa(
+        jnp.squeeze(q),
+        jnp.swapaxes(qk.astype(self.dtype) * k_scale, 1, 2),
+        jnp.swapaxes(qv.astype(self.dtype) * v_scale, 1, 2),
+        lengths,
+    )
+    self.assertTrue(jnp.allclose(ragged_out, reference_out, atol=1e-3))
+
 
 if __name__ == "__main__":
   unittest.main()
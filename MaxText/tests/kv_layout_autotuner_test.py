@@ -0,0 +1,102 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the KV cache layout autotuner and its layout database """
+
+import math
+import os
+import sys
+import tempfile
+import unittest
+
+import kv_layout_autotuner
+import kv_layout_cache
+import pyconfig
+
+
+class KVLayoutAutotunerTest(unittest.TestCase):
+  """Tests for successive halving over layouts and the tuned layout database."""
+
+  def setUp(self):
+    super().setUp()
+    pyconfig.initialize(
+        [sys.argv[0], "configs/base.yml"],
+        enable_checkpointing=False,
+        base_num_query_heads=16,
+        base_num_kv_heads=4,
+    )
+    self.config = pyconfig.config
+
+  def test_enumerate_layouts(self):
+    ar_layouts = kv_layout_autotuner.enumerate_ar_layouts(self.config)
+    self.assertEqual(len(ar_layouts), 24 * 2 * 2)
+    self.assertEqual(len({tuple(sorted(layout.items())) for layout in ar_layouts}), len(ar_layouts))
+    self.assertEqual(len(kv_layout_autotuner.enumerate_prefill_layouts()), 24)
+
+  def test_successive_halving_prunes_and_finds_fastest(self):
+    candidates = [{"ar_cache_axis_order": str(i)} for i in range(16)]
+    times = {str(i): 10.0 + i for i in range(16)}
+    times["3"] = 1.0
+    times["5"] = math.inf  # fails to run
+    calls = []
+
+    def measure(candidate, iters):
+      calls.append((candidate["ar_cache_axis_order"], iters))
+      return times[candidate["ar_cache_axis_order"]]
+
+    best, best_time, history = kv_layout_autotuner.successive_halving(
+        candidates, measure, first_iters=2, max_iters=8, prune_ratio=1.5
+    )
+    self.assertEqual(best, {"ar_cache_axis_order": "3"})
+    self.assertEqual(best_time, 1.0)
+    # Everything but the fastest is more than prune_ratio slower, so one round is enough.
+    self.assertEqual(len(history), 1)
+    self.assertEqual(len(calls), 16)
+
+  def test_successive_halving_doubles_iters_for_survivors(self):
+    candidates = [{"ar_cache_axis_order": str(i)} for i in range(8)]
+    calls = []
+
+    def measure(candidate, iters):
+      calls.append(iters)
+      return 1.0 + 0.01 * int(candidate["ar_cache_axis_order"])
+
+    best, _, history = kv_layout_autotuner.successive_halving(
+        candidates, measure, first_iters=2, max_iters=100, prune_ratio=1.5
+    )
+    self.assertEqual(best, {"ar_cache_axis_order": "0"})
+    self.assertEqual([round_["iters"] for round_ in history], [2, 4, 8])
+    self.assertEqual(calls, [2] * 8 + [4] * 4 + [8] * 2)
+
+  def test_store_and_load_layout(self):
+    layout = {
+        "prefill_cache_axis_order": "0,1,2,3",
+        "ar_cache_axis_order": "2,0,1,3",
+        "compute_axis_order": "0,2,1,3",
+        "reshape_q": True,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "layouts", "kv_layouts.json")
+      self.assertIsNone(kv_layout_cache.load_layout(path, self.config))
+      kv_layout_cache.store_layout(path, self.config, layout, {"ar_step_in_ms": 1.0})
+      self.assertEqual(kv_layout_cache.load_layout(path, self.config), layout)
+
+      pyconfig.initialize([sys.argv[0], "configs/base.yml"], enable_checkpointing=False, per_device_batch_size=2)
+      self.assertIsNone(kv_layout_cache.load_layout(path, pyconfig.config))
+
+
+if __name__ == "__main__":
+  unittest.main()
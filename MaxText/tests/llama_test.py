@@ -184,6 +184,31 @@ class RoPETest(unittest.TestCase):
 
     self.assertTrue(jnp.allclose(query_proj, expected_proj, rtol=1e-03, atol=1e-02))
 
+  def test_rope_precomputed_table(self):
+    dim_per_head = 128
+    seq_len = 16
+    max_position = 64
+    x_q = np.random.normal(1, 0.5, (2, seq_len, 4, dim_per_head)).astype(np.float32)
+    position = jnp.stack([jnp.arange(seq_len), jnp.arange(seq_len) + max_position - seq_len]).astype(jnp.int32)
+
+    ropes = {
+        "rope": lambda **kwargs: embeddings.RotaryEmbedding(**kwargs),
+        "llama_rope": lambda **kwargs: embeddings.LLaMARotaryEmbedding(use_scale=False, **kwargs),
+        "llama3.1_rope": lambda **kwargs: embeddings.LLaMARotaryEmbedding(use_scale=True, **kwargs),
+    }
+    for name, make_rope in ropes.items():
+      kwargs = {"min_timescale": 1, "max_timescale": 500_000, "embedding_dims": dim_per_head, "fprop_dtype": jnp.float32}
+      rope = make_rope(**kwargs)
+      rope_with_table = make_rope(max_position=max_position, **kwargs)
+      expected = rope.apply({}, x_q, position)
+      with_table = rope_with_table.apply({}, x_q, position)
+      self.assertTrue(jnp.allclose(with_table, expected, rtol=1e-04, atol=1e-04), msg=name)
+
+      # sin and cos computed once and passed to another call give the same result.
+      sin_cos = rope_with_table.apply({}, position, method="sin_cos")
+      shared = rope_with_table.apply({}, x_q, sin_cos=sin_cos)
+      self.assertTrue(jnp.array_equal(shared, with_table), msg=name)
+
 
 if __name__ == "__main__":
   unittest.main()
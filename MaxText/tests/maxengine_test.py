@@ -0,0 +1,240 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for MaxEngine prefill, insert and generate on a small random model """
+import logging
+import sys
+import unittest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import maxengine
+import pyconfig
+
+
+class MaxEngineTest(unittest.TestCase):
+  """Tests for MaxEngine"""
+
+  def setUp(self):
+    super().setUp()
+    self.rng = jax.random.PRNGKey(0)
+
+  def init_engine(self, **kwargs):
+    config_overrides = {
+        "per_device_batch_size": 4,
+        "run_name": "test",
+        "enable_checkpointing": False,
+        "base_num_decoder_layers": 2,
+        "attention": "dot_product",
+        "max_target_length": 32,
+        "max_prefill_predict_length": 8,
+        "base_emb_dim": 256,
+        "base_num_query_heads": 2,
+        "base_num_kv_heads": 2,
+        "decode_sampling_strategy": "greedy",
+    }
+    pyconfig.initialize([sys.argv[0], "configs/base.yml"], **(config_overrides | kwargs))
+    engine = maxengine.MaxEngine(pyconfig.config)
+    params = engine.load_params(rng=self.rng)
+    return engine, params
+
+  def get_tokens(self, length, true_length, seed=0):
+    tokens = jax.random.randint(jax.random.PRNGKey(seed), (length,), 1, 100, dtype=jnp.int32)
+    return jnp.where(jnp.arange(length) < true_length, tokens, 0)
+
+  def cache_leaves(self, cache, name):
+    """The leaves of cache named name, one per attention layer (or one stacked over them)."""
+    return [x for path, x in jax.tree_util.tree_flatten_with_path(cache)[0] if path[-1].key == name]
+
+  def test_chunked_prefill_matches_prefill(self):
+    tokens = self.get_tokens(8, 7)
+    # pyconfig holds a single config, so every engine is used before the next one is created.
+    engine, params = self.init_engine()
+    prefix, result = engine.prefill(params=params, padded_tokens=tokens, true_length=7)
+    logits, first_token = np.asarray(prefix["logits"]), np.asarray(result.data)[:, 0]
+
+    engine, params = self.init_engine(prefill_chunk_size=3)
+    chunked_prefix, chunked_result = engine.prefill(params=params, padded_tokens=tokens, true_length=7)
+    np.testing.assert_allclose(np.asarray(chunked_prefix["logits"]), logits, rtol=5e-02, atol=5e-02)
+    np.testing.assert_array_equal(np.asarray(chunked_result.data)[:, 0], first_token)
+    np.testing.assert_array_equal(np.asarray(chunked_prefix["next_pos"]), np.asarray(prefix["next_pos"]))
+
+  def test_insert_batch_matches_insert(self):
+    engine, params = self.init_engine()
+    tokens = jnp.stack([self.get_tokens(8, 5, seed=0), self.get_tokens(8, 8, seed=1)])
+    true_lengths = jnp.array([5, 8], dtype=jnp.int32)
+    slots = jnp.array([3, 1], dtype=jnp.int32)
+
+    prefix, _ = engine.prefill_batch(params=params, padded_tokens=tokens, true_lengths=true_lengths)
+    batch_state = engine.insert_batch(prefix, engine.init_decode_state(), slots)
+    row_state = engine.init_decode_state()
+    for row in range(2):
+      row_prefix, _ = engine.prefill(params=params, padded_tokens=tokens[row], true_length=int(true_lengths[row]))
+      row_state = engine.insert(row_prefix, row_state, int(slots[row]))
+
+    for batch_leaf, row_leaf in zip(jax.tree_util.tree_leaves(batch_state), jax.tree_util.tree_leaves(row_state)):
+      np.testing.assert_allclose(
+          np.asarray(batch_leaf, dtype=np.float32), np.asarray(row_leaf, dtype=np.float32), rtol=5e-02, atol=5e-02
+      )
+    batch_state, _ = engine.generate(params, batch_state)
+    row_state, _ = engine.generate(params, row_state)
+    np.testing.assert_array_equal(np.asarray(batch_state["tokens"])[slots], np.asarray(row_state["tokens"])[slots])
+
+  def test_generate_n_matches_generate(self):
+    engine, params = self.init_engine()
+    decode_state = engine.init_decode_state()
+    for slot in range(2):
+      prefix, _ = engine.prefill(params=params, padded_tokens=self.get_tokens(8, 6, seed=slot), true_length=6)
+      decode_state = engine.insert(prefix, decode_state, slot)
+    # generate and generate_n donate the decode state.
+    initial_state = jax.tree_util.tree_map(jnp.copy, decode_state)
+
+    reference_tokens = []
+    for _ in range(4):
+      decode_state, _ = engine.generate(params, decode_state)
+      reference_tokens.append(np.asarray(decode_state["tokens"])[:, 0])
+    state, tokens, done = engine.generate_n(params, jax.tree_util.tree_map(jnp.copy, initial_state), 4)
+    np.testing.assert_array_equal(np.asarray(tokens), np.stack(reference_tokens))
+    self.assertFalse(np.any(np.asarray(done)))
+    np.testing.assert_array_equal(np.asarray(state["next_pos"]), np.asarray(decode_state["next_pos"]))
+
+    # Slot 0 samples eos at the first step and stops advancing.
+    eos_id = int(reference_tokens[0][0])
+    state, tokens, done = engine.generate_n(params, jax.tree_util.tree_map(jnp.copy, initial_state), 4, eos_id=eos_id)
+    self.assertTrue(np.all(np.asarray(done)[:, 0]))
+    self.assertEqual(int(np.asarray(state["generated_tokens"])[0, 0]), 1)
+    self.assertEqual(int(np.asarray(state["next_pos"])[0, 0]), int(np.asarray(initial_state["next_pos"])[0, 0]) + 1)
+    self.assertEqual(int(np.asarray(state["tokens"])[0, 0]), eos_id)
+    for lengths in self.cache_leaves(state["cache"], "cached_ar_lengths"):
+      self.assertEqual(int(np.asarray(lengths)[..., 0].max()), 1)
+
+  def test_prefix_cache_miss_reuses_precompiled_prefill(self):
+    engine, params = self.init_engine(enable_prefix_caching=True)
+    engine.compile_from_abstract_params([8])
+
+    class CompileMessages(logging.Handler):
+
+      def __init__(self):
+        super().__init__()
+        self.messages = []
+
+      def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    handler = CompileMessages()
+    jax_logger = logging.getLogger("jax")
+    jax_logger.addHandler(handler)
+    try:
+      with jax.log_compiles():
+        engine.prefill(params=params, padded_tokens=self.get_tokens(8, 6), true_length=6)
+    finally:
+      jax_logger.removeHandler(handler)
+    prefill_compiles = [m for m in handler.messages if "compil" in m.lower() and "_prefill_jit" in m]
+    self.assertEqual(prefill_compiles, [])
+
+  def test_offload_restore_round_trip(self):
+    if "pinned_host" not in {memory.kind for memory in jax.devices()[0].addressable_memories()}:
+      self.skipTest("Offloading slots needs the pinned_host memory kind.")
+    engine, params = self.init_engine()
+    decode_state = engine.init_decode_state()
+    prefix, _ = engine.prefill(params=params, padded_tokens=self.get_tokens(8, 6), true_length=6)
+    decode_state = engine.insert(prefix, decode_state, 0)
+    for _ in range(2):
+      decode_state, _ = engine.generate(params, decode_state)
+
+    slot_state = engine.prefetch_slot(engine.offload_slot(decode_state, 0))
+    restored_state = engine.restore_slot(slot_state, engine.init_decode_state(), 2)
+
+    # pylint: disable=protected-access
+    def slot_rows(state, slot):
+      """The leaves of state which belong to slot, leaving out the cache shared across the batch."""
+      rows = engine._slot_row(state, slot)
+      rows["cache"] = jax.tree_util.tree_map(
+          lambda x, annotations: x if engine._slot_batch_axis(annotations) >= 0 else None,
+          rows["cache"],
+          engine.kv_cache_annotations_named,
+      )
+      return jax.tree_util.tree_leaves(rows)
+
+    for original, restored in zip(slot_rows(decode_state, 0), slot_rows(restored_state, 2)):
+      np.testing.assert_array_equal(np.asarray(original, dtype=np.float32), np.asarray(restored, dtype=np.float32))
+    decode_state, _ = engine.generate(params, decode_state)
+    restored_state, _ = engine.generate(params, restored_state)
+    self.assertEqual(int(np.asarray(restored_state["tokens"])[2, 0]), int(np.asarray(decode_state["tokens"])[0, 0]))
+
+  def test_release_slots_frees_pages(self):
+    engine, params = self.init_engine(paged_ar_cache=True, ar_cache_page_size=4)
+    decode_state = engine.init_decode_state()
+    for slot in range(2):
+      prefix, _ = engine.prefill(params=params, padded_tokens=self.get_tokens(8, 5, seed=slot), true_length=5)
+      decode_state = engine.insert(prefix, decode_state, slot)
+    for _ in range(6):
+      decode_state, _ = engine.generate(params, decode_state)
+
+    released = jnp.arange(decode_state["tokens"].shape[0]) == 0
+    cache = engine.release_slots(decode_state["cache"], released)
+    for owner in self.cache_leaves(cache, "cache_ar_page_owner"):
+      self.assertFalse(np.any(np.asarray(owner) == 1))
+      self.assertTrue(np.any(np.asarray(owner) == 2))
+    for page_table in self.cache_leaves(cache, "cache_ar_page_table"):
+      self.assertTrue(np.all(np.asarray(page_table)[..., 0, :] == 0))
+      self.assertTrue(np.any(np.asarray(page_table)[..., 1, :] > 0))
+    for slot_active in self.cache_leaves(cache, "cache_ar_slot_active"):
+      self.assertEqual(int(np.asarray(slot_active)[..., 0].max()), 0)
+
+  def test_page_pool_exhaustion_is_reported(self):
+    # Slots of 6 pages of 4 tokens share a pool of 3 pages: slots 0 and 1 get their first page, then only
+    # slot 0 gets its second one, at the fifth step.
+    engine, params = self.init_engine(paged_ar_cache=True, ar_cache_page_size=4, ar_cache_num_pages=3)
+    decode_state = engine.init_decode_state()
+    for slot in range(2):
+      prefix, _ = engine.prefill(params=params, padded_tokens=self.get_tokens(8, 5, seed=slot), true_length=5)
+      decode_state = engine.insert(prefix, decode_state, slot)
+    for _ in range(4):
+      decode_state, result = engine.generate(params, decode_state)
+      self.assertTrue(np.all(np.asarray(result.data)[:, 1] == 1))
+    # generate and generate_n donate the decode state.
+    state_before_fault = jax.tree_util.tree_map(jnp.copy, decode_state)
+
+    for _ in range(2):
+      decode_state, result = engine.generate(params, decode_state)
+      np.testing.assert_array_equal(np.asarray(result.data)[:2, 1], [1, 0])
+    for fault in self.cache_leaves(decode_state["cache"], "cache_ar_page_fault"):
+      self.assertEqual(int(np.asarray(fault)[..., 0].max()), 0)
+      self.assertEqual(int(np.asarray(fault)[..., 1].min()), 1)
+    # The faulted slot gave its pages back and stopped allocating.
+    for owner in self.cache_leaves(decode_state["cache"], "cache_ar_page_owner"):
+      self.assertFalse(np.any(np.asarray(owner) == 2))
+    for slot_active in self.cache_leaves(decode_state["cache"], "cache_ar_slot_active"):
+      self.assertEqual(int(np.asarray(slot_active)[..., 1].max()), 0)
+
+    _, _, done = engine.generate_n(params, state_before_fault, 2)
+    np.testing.assert_array_equal(np.asarray(done)[:, :2], [[False, True], [False, True]])
+
+    # A caller which saw slot 0 finish releases it, and inserting into the faulted slot clears its fault.
+    decode_state = engine.release(decode_state, jnp.arange(decode_state["tokens"].shape[0]) == 0)
+    for owner in self.cache_leaves(decode_state["cache"], "cache_ar_page_owner"):
+      self.assertFalse(np.any(np.asarray(owner) > 0))
+    prefix, _ = engine.prefill(params=params, padded_tokens=self.get_tokens(8, 5, seed=2), true_length=5)
+    decode_state = engine.insert(prefix, decode_state, 1)
+    decode_state, result = engine.generate(params, decode_state)
+    self.assertEqual(int(np.asarray(result.data)[1, 1]), 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
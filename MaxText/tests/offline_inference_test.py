@@ -0,0 +1,128 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the batch_inference loop of inference_mlperf/offline_inference.py, run on a fake engine """
+import os
+import sys
+import types
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference_mlperf"))
+
+import offline_inference  # pylint: disable=wrong-import-position
+
+
+class _FakeEngine:
+  """The parts of an engine OfflineInference reads, with max_decode_length = 10."""
+
+  max_concurrent_decodes = 4
+
+  def __init__(self):
+    self.config = types.SimpleNamespace(max_target_length=20, max_prefill_predict_length=10)
+
+  def load_params(self):
+    return {}
+
+  def get_tokenizer(self):
+    return None
+
+  def build_tokenizer(self, metadata):
+    del metadata
+    return types.SimpleNamespace(eos_id=-1)
+
+
+class OfflineInferenceTest(unittest.TestCase):
+
+  def init_offline_inference(self):
+    """Returns an OfflineInference whose slot s generates 1000 * s + the number of tokens it has generated.
+
+    Like generate_n, a slot is done at the step it has generated max_decode_length tokens.
+    """
+    offline_inf = offline_inference.OfflineInference(_FakeEngine(), None, None)
+    generated = np.zeros(offline_inf.batch_size, dtype=np.int64)
+
+    def prefill_insert(params, tokens, slot, true_length, decode_state):
+      del params, tokens, true_length
+      generated[slot] = 0
+      return types.SimpleNamespace(data=np.array([[1000 * slot]])), decode_state
+
+    def generate_n(params, decode_state):
+      del params
+      tokens, done = [], []
+      for _ in range(offline_inf.decode_steps):
+        generated[:] += 1
+        tokens.append(1000 * np.arange(offline_inf.batch_size) + generated)
+        done.append(generated >= offline_inf.max_decode_length)
+      return decode_state, np.stack(tokens), np.stack(done)
+
+    offline_inf._prefill_insert = prefill_insert  # pylint: disable=protected-access
+    offline_inf._generate_n = lambda: generate_n  # pylint: disable=protected-access
+    return offline_inf
+
+  def get_data(self, max_decode_lengths):
+    return [
+        offline_inference.InputData(str(i), np.zeros(8, dtype=np.int32), 8, max_decode_length)
+        for i, max_decode_length in enumerate(max_decode_lengths)
+    ]
+
+  def test_row_max_decode_length(self):
+    offline_inf = self.init_offline_inference()
+    result = offline_inf.batch_inference(self.get_data([3, 7, None, 12]))
+    # The first token and then at most the row's max_decode_length, capped by the engine's max_decode_length of 10.
+    self.assertEqual({id_: len(tokens) for id_, tokens in result.items()}, {"0": 4, "1": 8, "2": 11, "3": 11})
+    for tokens in result.values():
+      np.testing.assert_array_equal(tokens[1:] - tokens[0], np.arange(1, len(tokens)))
+
+  def test_emit_tokens_matches_one_by_one(self):
+    max_decode_lengths = [3, 7, None, 12]
+    result = self.init_offline_inference().batch_inference(self.get_data(max_decode_lengths))
+
+    one_by_one = {}
+
+    def emit_first_token(id_, token):
+      one_by_one[id_] = [token]
+      return False
+
+    def emit_token(id_, token):
+      one_by_one[id_].append(token)
+      return False
+
+    self.init_offline_inference().batch_inference_with_callback(
+        self.get_data(max_decode_lengths), emit_first_token=emit_first_token, emit_token=emit_token, desc=""
+    )
+    self.assertEqual(result.keys(), one_by_one.keys())
+    for id_, tokens in result.items():
+      self.assertIsInstance(tokens, np.ndarray)
+      np.testing.assert_array_equal(tokens, one_by_one[id_])
+
+  def test_emit_tokens_one_by_one_stops_at_finish(self):
+    emitted = []
+
+    def emit_token(id_, token):
+      emitted.append((id_, token))
+      return token == 12
+
+    emit_tokens = offline_inference._emit_tokens_one_by_one(emit_token)  # pylint: disable=protected-access
+    tokens = np.array([[10, 20], [11, 21], [12, 22]])
+    should_finish = emit_tokens(["a", "b"], tokens, np.array([3, 2]))
+    np.testing.assert_array_equal(should_finish, [True, False])
+    self.assertEqual(emitted, [("a", 10), ("a", 11), ("a", 12), ("b", 20), ("b", 21)])
+
+
+if __name__ == "__main__":
+  unittest.main()
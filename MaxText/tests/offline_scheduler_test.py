@@ -0,0 +1,140 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the OfflineInference schedulers in inference_mlperf/offline_scheduler.py """
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference_mlperf"))
+
+import offline_scheduler  # pylint: disable=wrong-import-position
+
+
+def _state(**kwargs):
+  state = {
+      "num_pending": 10,
+      "next_length": 64,
+      "num_empty_slots": 2,
+      "batch_size": 8,
+      "prefill_batch_size": 4,
+      "decode_steps": 1,
+  }
+  return offline_scheduler.SchedulerState(**(state | kwargs))
+
+
+class CostModelTest(unittest.TestCase):
+  """Tests for offline_scheduler.CostModel"""
+
+  def setUp(self):
+    self.cost_model = offline_scheduler.CostModel({64: 10.0, 128: 16.0, 256: 28.0}, generate_step_ms=2.0)
+
+  def test_prefill_ms_interpolates_in_tokens(self):
+    self.assertEqual(self.cost_model.prefill_ms(64), 10.0)
+    self.assertEqual(self.cost_model.prefill_ms(96), 13.0)
+    self.assertEqual(self.cost_model.prefill_ms(64, num_prompts=2), 16.0)
+    # shorter than every measured length, and extrapolated past the longest one.
+    self.assertEqual(self.cost_model.prefill_ms(32), 10.0)
+    self.assertEqual(self.cost_model.prefill_ms(512), 56.0)
+
+  def test_generate_ms(self):
+    self.assertEqual(self.cost_model.generate_ms(5), 10.0)
+
+  def test_needs_a_prefill_time(self):
+    with self.assertRaises(ValueError):
+      offline_scheduler.CostModel({}, generate_step_ms=1.0)
+
+  def test_from_microbenchmark_results(self):
+    results = {
+        "prefill": {"64": {"time_in_ms": 8.0}, "128": {"time_in_ms": 12.0}},
+        "insert": {"64": {"time_in_ms": 2.0}, "128": {"time_in_ms": 4.0}},
+        "autoregressive": {"step_in_ms": 3.0, "step_in_ms_per_seq": 0.1},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, "results.json")
+      with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+      cost_model = offline_scheduler.CostModel.from_microbenchmark_results(path)
+    self.assertEqual(cost_model.lengths, [64, 128])
+    # prefill and insert together
+    self.assertEqual(cost_model.times, [10.0, 16.0])
+    self.assertEqual(cost_model.generate_step_ms, 3.0)
+
+
+class SchedulerTest(unittest.TestCase):
+  """Tests for the decisions of offline_scheduler.FixedScheduler and CostModelScheduler"""
+
+  def setUp(self):
+    # A single prompt of 64 tokens takes 10 ms, in a batch of 4 it takes 7 ms per prompt.
+    self.prefill_ms = {64: 10.0, 128: 16.0, 256: 28.0}
+
+  def _cost_model_scheduler(self, generate_step_ms):
+    return offline_scheduler.CostModelScheduler(offline_scheduler.CostModel(self.prefill_ms, generate_step_ms))
+
+  def test_fixed_scheduler(self):
+    scheduler = offline_scheduler.FixedScheduler()
+    self.assertEqual(scheduler.decide(_state(num_empty_slots=0)), offline_scheduler.ScheduleDecision(0, 1))
+    self.assertEqual(scheduler.decide(_state(num_empty_slots=3)), offline_scheduler.ScheduleDecision(3, 0))
+    self.assertEqual(scheduler.decide(_state(num_empty_slots=3, num_pending=1)), offline_scheduler.ScheduleDecision(1, 0))
+
+  def test_cost_model_scheduler_decodes_when_all_slots_are_busy(self):
+    scheduler = self._cost_model_scheduler(generate_step_ms=2.0)
+    self.assertEqual(scheduler.decide(_state(num_empty_slots=0)), offline_scheduler.ScheduleDecision(0, 1))
+
+  def test_cost_model_scheduler_waits_for_a_cheaper_batch(self):
+    # Idling 2 slots for a decode step costs 2 / 8 ms each, much less than the 3 ms a batched prefill saves.
+    scheduler = self._cost_model_scheduler(generate_step_ms=2.0)
+    self.assertEqual(scheduler.decide(_state()), offline_scheduler.ScheduleDecision(0, 1))
+
+  def test_cost_model_scheduler_prefills_when_decoding_is_expensive(self):
+    scheduler = self._cost_model_scheduler(generate_step_ms=100.0)
+    self.assertEqual(scheduler.decide(_state(decode_steps=10)), offline_scheduler.ScheduleDecision(2, 0))
+
+  def test_cost_model_scheduler_prefills_without_a_choice(self):
+    scheduler = self._cost_model_scheduler(generate_step_ms=2.0)
+    # a full batch of free slots, nothing decoding, or too few prompts left to ever fill a batch.
+    self.assertEqual(scheduler.decide(_state(num_empty_slots=4)), offline_scheduler.ScheduleDecision(4, 0))
+    self.assertEqual(scheduler.decide(_state(num_empty_slots=8)), offline_scheduler.ScheduleDecision(8, 0))
+    self.assertEqual(scheduler.decide(_state(num_pending=3)), offline_scheduler.ScheduleDecision(2, 0))
+
+
+class SchedulerStatsTest(unittest.TestCase):
+  """Tests for offline_scheduler.SchedulerStats"""
+
+  def test_duty_cycles_and_utilization(self):
+    stats = offline_scheduler.SchedulerStats(batch_size=8)
+    stats.record_prefill(4, 1.0)
+    stats.record_decode(6, 3.0)
+    stats.record_decode(8, 1.0)
+    self.assertAlmostEqual(stats.prefill_duty_cycle, 0.2)
+    self.assertAlmostEqual(stats.decode_duty_cycle, 0.8)
+    self.assertAlmostEqual(stats.slot_utilization, 14 / 16)
+    summary = stats.summary()
+    self.assertEqual(summary["num_prefill_calls"], 1)
+    self.assertEqual(summary["num_prefilled"], 4)
+    self.assertEqual(summary["num_decode_calls"], 2)
+
+  def test_empty_stats(self):
+    stats = offline_scheduler.SchedulerStats(batch_size=8)
+    self.assertEqual(stats.prefill_duty_cycle, 0.0)
+    self.assertEqual(stats.decode_duty_cycle, 0.0)
+    self.assertEqual(stats.slot_utilization, 0.0)
+
+
+if __name__ == "__main__":
+  unittest.main()
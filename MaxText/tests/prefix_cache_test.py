@@ -0,0 +1,60 @@
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the prefix cache used by MaxEngine prefill """
+import unittest
+
+import prefix_cache
+
+
+class PrefixCacheTest(unittest.TestCase):
+  """Tests for the lookup and LRU eviction of prefix_cache.PrefixCache"""
+
+  def test_lookup_matches_longest_block_aligned_prefix(self):
+    cache = prefix_cache.PrefixCache(max_entries=4, block_size=2)
+    cache.insert([1, 2, 3, 4, 5], "a")
+    self.assertEqual(cache.lookup([1, 2, 3, 4, 9, 9]), (4, "a"))
+    self.assertEqual(cache.lookup([1, 2, 3, 9]), (2, "a"))
+    self.assertEqual(cache.lookup([9, 2, 3, 4]), (0, None))
+
+  def test_lookup_leaves_a_token_to_prefill(self):
+    cache = prefix_cache.PrefixCache(max_entries=4, block_size=2)
+    cache.insert([1, 2, 3, 4], "a")
+    self.assertEqual(cache.lookup([1, 2, 3, 4]), (2, "a"))
+    self.assertEqual(cache.lookup([1, 2]), (0, None))
+
+  def test_evicts_least_recently_used(self):
+    cache = prefix_cache.PrefixCache(max_entries=2, block_size=2)
+    cache.insert([1, 2, 3], "a")
+    cache.insert([4, 5, 6], "b")
+    cache.lookup([1, 2, 7])  # refreshes "a"
+    cache.insert([7, 8, 9], "c")
+    self.assertEqual(len(cache), 2)
+    self.assertNotIn([4, 5, 6], cache)
+    self.assertEqual(cache.lookup([4, 5, 6]), (0, None))
+    self.assertEqual(cache.lookup([1, 2, 3]), (2, "a"))
+
+  def test_eviction_keeps_shared_prefix_of_remaining_entry(self):
+    cache = prefix_cache.PrefixCache(max_entries=2, block_size=2)
+    cache.insert([1, 2, 3, 4, 5], "a")
+    cache.insert([1, 2, 7, 8, 9], "b")
+    cache.insert([5, 5, 5], "c")
+    self.assertEqual(cache.lookup([1, 2, 7]), (2, "b"))
+    self.assertEqual(cache.lookup([1, 2, 3, 4, 0]), (2, "b"))
+
+
+if __name__ == "__main__":
+  unittest.main()
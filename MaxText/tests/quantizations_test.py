@@ -153,5 +153,53 @@ class QuantizationTest(unittest.TestCase):
     self.assertEqual(_expected, result)
 
 
+class KVQuantTest(unittest.TestCase):
+  """Tests for kv cache quantization."""
+
+  axis_names = ("cache_batch", "cache_sequence", "cache_heads", "cache_kv")
+
+  def _kv_quant(self, **kwargs):
+    pyconfig.initialize([None, "configs/base.yml"], enable_checkpointing=False, quantize_kvcache=True, **kwargs)
+    return quantizations.configure_kv_quant(pyconfig.config)
+
+  def _dequantize(self, kv_quant, kv):
+    """Quantizes kv and dequantizes it the way the cached values are read back."""
+    value, scale = kv_quant.quantize(kv, self.axis_names)
+    max_value = {jnp.int8: quantizations.MAX_INT8, jnp.int4: quantizations.MAX_INT4}.get(
+        kv_quant.dtype, quantizations.MAX_FP8_E4M3
+    )
+    qtensor = quantizations.KVTensor(qvalue=value, scale=[scale / max_value], scale_t=None, dequant_dtype=kv.dtype, bias=[])
+    return value, scale, kv_quant.dequant(qtensor)
+
+  def test_group_scales_are_more_accurate(self):
+    kv = random.normal(random.PRNGKey(0), (2, 8, 4, 128)) * jnp.linspace(0.1, 4.0, 128)
+    _, _, per_token = self._dequantize(self._kv_quant(kv_quant_axis="dkv", kv_quant_dtype="int4"), kv)
+    value, scale, grouped = self._dequantize(
+        self._kv_quant(kv_quant_axis="dkv_groups", kv_quant_group_size=32, kv_quant_dtype="int4"), kv
+    )
+    self.assertEqual(value.dtype, jnp.int4)
+    self.assertEqual(scale.shape, (2, 8, 4, 4))
+    self.assertLess(float(jnp.mean(jnp.abs(grouped - kv))), float(jnp.mean(jnp.abs(per_token - kv))))
+
+  def test_fp8(self):
+    kv = random.normal(random.PRNGKey(0), (2, 8, 4, 128))
+    kv_quant = self._kv_quant(kv_quant_axis="dkv", kv_quant_dtype="fp8")
+    value, _, dequantized = self._dequantize(kv_quant, kv)
+    self.assertEqual(value.dtype, jnp.float8_e4m3fn)
+    self.assertTrue(jnp.allclose(dequantized, kv, rtol=0.07, atol=1e-2))
+
+  def test_einsum_dequantizes_groups(self):
+    kv = random.normal(random.PRNGKey(0), (2, 8, 4, 128))
+    query = random.normal(random.PRNGKey(1), (2, 1, 4, 128))
+    kv_quant = self._kv_quant(kv_quant_axis="dkv_groups", kv_quant_group_size=32, kv_quant_dtype="int8")
+    value, scale, dequantized = self._dequantize(kv_quant, kv)
+    qtensor = quantizations.KVTensor(
+        qvalue=value, scale=[scale / quantizations.MAX_INT8], scale_t=None, dequant_dtype=kv.dtype, bias=[]
+    )
+    einsum = kv_quant.einsum_fn_with_rhs_qtensor(qtensor)
+    result = einsum("btnd,bsnd->bnts", query, qtensor)
+    self.assertTrue(jnp.allclose(result, jnp.einsum("btnd,bsnd->bnts", query, dequantized), rtol=1e-5, atol=1e-5))
+
+
 if __name__ == "__main__":
   unittest.main()